@@ -1,18 +1,23 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Query, Header, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, FileResponse, JSONResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, FileResponse, JSONResponse, HTMLResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType, IndexModel, ReplaceOne, UpdateOne
+from bson import Binary, ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 import os
+import sys
 import logging
 import re
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, date, timezone, timedelta
 import jwt
 import bcrypt
 import base64
@@ -23,13 +28,36 @@ import httpx
 import resend
 import asyncio
 import secrets
+import random
+import hashlib
+import heapq
+import hmac
+import time
+import csv
+import json
+import shutil
+import zlib
+import itertools
+import sqlite3
+import threading
+import ipaddress
+import fcntl
+from array import array
+from contextlib import contextmanager
+import importlib.util
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo
+import numpy as np
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware: BSON dates come back as aware UTC datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # JWT Config
@@ -98,39 +126,544 @@ DEFAULT_PLAN_CONFIGS = {
 # Launch mode - when True, check_access returns True for all active users
 LAUNCH_MODE = True
 
-# Geo cache to avoid too many API calls
-_geo_cache = {}
+# ===================== CACHING =====================
 
-async def get_geo_from_ip(ip: str) -> dict:
-    """Get country and city from IP address using ip-api.com (free, no key needed)"""
-    # Return cached result if exists
-    if ip in _geo_cache:
-        return _geo_cache[ip]
-    
-    # Default values
-    result = {"country": "Неизвестно", "city": "Неизвестно"}
-    
-    # Skip local/private IPs
-    if not ip or ip in ["127.0.0.1", "localhost", "::1"] or ip.startswith("10.") or ip.startswith("192.168.") or ip.startswith("172."):
+class TTLCache:
+    """
+    Bounded LRU cache with a per-entry TTL.
+    Only used from the event loop, so no locking is needed.
+    `generation` is bumped on every eviction so a slow fill that started
+    before an invalidation can be discarded instead of caching stale data.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: int = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key) -> bool:
+        self.generation += 1
+        return self._data.pop(key, None) is not None
+
+    def pop_where(self, predicate) -> int:
+        """Remove every entry for which predicate(key, value) is true"""
+        self.generation += 1
+        keys = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight future:
+    the first caller runs the coroutine, everyone else awaits its result.
+    Results are shared between callers and must be treated as read-only.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def do(self, key, func):
+        """func is a zero-argument coroutine function, e.g. lambda: fetch(key)"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(func())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so one caller disconnecting does not cancel the shared call
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "calls": self.calls,
+            "coalesced": self.coalesced
+        }
+
+# ===================== HTTP CLIENTS =====================
+# One pooled httpx client per upstream for the app lifetime (created in
+# startup_event, closed on shutdown): keep-alive connections, per-upstream
+# pool limits and timeouts, HTTP/2 when the h2 package is installed.
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY_SECONDS', '30'))
+
+HTTP_UPSTREAMS = {
+    "geo": {"timeout": 3.0, "max_connections": 20, "max_keepalive": 10},
+    "itunes": {"timeout": 10.0, "max_connections": 10, "max_keepalive": 5},
+    "spotify": {"timeout": 10.0, "max_connections": 10, "max_keepalive": 5},
+    "odesli": {"timeout": 15.0, "max_connections": 10, "max_keepalive": 5},
+    "huggingface": {"timeout": 120.0, "max_connections": 4, "max_keepalive": 2},
+}
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """Transport that records request count, errors, latency and new connections"""
+    def __init__(self, stats: dict, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self._stats
+        
+        async def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                stats["connections_opened"] += 1
+        
+        request.extensions["trace"] = trace
+        stats["requests"] += 1
+        started = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            stats["errors"] += 1
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stats["latency_ms_total"] += elapsed_ms
+        stats["latency_ms_max"] = max(stats["latency_ms_max"], elapsed_ms)
+        return response
+
+class HttpClientRegistry:
+    """Named, shared httpx.AsyncClient instances"""
+    def __init__(self, upstreams: dict):
+        self.upstreams = upstreams
+        self._clients = {}
+        self._stats = {
+            name: {"requests": 0, "errors": 0, "connections_opened": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+            for name in upstreams
+        }
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            config = self.upstreams[name]
+            transport = InstrumentedTransport(
+                self._stats[name],
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=config["max_connections"],
+                    max_keepalive_connections=config["max_keepalive"],
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS
+                )
+            )
+            client = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(config["timeout"], connect=min(config["timeout"], 5.0))
+            )
+            self._clients[name] = client
+        return client
+
+    async def start(self):
+        for name in self.upstreams:
+            self.get(name)
+
+    async def close(self):
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+    def stats(self) -> dict:
+        result = {"http2": HTTP2_AVAILABLE}
+        for name, s in self._stats.items():
+            completed = s["requests"] - s["errors"]
+            result[name] = {
+                "requests": s["requests"],
+                "errors": s["errors"],
+                "connections_opened": s["connections_opened"],
+                "connections_reused": max(completed - s["connections_opened"], 0),
+                "latency_ms_avg": round(s["latency_ms_total"] / completed, 1) if completed else 0,
+                "latency_ms_max": round(s["latency_ms_max"], 1)
+            }
         return result
-    
+
+http_clients = HttpClientRegistry(HTTP_UPSTREAMS)
+
+# ===================== GEO DATABASE =====================
+# Offline IP -> country/city lookups from a DB-IP "lite" CSV
+# (https://db-ip.com/db/lite.php), either dbip-country-lite
+# (ip_start,ip_end,country) or dbip-city-lite
+# (ip_start,ip_end,continent,country,stateprov,city,latitude,longitude).
+# The CSV is compiled once into sorted NumPy arrays stored next to it and
+# memory-mapped, so all workers share the same pages and a lookup is a
+# single binary search. Compilation (`python server.py compile-geo-db`, or
+# the first worker to start with a stale index) holds an exclusive file
+# lock; workers load under a shared one and never compile concurrently.
+# IPv6 ranges are indexed by their upper 64 bits (/64 granularity).
+#
+# Country and city names are stored in Russian, as ip-api.com (lang=ru) always
+# returned them, so old and new events share rollup/top-K buckets: the bundled
+# geo_names_ru.csv maps every ISO country code and the largest cities; an
+# optional GEO_NAMES_PATH CSV with rows "country,RU,Россия" / "city,Moscow,Москва"
+# adds or overrides names. Cities missing from both keep their English name.
+
+DATA_DIR = ROOT_DIR / 'data'
+GEO_DB_PATH = os.environ.get('GEO_DB_PATH', str(DATA_DIR / 'geo' / 'dbip-city-lite.csv'))
+GEO_NAMES_PATH = os.environ.get('GEO_NAMES_PATH', str(DATA_DIR / 'geo' / 'names-ru.csv'))
+GEO_BUNDLED_NAMES_PATH = str(ROOT_DIR / 'geo_names_ru.csv')
+GEO_UNKNOWN = "Неизвестно"
+
+class GeoDatabase:
+    """Sorted IP range arrays searched with np.searchsorted"""
+    ARRAYS = ("v4_start", "v4_end", "v4_loc", "v6_start", "v6_end", "v6_loc")
+
+    def __init__(self):
+        self.loaded = False
+        self.lookups = 0
+        self.found = 0
+        self._arrays = {}
+        self._locations = []
+
+    @staticmethod
+    def load_names(*paths: str) -> dict:
+        """Name tables merged in order (later files override); missing files are skipped"""
+        names = {"country": {}, "city": {}}
+        for path in paths:
+            if not path or not os.path.exists(path):
+                continue
+            with open(path, newline='', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if len(row) >= 3 and row[0] in names:
+                        names[row[0]][row[1]] = row[2]
+        return names
+
+    @staticmethod
+    def localize(names: dict, country_code: str, city: str) -> tuple:
+        """(country, city) as stored in events: localized names, GEO_UNKNOWN when empty"""
+        return (
+            names["country"].get(country_code, country_code) or GEO_UNKNOWN,
+            names["city"].get(city, city) or GEO_UNKNOWN
+        )
+
+    @staticmethod
+    @contextmanager
+    def _locked(index_dir: Path, exclusive: bool):
+        index_dir.parent.mkdir(parents=True, exist_ok=True)
+        with open(index_dir.with_name(f"{index_dir.name}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def is_stale(csv_path: str, index_dir: Path, names_path: str = None) -> bool:
+        """The CSV or a name table changed since the index was compiled"""
+        if not os.path.exists(csv_path):
+            return False
+        if not (index_dir / "locations.json").exists():
+            return True
+        compiled = os.path.getmtime(index_dir / "locations.json")
+        sources = [csv_path, GEO_BUNDLED_NAMES_PATH, names_path]
+        return any(path and os.path.exists(path) and os.path.getmtime(path) > compiled for path in sources)
+
+    @classmethod
+    def ensure_compiled(cls, csv_path: str, names_path: str = None, force: bool = False) -> bool:
+        """Compile under the exclusive lock unless another process already did; True if compiled here"""
+        index_dir = Path(f"{csv_path}.idx")
+        if not force and not cls.is_stale(csv_path, index_dir, names_path):
+            return False
+        with cls._locked(index_dir, exclusive=True):
+            if not force and not cls.is_stale(csv_path, index_dir, names_path):
+                return False  # Compiled by another worker while we waited
+            cls.compile(csv_path, index_dir, names_path)
+        return True
+
+    @classmethod
+    def compile(cls, csv_path: str, index_dir: Path, names_path: str = None):
+        """Compile the CSV into .npy arrays + locations.json (callers hold the exclusive lock)"""
+        names = cls.load_names(GEO_BUNDLED_NAMES_PATH, names_path)
+        locations = []
+        location_ids = {}
+        # Flat typed columns instead of per-row tuples keep peak memory low on multi-million-row CSVs
+        ranges = {4: (array("Q"), array("Q"), array("I")), 6: (array("Q"), array("Q"), array("I"))}
+        
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                try:
+                    start = ipaddress.ip_address(row[0])
+                    end = ipaddress.ip_address(row[1])
+                except ValueError:
+                    continue  # Header or malformed row
+                country_code = row[3] if len(row) >= 6 else row[2]
+                city = row[5] if len(row) >= 6 else ""
+                location = cls.localize(names, country_code, city)
+                loc_id = location_ids.get(location)
+                if loc_id is None:
+                    loc_id = location_ids[location] = len(locations)
+                    locations.append(location)
+                shift = 0 if start.version == 4 else 64
+                starts, ends, locs = ranges[start.version]
+                starts.append(int(start) >> shift)
+                ends.append(int(end) >> shift)
+                locs.append(loc_id)
+        
+        tmp_dir = index_dir.with_name(f"{index_dir.name}.tmp-{os.getpid()}")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for version, dtype in ((4, np.uint32), (6, np.uint64)):
+            starts, ends, locs = ranges[version]
+            order = np.argsort(np.frombuffer(starts, dtype=np.uint64), kind="stable")
+            for suffix, column, column_dtype in (("start", starts, dtype), ("end", ends, dtype), ("loc", locs, np.uint32)):
+                values = np.frombuffer(column, dtype=np.uint64 if suffix != "loc" else np.uint32)[order]
+                np.save(tmp_dir / f"v{version}_{suffix}.npy", values.astype(column_dtype))
+        with open(tmp_dir / "locations.json", "w", encoding="utf-8") as f:
+            json.dump(locations, f, ensure_ascii=False)
+        
+        if index_dir.exists():
+            shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+        logging.info(f"Geo database compiled: {len(ranges[4][0])} IPv4 / {len(ranges[6][0])} IPv6 ranges, {len(locations)} locations")
+
+    def load(self, csv_path: str, names_path: str = None) -> bool:
+        """Load (compiling first, once across workers, if the CSV is newer than the index)"""
+        index_dir = Path(f"{csv_path}.idx")
+        if not os.path.exists(csv_path) and not index_dir.exists():
+            logging.warning(f"Geo database not found at {csv_path}, falling back to ip-api.com")
+            return False
+        try:
+            self.ensure_compiled(csv_path, names_path)
+            # Shared lock: a recompile cannot swap the directory while the arrays are opened
+            with self._locked(index_dir, exclusive=False):
+                self._arrays = {name: np.load(index_dir / f"{name}.npy", mmap_mode='r') for name in self.ARRAYS}
+                with open(index_dir / "locations.json", encoding="utf-8") as f:
+                    self._locations = [tuple(loc) for loc in json.load(f)]
+            self.loaded = True
+        except Exception as e:
+            logging.error(f"Failed to load geo database {csv_path}: {e}")
+            self.loaded = False
+        return self.loaded
+
+    def lookup(self, addr) -> Optional[dict]:
+        """Look up an ipaddress.IPv4Address/IPv6Address; None if not covered"""
+        self.lookups += 1
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        if addr.version == 4:
+            key, prefix = int(addr), "v4"
+        else:
+            key, prefix = int(addr) >> 64, "v6"
+        starts = self._arrays[f"{prefix}_start"]
+        i = int(np.searchsorted(starts, key, side="right")) - 1
+        if i < 0 or key > int(self._arrays[f"{prefix}_end"][i]):
+            return None
+        self.found += 1
+        country, city = self._locations[int(self._arrays[f"{prefix}_loc"][i])]
+        return {"country": country, "city": city}
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "ipv4_ranges": len(self._arrays.get("v4_start", ())),
+            "ipv6_ranges": len(self._arrays.get("v6_start", ())),
+            "locations": len(self._locations),
+            "lookups": self.lookups,
+            "found": self.found
+        }
+
+geo_db = GeoDatabase()
+# CDN geo headers carry ISO codes and English city names: localized the same way
+geo_names = GeoDatabase.load_names(GEO_BUNDLED_NAMES_PATH, GEO_NAMES_PATH)
+
+# ===================== GEO CACHE =====================
+# Two tiers in front of the network geo fallback:
+#   1. in-process LRU + TTL (bounded by GEO_CACHE_MAX_ENTRIES)
+#   2. a SQLite file on local disk shared by all uvicorn workers
+# so one worker's lookup is reused by the others instead of each worker
+# warming up (and growing) its own dict.
+
+GEO_CACHE_TTL_SECONDS = int(os.environ.get('GEO_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+GEO_CACHE_MAX_ENTRIES = int(os.environ.get('GEO_CACHE_MAX_ENTRIES', '20000'))
+GEO_SHARED_CACHE_PATH = os.environ.get('GEO_SHARED_CACHE_PATH', str(DATA_DIR / 'geo_cache.sqlite3'))
+GEO_SHARED_CACHE_MAX_ROWS = int(os.environ.get('GEO_SHARED_CACHE_MAX_ROWS', '500000'))
+
+class GeoCache:
+    """In-process LRU/TTL tier backed by a shared SQLite tier"""
+    PRUNE_EVERY_WRITES = 1000
+
+    def __init__(self, path: str, ttl_seconds: int, max_entries: int, max_shared_rows: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_shared_rows = max_shared_rows
+        self.local = TTLCache(max_entries, ttl_seconds)
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.shared_errors = 0
+        self._writes = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS geo_cache ("
+                "ip TEXT PRIMARY KEY, country TEXT NOT NULL, city TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _shared_get(self, ip: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT country, city FROM geo_cache WHERE ip = ? AND expires_at > ?", (ip, time.time())
+            ).fetchone()
+        return {"country": row[0], "city": row[1]} if row else None
+
+    def _shared_set(self, ip: str, value: dict):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO geo_cache (ip, country, city, expires_at) VALUES (?, ?, ?, ?)",
+                (ip, value["country"], value["city"], time.time() + self.ttl_seconds)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY_WRITES == 0:
+                conn.execute("DELETE FROM geo_cache WHERE expires_at <= ?", (time.time(),))
+                conn.execute(
+                    "DELETE FROM geo_cache WHERE ip IN ("
+                    "SELECT ip FROM geo_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_shared_rows,)
+                )
+
+    async def get(self, ip: str) -> Optional[dict]:
+        value = self.local.get(ip)
+        if value is not None:
+            return value
+        try:
+            value = await asyncio.to_thread(self._shared_get, ip)
+        except Exception as e:
+            self.shared_errors += 1
+            logging.warning(f"Shared geo cache read failed: {e}")
+            return None
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.local.set(ip, value)
+        return value
+
+    async def set(self, ip: str, value: dict):
+        self.local.set(ip, value)
+        try:
+            await asyncio.to_thread(self._shared_set, ip, value)
+        except Exception as e:
+            self.shared_errors += 1
+            logging.warning(f"Shared geo cache write failed: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> dict:
+        return {
+            "local": self.local.stats(),
+            "shared_path": self.path,
+            "shared_hits": self.shared_hits,
+            "shared_misses": self.shared_misses,
+            "shared_errors": self.shared_errors,
+            "shared_max_rows": self.max_shared_rows
+        }
+
+geo_cache = GeoCache(GEO_SHARED_CACHE_PATH, GEO_CACHE_TTL_SECONDS, GEO_CACHE_MAX_ENTRIES, GEO_SHARED_CACHE_MAX_ROWS)
+
+geo_flight = SingleFlight()
+
+async def _fetch_geo_from_ip_api(ip: str) -> dict:
+    """Query ip-api.com (free, no key needed) and cache successful results"""
+    result = {"country": GEO_UNKNOWN, "city": GEO_UNKNOWN}
     try:
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            response = await client.get(f"http://ip-api.com/json/{ip}?fields=status,country,city&lang=ru")
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("status") == "success":
-                    result = {
-                        "country": data.get("country", "Неизвестно"),
-                        "city": data.get("city", "Неизвестно")
-                    }
-                    # Cache the result
-                    _geo_cache[ip] = result
+        client = http_clients.get("geo")
+        response = await client.get(f"http://ip-api.com/json/{ip}?fields=status,country,city&lang=ru")
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("status") == "success":
+                result = {
+                    "country": data.get("country", "Неизвестно"),
+                    "city": data.get("city", "Неизвестно")
+                }
+                # Cache the result
+                await geo_cache.set(ip, result)
     except Exception as e:
         logging.warning(f"Geo lookup failed for IP {ip}: {e}")
     
     return result
 
+async def get_geo_from_ip(ip: str) -> dict:
+    """Get country and city from IP address using the local geo database,
+    or ip-api.com when no database is installed"""
+    # Default values
+    result = {"country": GEO_UNKNOWN, "city": GEO_UNKNOWN}
+    
+    # Skip local/private/reserved IPs
+    try:
+        addr = ipaddress.ip_address((ip or "").strip())
+    except ValueError:
+        return result
+    if not addr.is_global:
+        return result
+    
+    if geo_db.loaded:
+        return geo_db.lookup(addr) or result
+    
+    # Return cached result if exists
+    cached = await geo_cache.get(ip)
+    if cached is not None:
+        return cached
+    
+    # Concurrent misses for the same IP (e.g. carrier NAT) share one request
+    return await geo_flight.do(ip, lambda: _fetch_geo_from_ip_api(ip))
+
 def get_client_ip(request: Request) -> str:
     """Get the real client IP from request, handling proxies"""
     # Check X-Forwarded-For header (set by proxies/load balancers)
@@ -530,6 +1063,133 @@ def decode_token(token: str) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# ===================== TIMESTAMPS =====================
+# Events, audit logs and system metrics store `timestamp` (notifications:
+# `created_at`) as a BSON date (millisecond precision); the API keeps
+# returning the same ISO strings as before. Documents written before the
+# migration still hold ISO strings, so range filters match both forms until
+# `migrate-timestamps` has finished.
+
+# Calendar days of analytics rollups/timelines are in this timezone
+ANALYTICS_TIMEZONE = os.environ.get('ANALYTICS_TIMEZONE', 'UTC')
+ANALYTICS_TZ = ZoneInfo(ANALYTICS_TIMEZONE)
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def utc_now() -> datetime:
+    """Current UTC time truncated to BSON date precision, so stored == returned"""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def as_datetime(value) -> Optional[datetime]:
+    """BSON date or legacy ISO string -> aware UTC datetime"""
+    if value is None or isinstance(value, datetime):
+        return value if value is None or value.tzinfo else value.replace(tzinfo=timezone.utc)
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def epoch_ms(ts: datetime) -> int:
+    """Exact milliseconds since the epoch (float timestamp() * 1000 can be off by one)"""
+    return (as_datetime(ts) - UNIX_EPOCH) // timedelta(milliseconds=1)
+
+def format_timestamp(value):
+    """API representation: the ISO string the field always had (always with microseconds)"""
+    if isinstance(value, datetime):
+        return as_datetime(value).astimezone(timezone.utc).isoformat(timespec="microseconds")
+    return value
+
+def serialize_timestamps(doc: dict, fields=("timestamp",)) -> dict:
+    for f in fields:
+        if f in doc:
+            doc[f] = format_timestamp(doc[f])
+    return doc
+
+def timestamp_range(gte: Optional[datetime] = None, lt: Optional[datetime] = None, field: str = "timestamp") -> dict:
+    """Filter on a timestamp range matching both BSON dates and legacy ISO strings"""
+    date_cond, str_cond = {}, {}
+    if gte is not None:
+        date_cond["$gte"], str_cond["$gte"] = gte, gte.isoformat(timespec="microseconds")
+    if lt is not None:
+        date_cond["$lt"], str_cond["$lt"] = lt, lt.isoformat(timespec="microseconds")
+    return {"$or": [{field: date_cond}, {field: str_cond}]}
+
+def analytics_day(ts: datetime) -> str:
+    return ts.astimezone(ANALYTICS_TZ).date().isoformat()
+
+class TimestampMigration:
+    """
+    Converts legacy ISO string timestamps to BSON dates in chunks, in _id order.
+    Progress is checkpointed in `migrations`, so an interrupted run resumes
+    where it stopped; converting is idempotent (only string values are touched).
+    """
+    # collection -> date field
+    COLLECTIONS = {
+        "clicks": "timestamp",
+        "views": "timestamp",
+        "shares": "timestamp",
+        "audit_logs": "timestamp",
+        "system_metrics": "timestamp",
+        "notifications": "created_at",
+    }
+
+    def __init__(self, batch_size: int = 1000, pause_seconds: float = 0.05):
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+
+    async def migrate_collection(self, collection: str) -> int:
+        checkpoint_id = f"timestamps:{collection}"
+        checkpoint = await db.migrations.find_one({"_id": checkpoint_id}) or {}
+        if checkpoint.get("done"):
+            return 0
+        last_id = checkpoint.get("last_id")
+        converted = 0
+        field = self.COLLECTIONS[collection]
+        while True:
+            query = {field: {"$type": "string"}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = await db[collection].find(query, {"_id": 1, field: 1}).sort("_id", 1).to_list(self.batch_size)
+            if not docs:
+                break
+            ops = []
+            for doc in docs:
+                try:
+                    value = as_datetime(doc[field])
+                except ValueError:
+                    logging.warning(f"Unparseable {field} in {collection} {doc['_id']}: {doc[field]!r}")
+                    continue
+                # Guarded by the old value: a concurrent writer always wins
+                ops.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: value}}))
+            chunk_converted = 0
+            if ops:
+                result = await db[collection].bulk_write(ops, ordered=False)
+                chunk_converted = result.modified_count
+            converted += chunk_converted
+            last_id = docs[-1]["_id"]
+            await db.migrations.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"last_id": last_id, "updated_at": utc_now()}, "$inc": {"converted": chunk_converted}},
+                upsert=True
+            )
+            await asyncio.sleep(self.pause_seconds)
+        await db.migrations.update_one(
+            {"_id": checkpoint_id}, {"$set": {"done": True, "updated_at": utc_now()}}, upsert=True
+        )
+        logging.info(f"Timestamp migration {collection}: {converted} documents converted")
+        return converted
+
+    async def reset(self):
+        await db.migrations.delete_many({"_id": {"$in": [f"timestamps:{c}" for c in self.COLLECTIONS]}})
+
+    async def run(self) -> dict:
+        return {collection: await self.migrate_collection(collection) for collection in self.COLLECTIONS}
+
+    async def pending(self) -> dict:
+        """Documents still holding string timestamps, per collection"""
+        return {
+            collection: await db[collection].count_documents({field: {"$type": "string"}})
+            for collection, field in self.COLLECTIONS.items()
+        }
+
 # ===================== RBAC HELPERS =====================
 
 def has_role_permission(user_role: str, required_role: str) -> bool:
@@ -598,6 +1258,12 @@ async def get_current_user(authorization: str = Header(None)):
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = authorization.split(" ")[1]
     payload = decode_token(token)
+    # Scoped tokens (e.g. live stream tokens) are only valid for their own endpoint
+    if payload.get("scope"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return await get_token_user(payload)
+
+async def get_token_user(payload: dict) -> dict:
     user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
@@ -659,6 +1325,2394 @@ def generate_blurred_background(input_path: str, output_path: str):
     except Exception as e:
         logging.error(f"Error generating blurred background: {e}")
 
+# ===================== CLUSTER EVENTS =====================
+# Uvicorn runs several worker processes, each with its own in-memory caches.
+# Workers notify each other through a small capped collection that every
+# worker tails (e.g. to evict a public page after an edit).
+
+WORKER_ID = uuid.uuid4().hex
+CLUSTER_EVENTS_CAPPED_BYTES = int(os.environ.get('CLUSTER_EVENTS_CAPPED_BYTES', str(4 * 1024 * 1024)))
+
+_cluster_handlers = {}
+_background_tasks = []
+
+def on_cluster_event(channel: str):
+    """Register a handler for cluster events published by other workers"""
+    def decorator(func):
+        _cluster_handlers[channel] = func
+        return func
+    return decorator
+
+async def publish_cluster_event(channel: str, payload: dict):
+    """Broadcast an event to the other workers (best effort)"""
+    try:
+        await db.cluster_events.insert_one({
+            "channel": channel,
+            "payload": payload,
+            "origin": WORKER_ID,
+            "created_at": datetime.now(timezone.utc)
+        })
+    except Exception as e:
+        logging.warning(f"Cluster event publish failed ({channel}): {e}")
+
+async def ensure_cluster_events_collection():
+    """Create the capped collection used for cross-worker events"""
+    existing = await db.list_collection_names(filter={"name": "cluster_events"})
+    if not existing:
+        try:
+            await db.create_collection("cluster_events", capped=True, size=CLUSTER_EVENTS_CAPPED_BYTES)
+        except CollectionInvalid:
+            pass  # Created concurrently by another worker
+    # A tailable cursor on an empty capped collection dies immediately
+    if await db.cluster_events.estimated_document_count() == 0:
+        await publish_cluster_event("init", {})
+
+async def cluster_events_listener():
+    """Tail cluster_events and dispatch events from other workers to their handlers"""
+    since = datetime.now(timezone.utc)
+    seen_ids = deque(maxlen=1000)
+    while True:
+        try:
+            cursor = db.cluster_events.find(
+                {"created_at": {"$gte": since}},
+                cursor_type=CursorType.TAILABLE_AWAIT
+            )
+            while cursor.alive:
+                async for doc in cursor:
+                    since = doc.get("created_at", since)
+                    if doc["_id"] in seen_ids:
+                        continue
+                    seen_ids.append(doc["_id"])
+                    if doc.get("origin") == WORKER_ID:
+                        continue
+                    handler = _cluster_handlers.get(doc.get("channel"))
+                    if handler:
+                        try:
+                            handler(doc.get("payload") or {})
+                        except Exception as e:
+                            logging.error(f"Cluster event handler error ({doc.get('channel')}): {e}")
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Cluster events listener error: {e}")
+            await asyncio.sleep(5)
+
+def start_background_task(coro):
+    """Run a coroutine for the lifetime of the app; cancelled on shutdown"""
+    task = asyncio.create_task(coro)
+    _background_tasks.append(task)
+    return task
+
+async def stop_background_tasks():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+# ===================== LEADER LEASES =====================
+# Periodic cluster-wide jobs run on exactly one worker: the holder of a lease
+# document in leader_leases. The holder renews it on every run; if the worker
+# dies, the lease expires and another worker takes over.
+
+class LeaderLease:
+    def __init__(self, name: str, ttl_seconds: float):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.is_leader = False
+
+    async def acquire(self) -> bool:
+        """Take or renew the lease; False while another worker holds an unexpired one"""
+        now = utc_now()
+        try:
+            await db.leader_leases.update_one(
+                {"_id": self.name, "$or": [{"holder": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": WORKER_ID, "expires_at": now + timedelta(seconds=self.ttl_seconds)}},
+                upsert=True
+            )
+            self.is_leader = True
+        except DuplicateKeyError:
+            # The document exists and is held by someone else
+            self.is_leader = False
+        return self.is_leader
+
+    async def release(self):
+        self.is_leader = False
+        await db.leader_leases.delete_one({"_id": self.name, "holder": WORKER_ID})
+
+# ===================== PUBLIC PAGE CACHE =====================
+# Assembled /api/artist/{slug} payloads (page + active links + owner flags).
+# Every write that changes the payload must call invalidate_public_page_cache().
+
+PUBLIC_PAGE_CACHE_TTL_SECONDS = int(os.environ.get('PUBLIC_PAGE_CACHE_TTL_SECONDS', '300'))
+PUBLIC_PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PUBLIC_PAGE_CACHE_MAX_ENTRIES', '2000'))
+
+_public_page_cache = TTLCache(PUBLIC_PAGE_CACHE_MAX_ENTRIES, PUBLIC_PAGE_CACHE_TTL_SECONDS)
+
+def _evict_public_pages(scope: str, key: Optional[str] = None) -> int:
+    """Evict cached public pages by page id, owner user id, or everything"""
+    if scope == "page":
+        return _public_page_cache.pop_where(lambda slug, payload: payload.get("id") == key)
+    if scope == "user":
+        return _public_page_cache.pop_where(lambda slug, payload: payload.get("user_id") == key)
+    if scope == "all":
+        count = len(_public_page_cache)
+        _public_page_cache.clear()
+        return count
+    return 0
+
+@on_cluster_event("public_page_cache")
+def _on_public_page_cache_event(payload: dict):
+    _evict_public_pages(payload.get("scope"), payload.get("key"))
+
+async def invalidate_public_page_cache(scope: str, key: Optional[str] = None):
+    """
+    Invalidate cached public pages in this worker and all other workers.
+    scope: "page" (page id), "user" (owner id) or "all" (e.g. plan config changes)
+    """
+    _evict_public_pages(scope, key)
+    await publish_cluster_event("public_page_cache", {"scope": scope, "key": key})
+
+async def build_public_page_payload(slug: str) -> Optional[dict]:
+    """Assemble the public page payload: page, active links and owner flags"""
+    page = await db.pages.find_one({"slug": slug, "status": "active"}, {"_id": 0})
+    if not page:
+        return None
+    
+    links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
+    page["links"] = links
+    
+    # Get user info (verification, site navigation, plan features, and contact info)
+    user = await db.users.find_one({"id": page["user_id"]}, {"_id": 0, "verified": 1, "show_verification_badge": 1, "site_navigation_enabled": 1, "plan": 1, "contact_email": 1, "social_links": 1})
+    if user:
+        page["user_verified"] = user.get("verified", False) and user.get("show_verification_badge", True)
+        page["site_navigation_enabled"] = user.get("site_navigation_enabled", False)
+        
+        # Add contact info for public page
+        page["contact_email"] = user.get("contact_email", "")
+        page["social_links"] = user.get("social_links", {})
+        
+        # Get plan config for branding removal
+        plan_config = await get_plan_config(user.get("plan", "free"))
+        page["can_remove_branding"] = plan_config.get("can_remove_branding", False)
+    else:
+        page["user_verified"] = False
+        page["site_navigation_enabled"] = False
+        page["can_remove_branding"] = False
+        page["contact_email"] = ""
+        page["social_links"] = {}
+    
+    return page
+
+# ===================== COUNTER BUFFER =====================
+# Write-behind buffer for hot $inc counters (pages.views, shares, qr_scans...).
+# Increments are summed in memory per document and flushed periodically as a
+# single unordered bulk_write per collection, so a viral page costs one write
+# per flush interval instead of one write per hit.
+
+COUNTER_FLUSH_INTERVAL_SECONDS = float(os.environ.get('COUNTER_FLUSH_INTERVAL_SECONDS', '5'))
+COUNTER_BUFFER_MAX_KEYS = int(os.environ.get('COUNTER_BUFFER_MAX_KEYS', '5000'))
+
+class CounterBuffer:
+    """
+    Accumulates $inc increments per (collection, document id).
+    Flushes every `flush_interval` seconds, or sooner once `max_keys`
+    distinct documents are pending.
+    """
+    def __init__(self, flush_interval: float, max_keys: int):
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.failed_flushes = 0
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        # Called synchronously with every new increment (not with retried ones)
+        self.listeners = []
+
+    def incr(self, collection: str, doc_id: str, field: str, amount: int = 1):
+        self._add(collection, doc_id, field, amount)
+        for listener in self.listeners:
+            listener(collection, doc_id, field, amount)
+
+    def _add(self, collection: str, doc_id: str, field: str, amount: int):
+        fields = self._pending.setdefault((collection, doc_id), {})
+        fields[field] = fields.get(field, 0) + amount
+        if len(self._pending) >= self.max_keys:
+            self._wakeup.set()
+
+    def pending_increments(self) -> int:
+        return sum(sum(fields.values()) for fields in self._pending.values())
+
+    def _requeue(self, collection: str, doc_id: str, fields: dict):
+        for name, amount in fields.items():
+            self._add(collection, doc_id, name, amount)
+
+    async def flush(self) -> int:
+        """Write all pending increments; failed ones are kept for the next flush"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            
+            by_collection = {}
+            for (collection, doc_id), fields in pending.items():
+                by_collection.setdefault(collection, []).append((doc_id, fields))
+            
+            written = 0
+            for collection, items in by_collection.items():
+                ops = [UpdateOne({"id": doc_id}, {"$inc": fields}) for doc_id, fields in items]
+                try:
+                    await db[collection].bulk_write(ops, ordered=False)
+                    written += len(ops)
+                except BulkWriteError as e:
+                    failed = {err["index"] for err in e.details.get("writeErrors", [])}
+                    for index in failed:
+                        self._requeue(collection, *items[index])
+                    written += len(ops) - len(failed)
+                    self.failed_flushes += 1
+                    logging.error(f"Counter flush partially failed for {collection}: {len(failed)} ops")
+                except Exception as e:
+                    for doc_id, fields in items:
+                        self._requeue(collection, doc_id, fields)
+                    self.failed_flushes += 1
+                    logging.error(f"Counter flush failed for {collection}: {e}")
+            
+            self.flushes += 1
+            self.flushed_ops += written
+            return written
+
+    async def run(self):
+        """Background flush loop"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Shielded: cancelling the loop on shutdown must not abandon a swapped-out
+            # batch mid-write; the final flush() waits for it on the lock
+            self._flush_task = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flush_task)
+
+    def stats(self) -> dict:
+        return {
+            "pending_documents": len(self._pending),
+            "pending_increments": self.pending_increments(),
+            "max_keys": self.max_keys,
+            "flush_interval_seconds": self.flush_interval,
+            "flushes": self.flushes,
+            "flushed_ops": self.flushed_ops,
+            "failed_flushes": self.failed_flushes
+        }
+
+counter_buffer = CounterBuffer(COUNTER_FLUSH_INTERVAL_SECONDS, COUNTER_BUFFER_MAX_KEYS)
+
+# ===================== EVENT INGESTION =====================
+# Tracking handlers never wait on geo resolution. Events are stored with a
+# compact salted IP hash plus whatever geo the CDN headers provide; events
+# without CDN geo are flagged geo_pending and their raw IP is handed (in
+# memory only) to the background GeoEnrichmentWorker, which resolves IPs in
+# batches and backfills country/city with bulk updates.
+
+IP_HASH_SALT = os.environ.get('IP_HASH_SALT') or hashlib.sha256(f"ip-hash:{JWT_SECRET}".encode()).hexdigest()
+
+GEO_ENRICH_QUEUE_MAX_SIZE = int(os.environ.get('GEO_ENRICH_QUEUE_MAX_SIZE', '50000'))
+GEO_ENRICH_BATCH_SIZE = int(os.environ.get('GEO_ENRICH_BATCH_SIZE', '500'))
+GEO_ENRICH_BATCH_WAIT_SECONDS = float(os.environ.get('GEO_ENRICH_BATCH_WAIT_SECONDS', '2'))
+# Pending events older than this lost their in-memory IP (restart, overflow) and are finalized as unknown
+GEO_PENDING_MAX_AGE_MINUTES = int(os.environ.get('GEO_PENDING_MAX_AGE_MINUTES', '30'))
+
+def hash_client_ip(ip: str) -> str:
+    """Compact salted hash of the client IP (the raw IP is never stored)"""
+    if not ip:
+        return ""
+    return hmac.new(IP_HASH_SALT.encode(), ip.encode(), hashlib.sha256).hexdigest()[:16]
+
+def get_tracking_context(request: Optional[Request]) -> dict:
+    """Client IP, its hash and CDN geo headers (Cloudflare) for a tracking request"""
+    if not request:
+        return {"client_ip": "", "ip_hash": "", "country": GEO_UNKNOWN, "city": GEO_UNKNOWN, "geo_pending": False}
+    client_ip = get_client_ip(request)
+    country = request.headers.get("CF-IPCountry", "")
+    city = request.headers.get("CF-IPCity", "")
+    geo_pending = not country or country in ("Unknown", "XX")
+    if not geo_pending:
+        country, city = GeoDatabase.localize(geo_names, country, city)
+    return {
+        "client_ip": client_ip,
+        "ip_hash": hash_client_ip(client_ip),
+        "country": GEO_UNKNOWN if geo_pending else country,
+        "city": GEO_UNKNOWN if geo_pending else city,
+        "geo_pending": geo_pending
+    }
+
+class BatchingQueue(ABC):
+    """
+    Bounded asyncio queue drained in batches by one background writer.
+    When the queue is full new items are dropped and counted: backpressure
+    must never slow down the request that produced the item.
+    Subclasses implement _write(batch).
+    """
+    def __init__(self, max_size: int, batch_size: int, batch_wait: float):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._batch = []
+        self._inflight = None
+
+    def submit(self, item) -> bool:
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    async def _collect_batch(self):
+        """Wait for the first item, then gather more for up to batch_wait seconds"""
+        self._batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.batch_wait
+        while len(self._batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        batch, self._batch = self._batch, []
+        return batch
+
+    @abstractmethod
+    async def _write(self, batch: list):
+        """Persist one batch; must not raise (count failures instead)"""
+
+    async def run(self):
+        """Background writer loop"""
+        while True:
+            batch = await self._collect_batch()
+            self._inflight = asyncio.ensure_future(self._write(batch))
+            # Shielded so shutdown waits for the batch in drain() instead of losing it
+            await asyncio.shield(self._inflight)
+
+    async def drain(self):
+        """Write everything still queued; called on shutdown after run() is cancelled"""
+        if self._inflight and not self._inflight.done():
+            await asyncio.gather(self._inflight, return_exceptions=True)
+        batch, self._batch = self._batch, []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        for i in range(0, len(batch), self.batch_size):
+            await self._write(batch[i:i + self.batch_size])
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "max_size": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed
+        }
+
+class GeoEnrichmentWorker(BatchingQueue):
+    """
+    Resolves geo for geo_pending events. Items: TrackingEvent.
+    Geo-dependent aggregates (finalizers) see an event once, after its geo is final.
+    """
+    SWEEP_INTERVAL_SECONDS = 300
+    SWEEP_BATCH_SIZE = 1000
+    COLLECTIONS = ("clicks", "views", "shares")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.swept = 0
+        # async callables taking a list of finalized events
+        self.finalizers = []
+
+    async def _finalize(self, events: list):
+        for finalizer in self.finalizers:
+            try:
+                await finalizer(events)
+            except Exception as e:
+                logging.error(f"Geo finalizer failed ({len(events)} events): {e}")
+
+    async def _write(self, batch: list):
+        ips = list({event.client_ip for event in batch})
+        geo_by_ip = dict(zip(ips, await asyncio.gather(*(get_geo_from_ip(ip) for ip in ips))))
+        
+        events_by_collection = {}
+        for event in batch:
+            geo = geo_by_ip[event.client_ip]
+            event.country, event.city = geo["country"], geo["city"]
+            events_by_collection.setdefault(event.collection, []).append(event)
+        for collection, events in events_by_collection.items():
+            ops = [
+                UpdateOne(
+                    {"id": e.id},
+                    {"$set": {"country": e.country, "city": e.city}, "$unset": {"geo_pending": ""}}
+                )
+                for e in events
+            ]
+            try:
+                await db[collection].bulk_write(ops, ordered=False)
+                self.written += len(ops)
+            except Exception as e:
+                self.failed += len(ops)
+                logging.error(f"Geo enrichment write failed for {collection} ({len(ops)} events): {e}")
+                continue
+            for e in events:
+                e.geo_pending = False
+            await self._finalize(events)
+
+    async def run_sweeps(self):
+        """Background sweep loop, independent of new pending events arriving"""
+        while True:
+            await self.sweep()
+            await asyncio.sleep(self.SWEEP_INTERVAL_SECONDS)
+
+    async def sweep(self):
+        """Finalize pending events whose IP is no longer in memory"""
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=GEO_PENDING_MAX_AGE_MINUTES)
+        for collection in self.COLLECTIONS:
+            try:
+                stale = await db[collection].find(
+                    {"geo_pending": True, **timestamp_range(lt=cutoff)}, {"_id": 0}
+                ).to_list(self.SWEEP_BATCH_SIZE)
+                finalized = []
+                for doc in stale:
+                    # Per event so another worker's sweep never finalizes the same event twice
+                    result = await db[collection].update_one(
+                        {"id": doc["id"], "geo_pending": True}, {"$unset": {"geo_pending": ""}}
+                    )
+                    if result.modified_count:
+                        finalized.append(TrackingEvent.from_document(collection, doc))
+                self.swept += len(finalized)
+                if finalized:
+                    await self._finalize(finalized)
+            except Exception as e:
+                logging.warning(f"Geo pending sweep failed for {collection}: {e}")
+
+    def stats(self) -> dict:
+        return {**super().stats(), "swept": self.swept}
+
+geo_enrichment = GeoEnrichmentWorker(GEO_ENRICH_QUEUE_MAX_SIZE, GEO_ENRICH_BATCH_SIZE, GEO_ENRICH_BATCH_WAIT_SECONDS)
+
+# ===================== DAILY ROLLUPS =====================
+# analytics_daily: one document per (page_id, day, country, city, link_id, share_type)
+# (day is the calendar day in ANALYTICS_TIMEZONE)
+# with clicks / views / shares counters, kept current with $inc upserts on ingest.
+# Analytics endpoints read these instead of scanning raw events, so their cost
+# grows with the number of days, not the number of events.
+# Events with pending geo are counted once their geo is final (geo enrichment finalizer).
+
+ROLLUP_COUNTERS = {"click": "clicks", "view": "views", "share": "shares", "qr": "shares"}
+
+# Raw event collection -> rollup counter
+EVENT_SOURCE_COLLECTIONS = {"clicks": "clicks", "views": "views", "shares": "shares"}
+
+class DailyRollups:
+    BACKFILL_CHUNK_DAYS = 7
+    BACKFILL_LIVE_MARGIN = timedelta(minutes=10)
+
+    def __init__(self, collection: str = "analytics_daily"):
+        self.collection = collection
+        self.recorded = 0
+        self.upserts = 0
+
+    @property
+    def coll(self):
+        return db[self.collection]
+
+    @staticmethod
+    def bucket(page_id, day, country, city, link_id, share_type) -> dict:
+        return {
+            "page_id": page_id,
+            "day": day,
+            "country": country or GEO_UNKNOWN,
+            "city": city or GEO_UNKNOWN,
+            "link_id": link_id,
+            "share_type": share_type
+        }
+
+    @classmethod
+    def dimensions(cls, event) -> dict:
+        return cls.bucket(
+            event.page_id,
+            analytics_day(event.timestamp),
+            event.country,
+            event.city,
+            event.link_id if event.kind == "click" else None,
+            "qr" if event.kind == "qr" else (event.share_type if event.kind == "share" else None)
+        )
+
+    @staticmethod
+    def key(dims: dict) -> str:
+        # Deterministic _id: concurrent upserts of the same bucket hit the _id index
+        return "|".join(dims[k] or "" for k in ("page_id", "day", "country", "city", "link_id", "share_type"))
+
+    def _merge(self, events: list) -> dict:
+        """Pre-aggregate a batch in memory: one $inc per bucket"""
+        buckets = {}
+        for event in events:
+            dims = self.dimensions(event)
+            key = self.key(dims)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = (dims, {})
+            counter = ROLLUP_COUNTERS[event.kind]
+            bucket[1][counter] = bucket[1].get(counter, 0) + 1
+        return buckets
+
+    async def _apply(self, buckets: dict):
+        if not buckets:
+            return
+        ops = [
+            UpdateOne({"_id": key}, {"$inc": counters, "$setOnInsert": dims}, upsert=True)
+            for key, (dims, counters) in buckets.items()
+        ]
+        await self.coll.bulk_write(ops, ordered=False)
+        self.upserts += len(ops)
+
+    async def record(self, events: list):
+        """Count finalized events (geo known)"""
+        await self._apply(self._merge(events))
+        self.recorded += len(events)
+
+    async def delete_pages(self, page_ids: list):
+        await self.coll.delete_many({"page_id": {"$in": page_ids}})
+
+    async def backfill(self, since: Optional[str] = None, until: Optional[str] = None) -> dict:
+        """
+        Rebuild rollups from raw events for whole days in [since, until), in
+        ANALYTICS_TIMEZONE. Days are recounted server-side ($dateTrunc) a chunk at
+        a time; events still geo_pending are skipped because the enrichment
+        finalizer counts them.
+        Buckets are replaced with the recounted totals rather than deleted and
+        re-incremented, and days that may still receive live increments (up to
+        BACKFILL_LIVE_MARGIN ago) are never touched, so running it next to live
+        ingest loses nothing. Defaults: from the oldest event up to yesterday.
+        """
+        pending = await TimestampMigration().pending()
+        if any(pending[c] for c in EVENT_SOURCE_COLLECTIONS):
+            raise RuntimeError(f"String timestamps left, run migrate-timestamps first: {pending}")
+        if not since:
+            oldest = []
+            for collection in EVENT_SOURCE_COLLECTIONS:
+                doc = await db[collection].find_one({}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", 1)])
+                if doc and doc.get("timestamp"):
+                    oldest.append(analytics_day(as_datetime(doc["timestamp"])))
+            if not oldest:
+                return {"days": 0, "events": 0, "buckets": 0}
+            since = min(oldest)
+        live_day = analytics_day(datetime.now(timezone.utc) - self.BACKFILL_LIVE_MARGIN)
+        if not until or until[:10] > live_day:
+            until = live_day
+        
+        # Raw events of archived days are gone from Mongo: keep their rollups as they are
+        archived = await event_archive.watermark_day()
+        if archived and since[:10] < archived:
+            logging.info(f"Rollup backfill skips archived days before {archived}")
+            since = archived
+        
+        day = date.fromisoformat(since[:10])
+        end = date.fromisoformat(until[:10])
+        backfill_id = uuid.uuid4().hex
+        days = events = buckets_written = 0
+        while day < end:
+            chunk_end = min(day + timedelta(days=self.BACKFILL_CHUNK_DAYS), end)
+            chunk_days = [(day + timedelta(days=i)).isoformat() for i in range((chunk_end - day).days)]
+            start_ts = datetime(day.year, day.month, day.day, tzinfo=ANALYTICS_TZ)
+            end_ts = datetime(chunk_end.year, chunk_end.month, chunk_end.day, tzinfo=ANALYTICS_TZ)
+            buckets = {}
+            for collection, counter in EVENT_SOURCE_COLLECTIONS.items():
+                cursor = db[collection].aggregate([
+                    {"$match": {"timestamp": {"$gte": start_ts, "$lt": end_ts}, "geo_pending": {"$ne": True}, "bot": {"$ne": True}}},
+                    {"$group": {
+                        "_id": {
+                            "page_id": "$page_id",
+                            "day": {"$dateToString": {
+                                "format": "%Y-%m-%d",
+                                "date": {"$dateTrunc": {"date": "$timestamp", "unit": "day", "timezone": ANALYTICS_TIMEZONE}},
+                                "timezone": ANALYTICS_TIMEZONE
+                            }},
+                            "country": "$country",
+                            "city": "$city",
+                            "link_id": "$link_id",
+                            "type": "$type"
+                        },
+                        "count": {"$sum": 1}
+                    }}
+                ], allowDiskUse=True)
+                async for doc in cursor:
+                    group = doc["_id"]
+                    dims = self.bucket(
+                        group["page_id"], group["day"], group.get("country"), group.get("city"),
+                        group.get("link_id") if collection == "clicks" else None,
+                        (group.get("type") or "link") if collection == "shares" else None
+                    )
+                    bucket = buckets.setdefault(self.key(dims), (dims, {}))
+                    bucket[1][counter] = bucket[1].get(counter, 0) + doc["count"]
+                    events += doc["count"]
+            ops = [
+                ReplaceOne({"_id": key}, {**dims, **counters, "backfill": backfill_id}, upsert=True)
+                for key, (dims, counters) in buckets.items()
+            ]
+            for i in range(0, len(ops), 1000):
+                await self.coll.bulk_write(ops[i:i + 1000], ordered=False)
+            self.upserts += len(ops)
+            # Buckets without events left in the chunk (deleted pages, bot-flagged events)
+            await self.coll.delete_many({"day": {"$in": chunk_days}, "backfill": {"$ne": backfill_id}})
+            buckets_written += len(buckets)
+            days += len(chunk_days)
+            logging.info(f"Rollup backfill {chunk_days[0]}..{chunk_days[-1]}: {len(buckets)} buckets")
+            day = chunk_end
+        return {"days": days, "events": events, "buckets": buckets_written}
+
+    @staticmethod
+    def _top_facet(dimension: str, limit: int) -> list:
+        return [
+            {"$match": {"clicks": {"$gt": 0}}},
+            {"$group": {"_id": f"${dimension}", "clicks": {"$sum": "$clicks"}}},
+            {"$sort": {"clicks": -1}},
+            {"$limit": limit}
+        ]
+
+    async def dashboard(self, match: dict, geo: bool = True, timeline_days: Optional[int] = 30,
+                        shares_by_type: bool = True, limit: int = 10) -> dict:
+        """
+        Everything an analytics dashboard reads from the rollups in one $facet pass:
+        top countries/cities by clicks (geo), daily clicks/shares timeline and shares by type.
+        """
+        facets = {}
+        if timeline_days is not None:
+            since = analytics_since_day(timeline_days)
+            facets["timeline"] = [
+                {"$match": {"day": {"$gte": since}}},
+                {"$group": {"_id": "$day", "clicks": {"$sum": "$clicks"}, "shares": {"$sum": "$shares"}}},
+                {"$match": {"clicks": {"$gt": 0}}},
+                {"$sort": {"_id": 1}}
+            ]
+        if shares_by_type:
+            facets["shares_by_type"] = [
+                {"$match": {"shares": {"$gt": 0}}},
+                {"$group": {"_id": "$share_type", "shares": {"$sum": "$shares"}}}
+            ]
+        if geo:
+            facets["by_country"] = self._top_facet("country", limit)
+            facets["by_city"] = self._top_facet("city", limit)
+        
+        if not facets:
+            return {"by_country": [], "by_city": [], "timeline": [], "shares_by_type": {}}
+        result = await self.coll.aggregate([{"$match": match}, {"$facet": facets}]).to_list(1)
+        result = result[0] if result else {}
+        
+        by_type = {}
+        for doc in result.get("shares_by_type", []):
+            share_type = doc["_id"] or "link"
+            by_type[share_type] = by_type.get(share_type, 0) + doc["shares"]
+        return {
+            "by_country": [{"country": d["_id"] or "Неизвестно", "clicks": d["clicks"]} for d in result.get("by_country", [])],
+            "by_city": [{"city": d["_id"] or "Неизвестно", "clicks": d["clicks"]} for d in result.get("by_city", [])],
+            "timeline": [{"date": d["_id"], "clicks": d["clicks"], "shares": d["shares"]} for d in result.get("timeline", [])],
+            "shares_by_type": by_type
+        }
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded, "upserts": self.upserts}
+
+rollups = DailyRollups()
+geo_enrichment.finalizers.append(rollups.record)
+
+# ===================== TIMELINES =====================
+# Views/clicks/shares/QR series at hour, day, week or month granularity in
+# any timezone. analytics_hourly keeps one document per (page_id, UTC hour),
+# counted on ingest; day/week/month series in ANALYTICS_TIMEZONE are read
+# from the daily rollups instead, everything else from the hourly buckets
+# (zones with a non-whole-hour offset are bucketed by the hour's local start).
+# Series are dense (empty buckets are zeros) and cached per scope, range,
+# granularity and timezone.
+
+TIMELINE_GRANULARITIES = ("hour", "day", "week", "month")
+TIMELINE_MAX_POINTS = int(os.environ.get('TIMELINE_MAX_POINTS', '1000'))
+TIMELINE_CACHE_TTL_SECONDS = float(os.environ.get('TIMELINE_CACHE_TTL_SECONDS', '30'))
+TIMELINE_DEFAULT_SPAN = {
+    "hour": timedelta(hours=48),
+    "day": timedelta(days=30),
+    "week": timedelta(weeks=26),
+    "month": timedelta(days=365),
+}
+TIMELINE_SERIES = ("views", "clicks", "shares", "qr")
+
+class HourlyRollups:
+    BACKFILL_CHUNK_DAYS = 7
+    BACKFILL_LIVE_MARGIN = timedelta(minutes=10)
+    COUNTERS = {"view": "views", "click": "clicks", "share": "shares", "qr": "qr"}
+
+    def __init__(self, collection: str = "analytics_hourly"):
+        self.collection = collection
+        self.recorded = 0
+        self.upserts = 0
+
+    @property
+    def coll(self):
+        return db[self.collection]
+
+    @staticmethod
+    def hour(ts: datetime) -> datetime:
+        return as_datetime(ts).astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    async def _apply(self, buckets: dict):
+        if not buckets:
+            return
+        ops = [
+            UpdateOne(
+                {"_id": f"{page_id}|{hour:%Y-%m-%dT%H}"},
+                {"$inc": counters, "$setOnInsert": {"page_id": page_id, "hour": hour}},
+                upsert=True
+            )
+            for (page_id, hour), counters in buckets.items()
+        ]
+        await self.coll.bulk_write(ops, ordered=False)
+        self.upserts += len(ops)
+
+    async def record(self, events: list):
+        """No geo dimensions here, so events are counted right away (pending geo included)"""
+        buckets = {}
+        for e in events:
+            counters = buckets.setdefault((e.page_id, self.hour(e.timestamp)), {})
+            counter = self.COUNTERS[e.kind]
+            counters[counter] = counters.get(counter, 0) + 1
+        await self._apply(buckets)
+        self.recorded += len(events)
+
+    async def delete_pages(self, page_ids: list):
+        await self.coll.delete_many({"page_id": {"$in": page_ids}})
+
+    async def backfill(self, since: Optional[str] = None, until: Optional[str] = None) -> dict:
+        """
+        Recount hours of the days [since, until) (ANALYTICS_TIMEZONE, like the
+        daily backfill) from raw events, a chunk of days at a time. Archived
+        hours are left as they are.
+        Buckets are replaced with the recounted totals rather than deleted and
+        re-incremented, and hours that may still receive live increments (the
+        last BACKFILL_LIVE_MARGIN) are never touched, so running it next to live
+        ingest loses nothing.
+        """
+        if since:
+            day = date.fromisoformat(since[:10])
+            start = datetime(day.year, day.month, day.day, tzinfo=ANALYTICS_TZ)
+        else:
+            oldest = []
+            for collection in EVENT_SOURCE_COLLECTIONS:
+                doc = await db[collection].find_one({}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", 1)])
+                if doc and doc.get("timestamp"):
+                    oldest.append(as_datetime(doc["timestamp"]))
+            if not oldest:
+                return {"hours": 0, "events": 0, "buckets": 0}
+            start = min(oldest)
+        day = date.fromisoformat(until[:10]) if until else (datetime.now(ANALYTICS_TZ) + timedelta(days=1)).date()
+        until = min(
+            datetime(day.year, day.month, day.day, tzinfo=ANALYTICS_TZ),
+            self.hour(datetime.now(timezone.utc) - self.BACKFILL_LIVE_MARGIN)
+        )
+        archived = [m for m in [await event_archive.watermark(c) for c in EVENT_SOURCE_COLLECTIONS] if m]
+        if archived and start < max(archived):
+            start = max(archived)
+        start = self.hour(start)
+        backfill_id = uuid.uuid4().hex
+        upserts = self.upserts
+        hours = events = 0
+        while start < until:
+            end = min(start + timedelta(days=self.BACKFILL_CHUNK_DAYS), until)
+            buckets = {}
+            for collection in EVENT_SOURCE_COLLECTIONS:
+                cursor = db[collection].aggregate([
+                    {"$match": {"timestamp": {"$gte": start, "$lt": end}, "bot": {"$ne": True}}},
+                    {"$group": {
+                        "_id": {
+                            "page_id": "$page_id",
+                            "hour": {"$dateTrunc": {"date": "$timestamp", "unit": "hour"}},
+                            "qr": {"$eq": ["$type", "qr"]}
+                        },
+                        "count": {"$sum": 1}
+                    }}
+                ], allowDiskUse=True)
+                async for doc in cursor:
+                    group = doc["_id"]
+                    counter = "qr" if group["qr"] else collection
+                    counters = buckets.setdefault((group["page_id"], as_datetime(group["hour"])), {})
+                    counters[counter] = counters.get(counter, 0) + doc["count"]
+                    events += doc["count"]
+            ops = [
+                ReplaceOne(
+                    {"_id": f"{page_id}|{hour:%Y-%m-%dT%H}"},
+                    {"page_id": page_id, "hour": hour, "backfill": backfill_id, **counters},
+                    upsert=True
+                )
+                for (page_id, hour), counters in buckets.items()
+            ]
+            for i in range(0, len(ops), 1000):
+                await self.coll.bulk_write(ops[i:i + 1000], ordered=False)
+            self.upserts += len(ops)
+            # Buckets without events left in the chunk (deleted pages, bot-flagged events)
+            await self.coll.delete_many({"hour": {"$gte": start, "$lt": end}, "backfill": {"$ne": backfill_id}})
+            hours += len({hour for _, hour in buckets})
+            start = end
+        return {"hours": hours, "events": events, "buckets": self.upserts - upserts}
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded, "upserts": self.upserts}
+
+hourly_rollups = HourlyRollups()
+
+def timeline_floor(ts: datetime, granularity: str, tz: ZoneInfo) -> datetime:
+    """Start of the bucket containing `ts`, as an aware local datetime"""
+    local = ts.astimezone(tz)
+    if granularity == "hour":
+        return local.replace(minute=0, second=0, microsecond=0)
+    day = local.date()
+    if granularity == "week":
+        day -= timedelta(days=day.weekday())
+    elif granularity == "month":
+        day = day.replace(day=1)
+    return datetime(day.year, day.month, day.day, tzinfo=tz)
+
+def timeline_next(start: datetime, granularity: str, tz: ZoneInfo) -> datetime:
+    if granularity == "hour":
+        return (start.astimezone(timezone.utc) + timedelta(hours=1)).astimezone(tz)
+    if granularity == "month":
+        year, month = (start.year + 1, 1) if start.month == 12 else (start.year, start.month + 1)
+        return datetime(year, month, 1, tzinfo=tz)
+    day = start.date() + timedelta(days=7 if granularity == "week" else 1)
+    return datetime(day.year, day.month, day.day, tzinfo=tz)
+
+class TimelineRequest:
+    """Validated timeline parameters; bucket-aligned so equal requests share a cache entry"""
+    def __init__(self, granularity: str, since: Optional[str], until: Optional[str], tz: Optional[str]):
+        if granularity not in TIMELINE_GRANULARITIES:
+            raise HTTPException(status_code=400, detail="Шаг графика: hour, day, week или month")
+        try:
+            self.tz = ZoneInfo(tz) if tz else ANALYTICS_TZ
+        except (KeyError, ValueError):
+            raise HTTPException(status_code=400, detail="Неизвестный часовой пояс")
+        self.granularity = granularity
+        try:
+            end = self._parse(until) if until else datetime.now(timezone.utc)
+            start = self._parse(since) if since else end - TIMELINE_DEFAULT_SPAN[granularity]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректный формат даты")
+        if start >= end:
+            raise HTTPException(status_code=400, detail="Начало периода должно быть раньше конца")
+        self.since = timeline_floor(start, granularity, self.tz)
+        last = timeline_floor(end - timedelta(microseconds=1), granularity, self.tz)
+        self.until = timeline_next(last, granularity, self.tz)
+        self.buckets = []
+        bucket = self.since
+        while bucket < self.until:
+            self.buckets.append(bucket)
+            if len(self.buckets) > TIMELINE_MAX_POINTS:
+                raise HTTPException(status_code=400, detail=f"Слишком много точек (максимум {TIMELINE_MAX_POINTS}), увеличьте шаг")
+            bucket = timeline_next(bucket, granularity, self.tz)
+
+    def _parse(self, value: str) -> datetime:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=self.tz)
+
+    @property
+    def from_daily_rollups(self) -> bool:
+        return self.granularity != "hour" and self.tz.key == ANALYTICS_TZ.key
+
+    def cache_key(self, scope: str) -> tuple:
+        return (scope, self.granularity, self.tz.key, self.since.isoformat(), self.until.isoformat())
+
+class Timelines:
+    def __init__(self, cache_ttl: float):
+        self.cache = TTLCache(2000, cache_ttl)
+
+    async def _rows(self, page_match, request: TimelineRequest) -> list:
+        """(bucket start, counters) pairs from the cheapest pre-aggregated source"""
+        if request.from_daily_rollups:
+            cursor = rollups.coll.aggregate([
+                {"$match": {"page_id": page_match, "day": {
+                    "$gte": request.since.date().isoformat(), "$lt": request.until.date().isoformat()
+                }}},
+                {"$group": {
+                    "_id": "$day",
+                    "views": {"$sum": "$views"},
+                    "clicks": {"$sum": "$clicks"},
+                    "shares": {"$sum": {"$cond": [{"$eq": ["$share_type", "qr"]}, 0, "$shares"]}},
+                    "qr": {"$sum": {"$cond": [{"$eq": ["$share_type", "qr"]}, "$shares", 0]}}
+                }}
+            ])
+            return [
+                (datetime.fromisoformat(doc["_id"]).replace(tzinfo=request.tz), doc)
+                async for doc in cursor
+            ]
+        cursor = hourly_rollups.coll.aggregate([
+            {"$match": {"page_id": page_match, "hour": {
+                "$gte": request.since.astimezone(timezone.utc), "$lt": request.until.astimezone(timezone.utc)
+            }}},
+            {"$group": {"_id": "$hour", **{name: {"$sum": f"${name}"} for name in TIMELINE_SERIES}}}
+        ])
+        return [(as_datetime(doc["_id"]), doc) async for doc in cursor]
+
+    async def series(self, scope: str, page_ids: list, request: TimelineRequest) -> dict:
+        key = request.cache_key(scope)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        generation = self.cache.generation
+        page_match = page_ids[0] if len(page_ids) == 1 else {"$in": page_ids}
+        totals = {}
+        if page_ids:
+            for ts, doc in await self._rows(page_match, request):
+                # Keyed by UTC instant: repeated wall-clock hours (DST) stay distinct
+                start = timeline_floor(ts, request.granularity, request.tz).astimezone(timezone.utc)
+                bucket = totals.setdefault(start, dict.fromkeys(TIMELINE_SERIES, 0))
+                for name in TIMELINE_SERIES:
+                    bucket[name] += doc.get(name) or 0
+        zero = dict.fromkeys(TIMELINE_SERIES, 0)
+        result = {
+            "granularity": request.granularity,
+            "timezone": request.tz.key,
+            "since": request.since.isoformat(),
+            "until": request.until.isoformat(),
+            "points": [{"t": b.isoformat(), **totals.get(b.astimezone(timezone.utc), zero)} for b in request.buckets],
+            "totals": {name: sum(t[name] for t in totals.values()) for name in TIMELINE_SERIES}
+        }
+        self.cache.set(key, result, generation)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "hourly_rollups": hourly_rollups.stats(),
+            "cache": {"entries": len(self.cache), "hits": self.cache.hits, "misses": self.cache.misses}
+        }
+
+timelines = Timelines(TIMELINE_CACHE_TTL_SECONDS)
+
+# ===================== UNIQUE VISITORS =====================
+# One HyperLogLog sketch per (page_id, day) in visitor_sketches, plus a
+# global "*" sketch per day. Visitors are identified by a keyed 64-bit hash of
+# client IP + user agent (nothing reversible is stored). Sketches merge by
+# register-wise max, so unique visitors over any set of pages and days cost
+# one small binary read per bucket.
+#
+# Error bounds: standard error 1.04 / sqrt(2^HLL_PRECISION), about 1.6% at
+# the default precision 12; small counts use linear counting and are
+# near-exact.
+
+HLL_PRECISION = int(os.environ.get('HLL_PRECISION', '12'))
+VISITOR_FLUSH_INTERVAL_SECONDS = float(os.environ.get('VISITOR_FLUSH_INTERVAL_SECONDS', '10'))
+VISITOR_PENDING_MAX_HASHES = int(os.environ.get('VISITOR_PENDING_MAX_HASHES', '200000'))
+ALL_PAGES = "*"
+
+class HyperLogLog:
+    """
+    Dense uint8 registers; serialized sparse (index, value) pairs while that is smaller.
+    The first serialized byte is the format in bit 0 and the precision above it
+    (0 in legacy sketches). Sketches of different precision merge at the lower one.
+    """
+    __slots__ = ("p", "m", "registers")
+
+    DENSE, SPARSE = 0, 1
+
+    def __init__(self, p: int = HLL_PRECISION, registers: Optional[np.ndarray] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    def add_hashes(self, hashes) -> bool:
+        """Add 64-bit hashes; True if any register changed"""
+        width = 64 - self.p
+        mask = (1 << width) - 1
+        indexes = np.fromiter((h >> width for h in hashes), dtype=np.int64)
+        ranks = np.fromiter((width - (h & mask).bit_length() + 1 for h in hashes), dtype=np.uint8)
+        before = self.registers.copy()
+        np.maximum.at(self.registers, indexes, ranks)
+        return not np.array_equal(before, self.registers)
+
+    def fold(self, p: int) -> "HyperLogLog":
+        """The same sketch at a lower precision p (exact: as if built at p)"""
+        if p == self.p:
+            return self
+        if p > self.p:
+            raise ValueError(f"Cannot raise HyperLogLog precision from {self.p} to {p}")
+        shift = self.p - p
+        indexes = np.arange(self.m)
+        low = indexes & ((1 << shift) - 1)
+        # The dropped index bits become the leading bits of the remainder:
+        # rank = position of their first 1 bit, or shift + old rank if they are all 0
+        low_rank = shift - np.floor(np.log2(np.maximum(low, 1))).astype(np.int64)
+        ranks = np.where(low == 0, self.registers.astype(np.int64) + shift, low_rank)
+        ranks = np.where(self.registers == 0, 0, ranks).astype(np.uint8)
+        folded = HyperLogLog(p)
+        np.maximum.at(folded.registers, indexes >> shift, ranks)
+        return folded
+
+    def merge(self, other: "HyperLogLog"):
+        if other.p != self.p:
+            p = min(self.p, other.p)
+            folded = self.fold(p)
+            self.p, self.m, self.registers = p, folded.m, folded.registers
+            other = other.fold(p)
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting for small cardinalities
+            return int(round(m * np.log(m / zeros)))
+        return int(round(raw))
+
+    def to_bytes(self) -> bytes:
+        nonzero = np.flatnonzero(self.registers)
+        if len(nonzero) * 3 < self.m:
+            return bytes([self.SPARSE | self.p << 1]) + nonzero.astype("<u2").tobytes() + self.registers[nonzero].tobytes()
+        return bytes([self.DENSE | self.p << 1]) + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, p: Optional[int] = None) -> "HyperLogLog":
+        """Decode at the stored precision; `p` is only a fallback for legacy sparse sketches"""
+        fmt, stored_p = data[0] & 1, data[0] >> 1
+        if not stored_p and fmt == cls.DENSE:
+            stored_p = (len(data) - 1).bit_length() - 1
+        sketch = cls(stored_p or p or HLL_PRECISION)
+        if fmt == cls.DENSE:
+            registers = np.frombuffer(data, dtype=np.uint8, offset=1)
+            if len(registers) != sketch.m:
+                raise ValueError(f"HyperLogLog of {len(registers)} registers does not match precision {sketch.p}")
+            sketch.registers = registers.copy()
+        else:
+            count = (len(data) - 1) // 3
+            indexes = np.frombuffer(data, dtype="<u2", count=count, offset=1)
+            sketch.registers[indexes] = np.frombuffer(data, dtype=np.uint8, offset=1 + 2 * count)
+        return sketch
+
+class VersionedMergeBuffer(ABC):
+    """
+    Base for per-worker deltas folded into shared documents every flush:
+    each document is read, merged and written back with a compare-and-set on
+    `version` (retried), so concurrent workers never lose each other's updates.
+    Subclasses build the items in flush() and take back failed ones in _requeue().
+    """
+    MAX_CAS_ATTEMPTS = 5
+    APPLY_CONCURRENCY = 20
+
+    def __init__(self, flush_interval: float, collection: str):
+        self.flush_interval = flush_interval
+        self.collection = collection
+        self.flushes = 0
+        self.cas_retries = 0
+        self.failed = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    @property
+    def coll(self):
+        return db[self.collection]
+
+    async def compare_and_set(self, doc_id: str, merge, insert_fields: dict) -> bool:
+        """
+        `merge(doc)` gets the stored document (None if missing) and returns the
+        fields to write, or None when there is nothing to change.
+        """
+        for attempt in range(self.MAX_CAS_ATTEMPTS):
+            doc = await self.coll.find_one({"_id": doc_id})
+            fields = merge(doc)
+            if fields is None:
+                return True
+            fields["updated_at"] = utc_now()
+            if doc:
+                result = await self.coll.update_one(
+                    {"_id": doc_id, "version": doc["version"]},
+                    {"$set": {**fields, "version": doc["version"] + 1}}
+                )
+                if result.matched_count:
+                    return True
+            else:
+                try:
+                    await self.coll.insert_one({"_id": doc_id, **insert_fields, "version": 1, **fields})
+                    return True
+                except DuplicateKeyError:
+                    pass
+            self.cas_retries += 1
+        return False
+
+    async def apply_all(self, items: list, apply) -> int:
+        """Run `apply(key, value)` for (key, value) items a few at a time; failed ones go to _requeue()"""
+        applied = 0
+        for i in range(0, len(items), self.APPLY_CONCURRENCY):
+            chunk = items[i:i + self.APPLY_CONCURRENCY]
+            results = await asyncio.gather(*(apply(key, value) for key, value in chunk), return_exceptions=True)
+            for (key, value), ok in zip(chunk, results):
+                if ok is True:
+                    applied += 1
+                    continue
+                self.failed += 1
+                self._requeue(key, value, ok if isinstance(ok, Exception) else None)
+        return applied
+
+    @abstractmethod
+    async def flush(self) -> int:
+        ...
+
+    @abstractmethod
+    def _requeue(self, key, value, error: Optional[Exception]):
+        ...
+
+    async def _wait(self):
+        await asyncio.sleep(self.flush_interval)
+
+    async def run(self):
+        """Background flush loop"""
+        while True:
+            await self._wait()
+            # Shielded: cancelling the loop on shutdown must not abandon a swapped-out
+            # batch mid-write; the final flush() waits for it on the lock
+            self._flush_task = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flush_task)
+
+class UniqueVisitors(VersionedMergeBuffer):
+    """
+    Collects visitor hashes per (page_id, day) in memory and merges them into
+    the stored sketches every flush (or sooner once `max_pending` hashes wait).
+    """
+    def __init__(self, flush_interval: float, max_pending: int, collection: str = "visitor_sketches"):
+        super().__init__(flush_interval, collection)
+        self.max_pending = max_pending
+        self.observed = 0
+        self._pending = {}
+        self._pending_hashes = 0
+        self._wakeup = asyncio.Event()
+        self._key = IP_HASH_SALT.encode()[:64]
+
+    def visitor_hash(self, client_ip: str, user_agent: str) -> int:
+        digest = hashlib.blake2b(f"{client_ip}|{user_agent}".encode(), digest_size=8, key=self._key).digest()
+        return int.from_bytes(digest, "big")
+
+    def observe(self, page_id: str, client_ip: str, user_agent: str, timestamp: Optional[datetime] = None):
+        visitor = self.visitor_hash(client_ip, user_agent)
+        day = analytics_day(timestamp or utc_now())
+        for key in ((page_id, day), (ALL_PAGES, day)):
+            hashes = self._pending.setdefault(key, set())
+            if visitor not in hashes:
+                hashes.add(visitor)
+                self._pending_hashes += 1
+        self.observed += 1
+        if self._pending_hashes >= self.max_pending:
+            self._wakeup.set()
+
+    def observe_request(self, page_id: str, request: Optional[Request]):
+        if request is not None:
+            self.observe(page_id, get_client_ip(request), request.headers.get("user-agent", ""))
+
+    async def _merge(self, key: tuple, hashes: set) -> bool:
+        page_id, day = key
+        
+        def merge(doc):
+            # Hashes are precision independent: an existing sketch keeps its stored precision
+            sketch = HyperLogLog.from_bytes(doc["hll"], doc.get("p")) if doc else HyperLogLog()
+            if not sketch.add_hashes(hashes) and doc:
+                return None
+            return {"hll": Binary(sketch.to_bytes()), "p": sketch.p, "estimate": sketch.estimate()}
+        
+        return await self.compare_and_set(f"{page_id}|{day}", merge, {"page_id": page_id, "day": day})
+
+    def _requeue(self, key: tuple, hashes: set, error: Optional[Exception]):
+        # Keep for the next flush (HLL adds are idempotent)
+        self._pending.setdefault(key, set()).update(hashes)
+        self._pending_hashes += len(hashes)
+        if error:
+            logging.error(f"Visitor sketch merge failed for {key[0]} {key[1]}: {error}")
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending, self._pending_hashes = self._pending, {}, 0
+            merged = await self.apply_all(list(pending.items()), self._merge)
+            self.flushes += 1
+            return merged
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def count(self, page_ids: list, since_day: Optional[str] = None, until_day: Optional[str] = None) -> int:
+        """Distinct visitors over the given pages and day range (inclusive)"""
+        query = {"page_id": {"$in": page_ids}}
+        if since_day or until_day:
+            query["day"] = {}
+            if since_day:
+                query["day"]["$gte"] = since_day
+            if until_day:
+                query["day"]["$lte"] = until_day
+        docs = await self.coll.find(query, {"_id": 0, "hll": 1, "p": 1, "estimate": 1}).to_list(None)
+        if not docs:
+            return 0
+        if len(docs) == 1:
+            return docs[0]["estimate"]
+        merged = HyperLogLog()
+        for doc in docs:
+            merged.merge(HyperLogLog.from_bytes(doc["hll"], doc.get("p")))
+        return merged.estimate()
+
+    async def delete_pages(self, page_ids: list):
+        await self.coll.delete_many({"page_id": {"$in": page_ids}})
+
+    def stats(self) -> dict:
+        return {
+            "pending_buckets": len(self._pending),
+            "pending_hashes": self._pending_hashes,
+            "observed": self.observed,
+            "flushes": self.flushes,
+            "cas_retries": self.cas_retries,
+            "failed_merges": self.failed,
+            "precision": HLL_PRECISION,
+            "standard_error": round(1.04 / (1 << HLL_PRECISION) ** 0.5, 4)
+        }
+
+unique_visitors = UniqueVisitors(VISITOR_FLUSH_INTERVAL_SECONDS, VISITOR_PENDING_MAX_HASHES)
+
+def analytics_since_day(days: int) -> str:
+    return (datetime.now(ANALYTICS_TZ) - timedelta(days=days)).date().isoformat()
+
+# ===================== HEAVY HITTERS =====================
+# Top countries/cities by clicks per page, per user and globally, kept as
+# Space-Saving summaries in heavy_hitters and updated on ingest, so a top-K
+# query is one small document read.
+#
+# Error bounds (Space-Saving, capacity k, total clicks N in the scope): every
+# monitored value v satisfies count(v) - error(v) <= true(v) <= count(v), with
+# error(v) <= N/k; any value with more than N/k clicks is always monitored.
+# TOPK_MODE=exact answers from the daily rollups instead (also used while a
+# scope has no summary yet); `python server.py rebuild-heavy-hitters` seeds
+# all summaries exactly from the rollups.
+
+HEAVY_HITTERS_CAPACITY = int(os.environ.get('HEAVY_HITTERS_CAPACITY', '100'))
+HEAVY_HITTERS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('HEAVY_HITTERS_FLUSH_INTERVAL_SECONDS', '30'))
+TOPK_MODE = os.environ.get('TOPK_MODE', 'sketch')  # sketch | exact
+GEO_DIMENSIONS = ("country", "city")
+
+class SpaceSaving:
+    """Weighted Space-Saving summary: value -> [count, error], at most `capacity` values"""
+    def __init__(self, capacity: int, counters: Optional[dict] = None, total: int = 0):
+        self.capacity = capacity
+        self.counters = counters or {}
+        self.total = total
+
+    def add(self, value: str, weight: int = 1):
+        self.total += weight
+        counter = self.counters.get(value)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[value] = [weight, 0]
+        else:
+            # Replace the minimum; the newcomer inherits its count as error
+            victim = min(self.counters, key=lambda v: self.counters[v][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[value] = [floor + weight, floor]
+
+    def top(self, limit: int) -> list:
+        return sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+
+    def to_document(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "total": self.total,
+            "items": [{"v": v, "c": c, "e": e} for v, (c, e) in self.top(self.capacity)]
+        }
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "SpaceSaving":
+        return cls(
+            doc.get("capacity", HEAVY_HITTERS_CAPACITY),
+            {item["v"]: [item["c"], item["e"]] for item in doc.get("items", [])},
+            doc.get("total", 0)
+        )
+
+class HeavyHitters(VersionedMergeBuffer):
+    """
+    Workers accumulate exact click deltas per (scope, dimension) in memory and
+    fold them into the stored summaries every flush, like the visitor sketches.
+    """
+    def __init__(self, capacity: int, flush_interval: float, collection: str = "heavy_hitters"):
+        super().__init__(flush_interval, collection)
+        self.capacity = capacity
+        self.recorded = 0
+        self.exact_fallbacks = 0
+        # page_id -> {dimension: {value: clicks}}; owners are resolved at flush time
+        self._pending = {}
+        # (scope, dimension) -> {value: clicks} whose update failed, retried next flush
+        self._retry = {}
+        self._owners = TTLCache(20000, 3600)
+
+    async def record(self, events: list):
+        """Count finalized click events (geo known)"""
+        for e in events:
+            if e.kind != "click":
+                continue
+            page = self._pending.setdefault(e.page_id, {d: {} for d in GEO_DIMENSIONS})
+            for dimension, value in (("country", e.country), ("city", e.city)):
+                value = value or GEO_UNKNOWN
+                page[dimension][value] = page[dimension].get(value, 0) + 1
+            self.recorded += 1
+
+    async def _page_owners(self, page_ids: list) -> dict:
+        owners = {}
+        missing = []
+        for page_id in page_ids:
+            owner = self._owners.get(page_id)
+            if owner is None:
+                missing.append(page_id)
+            else:
+                owners[page_id] = owner
+        if missing:
+            async for page in db.pages.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "user_id": 1}):
+                owners[page["id"]] = page["user_id"]
+                self._owners.set(page["id"], page["user_id"])
+        return owners
+
+    async def _apply(self, key: tuple, deltas: dict) -> bool:
+        scope, dimension = key
+        
+        def merge(doc):
+            summary = SpaceSaving.from_document(doc) if doc else SpaceSaving(self.capacity)
+            # Largest deltas first: they are the ones that must survive eviction
+            for value, clicks in sorted(deltas.items(), key=lambda item: item[1], reverse=True):
+                summary.add(value, clicks)
+            return summary.to_document()
+        
+        return await self.compare_and_set(f"{scope}|{dimension}", merge, {"scope": scope, "dimension": dimension})
+
+    def _requeue(self, key: tuple, deltas: dict, error: Optional[Exception]):
+        # Summaries of other scopes already include this delta: retry only this scope
+        retry = self._retry.setdefault(key, {})
+        for value, clicks in deltas.items():
+            retry[value] = retry.get(value, 0) + clicks
+        logging.warning(f"Heavy hitters update failed for {key[0]}|{key[1]}, retrying next flush: {error}")
+
+    def _restore(self, pending: dict):
+        """Put page deltas back in front of the ones recorded since they were taken"""
+        for page_id, dimensions in pending.items():
+            page = self._pending.setdefault(page_id, {d: {} for d in GEO_DIMENSIONS})
+            for dimension, deltas in dimensions.items():
+                for value, clicks in deltas.items():
+                    page[dimension][value] = page[dimension].get(value, 0) + clicks
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending and not self._retry:
+                return 0
+            pending, self._pending = self._pending, {}
+            try:
+                owners = await self._page_owners(list(pending))
+            except Exception as e:
+                self._restore(pending)
+                logging.warning(f"Heavy hitters flush postponed, page owners lookup failed: {e}")
+                return 0
+            
+            # Fold page deltas into page, user and global scopes (plus last flush's failures)
+            by_scope, self._retry = self._retry, {}
+            for page_id, dimensions in pending.items():
+                scopes = [f"page:{page_id}", "global"]
+                if page_id in owners:
+                    scopes.append(f"user:{owners[page_id]}")
+                for scope in scopes:
+                    for dimension, deltas in dimensions.items():
+                        target = by_scope.setdefault((scope, dimension), {})
+                        for value, clicks in deltas.items():
+                            target[value] = target.get(value, 0) + clicks
+            
+            applied = await self.apply_all(list(by_scope.items()), self._apply)
+            self.flushes += 1
+            return applied
+
+    async def top(self, scope: str, limit: int = 10) -> Optional[dict]:
+        """{"country": [(value, clicks)], "city": [...]} or None when the scope has no summary"""
+        docs = await self.coll.find({"_id": {"$in": [f"{scope}|{d}" for d in GEO_DIMENSIONS]}}).to_list(len(GEO_DIMENSIONS))
+        if len(docs) < len(GEO_DIMENSIONS):
+            return None
+        return {
+            doc["dimension"]: [(v, c) for v, (c, e) in SpaceSaving.from_document(doc).top(limit)]
+            for doc in docs
+        }
+
+    async def rebuild(self) -> dict:
+        """
+        Seed every summary exactly from the daily rollups (error 0).
+        Summaries are replaced in place with a bumped version, so a worker's
+        concurrent flush fails its compare-and-set and re-applies on top of the
+        rebuilt summary; summaries the rebuild did not produce are removed after.
+        """
+        started = utc_now()
+        rebuild_id = uuid.uuid4().hex
+        owners = {}
+        async for page in db.pages.find({}, {"_id": 0, "id": 1, "user_id": 1}):
+            owners[page["id"]] = page["user_id"]
+        scopes = {}
+        cursor = rollups.coll.aggregate([
+            {"$match": {"clicks": {"$gt": 0}}},
+            {"$group": {"_id": {"page_id": "$page_id", "country": "$country", "city": "$city"}, "clicks": {"$sum": "$clicks"}}}
+        ], allowDiskUse=True)
+        async for doc in cursor:
+            page_id = doc["_id"]["page_id"]
+            targets = [f"page:{page_id}", "global"]
+            if page_id in owners:
+                targets.append(f"user:{owners[page_id]}")
+            for scope in targets:
+                for dimension in GEO_DIMENSIONS:
+                    value = doc["_id"].get(dimension) or GEO_UNKNOWN
+                    counts = scopes.setdefault((scope, dimension), {})
+                    counts[value] = counts.get(value, 0) + doc["clicks"]
+        ops = []
+        for (scope, dimension), counts in scopes.items():
+            summary = SpaceSaving(self.capacity)
+            ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+            summary.counters = {v: [c, 0] for v, c in ranked[:self.capacity]}
+            summary.total = sum(counts.values())
+            ops.append(UpdateOne(
+                {"_id": f"{scope}|{dimension}"},
+                {
+                    "$set": {"scope": scope, "dimension": dimension, "rebuild_id": rebuild_id, "updated_at": utc_now(), **summary.to_document()},
+                    "$inc": {"version": 1}
+                },
+                upsert=True
+            ))
+        for i in range(0, len(ops), 1000):
+            await self.coll.bulk_write(ops[i:i + 1000], ordered=False)
+        # Stale summaries: not rebuilt now and not touched by a live flush since the rebuild started
+        removed = await self.coll.delete_many({"rebuild_id": {"$ne": rebuild_id}, "updated_at": {"$lt": started}})
+        return {"summaries": len(ops), "removed": removed.deleted_count}
+
+    async def delete_pages(self, page_ids: list):
+        await self.coll.delete_many({"scope": {"$in": [f"page:{page_id}" for page_id in page_ids]}})
+
+    def stats(self) -> dict:
+        return {
+            "mode": TOPK_MODE,
+            "capacity": self.capacity,
+            "pending_pages": len(self._pending),
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "cas_retries": self.cas_retries,
+            "failed_updates": self.failed,
+            "retry_scopes": len(self._retry),
+            "exact_fallbacks": self.exact_fallbacks
+        }
+
+heavy_hitters = HeavyHitters(HEAVY_HITTERS_CAPACITY, HEAVY_HITTERS_FLUSH_INTERVAL_SECONDS)
+geo_enrichment.finalizers.append(heavy_hitters.record)
+
+async def top_geo(scope: str, match: dict, limit: int = 10) -> dict:
+    """Top countries/cities by clicks: heavy-hitter summary, or exact from the rollups"""
+    if TOPK_MODE != "exact":
+        top = await heavy_hitters.top(scope, limit)
+        if top is not None:
+            return {
+                "by_country": [{"country": v, "clicks": c} for v, c in top["country"]],
+                "by_city": [{"city": v, "clicks": c} for v, c in top["city"]]
+            }
+        heavy_hitters.exact_fallbacks += 1
+    dashboard = await rollups.dashboard(match, geo=True, timeline_days=None, shares_by_type=False, limit=limit)
+    return {"by_country": dashboard["by_country"], "by_city": dashboard["by_city"]}
+
+# ===================== COLD ARCHIVE =====================
+# Raw clicks/views/shares older than ARCHIVE_AFTER_DAYS are moved out of Mongo
+# into compressed NumPy .npz files (one per batch, columns per field, strings
+# dictionary-encoded) under ARCHIVE_PATH/<collection>/. Rollups, counters and
+# sketches are left as they are; rollup backfill never recounts archived days.
+# ArchiveQuery answers group-by/time-range counts over the files vectorized,
+# and exports read archived rows before the live ones.
+#
+#   python server.py archive-events            # move events past the horizon
+#   python server.py query-archive clicks --by country
+
+ARCHIVE_PATH = Path(os.environ.get('ARCHIVE_PATH', str(DATA_DIR / 'archive')))
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '180'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '50000'))
+
+# Dictionary-encoded (low cardinality) and plain string columns per collection
+ARCHIVE_COLUMNS = {
+    "clicks": (("page_id", "link_id", "country", "city", "referrer", "source"), ("id", "ip_hash")),
+    "views": (("page_id", "country", "city", "source"), ("id", "ip_hash")),
+    "shares": (("page_id", "type", "country", "city"), ("id", "ip_hash")),
+}
+
+def export_sort_key(doc: dict) -> tuple:
+    """(ms, ObjectId bytes): the global order of archived and live rows in exports"""
+    return epoch_ms(doc["timestamp"]), doc["_id"].binary
+
+def _dictionary_encode(values: list):
+    dictionary, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return dictionary, codes.astype(np.int32)
+
+class ArchiveSegment:
+    """One archived batch: int64 ms timestamps, 12-byte ObjectIds and encoded columns"""
+    def __init__(self, path: Path, arrays: dict):
+        self.path = path
+        self.arrays = arrays
+        self.timestamp = arrays["timestamp"]
+        self.oid = arrays["_id"]
+
+    @staticmethod
+    def first_ms(path: Path) -> int:
+        """First timestamp of a segment, from its <first ms>-<first _id>-<last ms> file name"""
+        return int(path.stem.split("-")[0])
+
+    @classmethod
+    def load(cls, path: Path) -> "ArchiveSegment":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(path, {name: data[name] for name in data.files})
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def codes(self, column: str) -> tuple:
+        """(dictionary, codes) of a column; plain columns are encoded on the fly"""
+        if f"{column}__dict" in self.arrays:
+            return self.arrays[f"{column}__dict"], self.arrays[f"{column}__codes"]
+        return _dictionary_encode(self.arrays[column])
+
+    def column(self, column: str) -> np.ndarray:
+        if f"{column}__dict" in self.arrays:
+            dictionary, codes = self.codes(column)
+            return dictionary[codes]
+        return self.arrays[column]
+
+    def mask(self, gte: Optional[int] = None, lt: Optional[int] = None, page_ids: Optional[list] = None) -> np.ndarray:
+        selected = np.ones(len(self), dtype=bool)
+        if gte is not None:
+            selected &= self.timestamp >= gte
+        if lt is not None:
+            selected &= self.timestamp < lt
+        if page_ids is not None:
+            dictionary, codes = self.codes("page_id")
+            selected &= np.isin(codes, np.flatnonzero(np.isin(dictionary, page_ids)))
+        return selected
+
+class EventArchive:
+    """
+    Moves old events to .npz segments, oldest first. A segment file is named
+    after its first (timestamp, _id), so a run interrupted between writing
+    and deleting rewrites the same file instead of duplicating rows. The
+    per-collection watermark (everything older is archived) is kept in
+    `migrations` as archive:<collection>.
+    """
+    def __init__(self, path: Path, after_days: int, batch_size: int):
+        self.path = path
+        self.after_days = after_days
+        self.batch_size = batch_size
+
+    def _dir(self, collection: str) -> Path:
+        return self.path / collection
+
+    async def watermark(self, collection: str) -> Optional[datetime]:
+        doc = await db.migrations.find_one({"_id": f"archive:{collection}"})
+        return as_datetime(doc["archived_until"]) if doc else None
+
+    async def watermark_day(self) -> Optional[str]:
+        """First analytics day whose raw events are all still in Mongo (cutoffs are local midnights)"""
+        marks = [m for m in [await self.watermark(c) for c in ARCHIVE_COLUMNS] if m]
+        if not marks:
+            return None
+        return max(marks).astimezone(ANALYTICS_TZ).date().isoformat()
+
+    def _write_segment(self, collection: str, docs: list) -> Path:
+        categorical, plain = ARCHIVE_COLUMNS[collection]
+        first = docs[0]
+        ms = np.array([epoch_ms(d["timestamp"]) for d in docs], dtype=np.int64)
+        arrays = {
+            "timestamp": ms,
+            "_id": np.array([d["_id"].binary for d in docs], dtype="S12"),
+        }
+        for column in categorical:
+            dictionary, codes = _dictionary_encode([d.get(column) or "" for d in docs])
+            arrays[f"{column}__dict"], arrays[f"{column}__codes"] = dictionary, codes
+        for column in plain:
+            arrays[column] = np.array([d.get(column) or "" for d in docs], dtype=str)
+        directory = self._dir(collection)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{ms[0]}-{first['_id']}-{ms[-1]}.npz"
+        tmp = path.with_suffix(".tmp.npz")
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, path)
+        return path
+
+    async def compact(self, collection: str, cutoff: datetime) -> dict:
+        # Flagged bot events stay in Mongo (retention expires them): the archive only holds counted traffic
+        query = {"timestamp": {"$lt": cutoff}, "geo_pending": {"$ne": True}, "bot": {"$ne": True}}
+        moved = segments = 0
+        while True:
+            docs = await db[collection].find(query).sort([("timestamp", 1), ("_id", 1)]).limit(self.batch_size).to_list(None)
+            if not docs:
+                break
+            await asyncio.to_thread(self._write_segment, collection, docs)
+            await db[collection].delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+            moved += len(docs)
+            segments += 1
+            logging.info(f"Archived {len(docs)} {collection} up to {format_timestamp(docs[-1]['timestamp'])}")
+        await db.migrations.update_one(
+            {"_id": f"archive:{collection}"},
+            {"$max": {"archived_until": cutoff}, "$set": {"updated_at": utc_now()}},
+            upsert=True
+        )
+        return {"events": moved, "segments": segments}
+
+    async def run(self, after_days: Optional[int] = None) -> dict:
+        """Archive every event collection up to the start of the horizon day"""
+        horizon = (datetime.now(ANALYTICS_TZ) - timedelta(days=after_days or self.after_days)).date()
+        cutoff = datetime(horizon.year, horizon.month, horizon.day, tzinfo=ANALYTICS_TZ)
+        pending = await TimestampMigration().pending()
+        if any(pending[c] for c in ARCHIVE_COLUMNS):
+            raise RuntimeError(f"String timestamps left, run migrate-timestamps first: {pending}")
+        return {"cutoff": cutoff.isoformat(), **{c: await self.compact(c, cutoff) for c in ARCHIVE_COLUMNS}}
+
+    def segment_paths(self, collection: str, gte: Optional[int] = None, lt: Optional[int] = None) -> list:
+        """Segments overlapping [gte, lt) ms, pruned by the range in the file name"""
+        directory = self._dir(collection)
+        if not directory.exists():
+            return []
+        paths = []
+        for path in directory.glob("*.npz"):
+            if path.name.endswith(".tmp.npz"):
+                continue
+            first, _, last = path.stem.split("-")
+            if (lt is not None and int(first) >= lt) or (gte is not None and int(last) < gte):
+                continue
+            paths.append((int(first), path.name, path))
+        return [path for _, _, path in sorted(paths)]
+
+    def stats(self) -> dict:
+        result = {"path": str(self.path), "after_days": self.after_days}
+        for collection in ARCHIVE_COLUMNS:
+            files = list(self._dir(collection).glob("*.npz")) if self._dir(collection).exists() else []
+            result[collection] = {"segments": len(files), "bytes": sum(f.stat().st_size for f in files)}
+        return result
+
+class ArchiveQuery:
+    """Vectorized scans over archive segments (run in a thread: numpy work is blocking)"""
+    def __init__(self, archive: EventArchive, collection: str, since: Optional[datetime] = None,
+                 until: Optional[datetime] = None, page_ids: Optional[list] = None):
+        if collection not in ARCHIVE_COLUMNS:
+            raise ValueError(f"Unknown collection: {collection}")
+        self.archive = archive
+        self.collection = collection
+        self.gte = epoch_ms(since) if since else None
+        self.lt = epoch_ms(until) if until else None
+        self.page_ids = page_ids
+
+    def segments(self):
+        for path in self.archive.segment_paths(self.collection, self.gte, self.lt):
+            segment = ArchiveSegment.load(path)
+            yield segment, segment.mask(self.gte, self.lt, self.page_ids)
+
+    def _day_codes(self, segment: ArchiveSegment, selected: np.ndarray) -> tuple:
+        # Quarter-hour slots map to local days exactly for every real UTC offset
+        slots, codes = np.unique(segment.timestamp[selected] // 900000, return_inverse=True)
+        days = np.array([
+            datetime.fromtimestamp(int(s) * 900, tz=timezone.utc).astimezone(ANALYTICS_TZ).date().isoformat()
+            for s in slots
+        ])
+        dictionary, day_codes = np.unique(days, return_inverse=True)
+        return dictionary, day_codes[codes]
+
+    def group_count(self, by: tuple = (), day: bool = False) -> list:
+        """[{<by columns>, "day"?, "count"}] sorted by count, over the selected rows"""
+        totals = {}
+        for segment, selected in self.segments():
+            if not selected.any():
+                continue
+            dictionaries, key = [], np.zeros(int(selected.sum()), dtype=np.int64)
+            columns = [segment.codes(c) for c in by]
+            if day:
+                columns.append(self._day_codes(segment, selected))
+            for i, (dictionary, codes) in enumerate(columns):
+                codes = codes if day and i == len(columns) - 1 else codes[selected]
+                key = key * len(dictionary) + codes
+                dictionaries.append(dictionary)
+            keys, counts = np.unique(key, return_counts=True)
+            for k, count in zip(keys.tolist(), counts.tolist()):
+                values = []
+                for dictionary in reversed(dictionaries):
+                    k, code = divmod(k, len(dictionary))
+                    values.append(str(dictionary[code]))
+                group = tuple(reversed(values))
+                totals[group] = totals.get(group, 0) + count
+        names = list(by) + (["day"] if day else [])
+        rows = [{**dict(zip(names, group)), "count": count} for group, count in totals.items()]
+        return sorted(rows, key=lambda r: r["count"], reverse=True)
+
+    def _segment_rows(self, path: Path, fields: list, after: Optional[tuple]):
+        segment = ArchiveSegment.load(path)
+        selected = segment.mask(self.gte, self.lt, self.page_ids)
+        if after is not None:
+            ms, oid = after
+            selected &= (segment.timestamp > ms) | ((segment.timestamp == ms) & (segment.oid > oid))
+        indexes = np.flatnonzero(selected)
+        if not len(indexes):
+            return
+        present = [f for f in fields if f in segment.arrays or f"{f}__dict" in segment.arrays]
+        columns = {f: segment.column(f)[indexes] for f in present}
+        for n, i in enumerate(indexes.tolist()):
+            row = {f: str(columns[f][n]) for f in present}
+            row["timestamp"] = UNIX_EPOCH + timedelta(milliseconds=int(segment.timestamp[i]))
+            row["_id"] = ObjectId(bytes(segment.oid[i]).ljust(12, b"\0"))  # "S" arrays drop trailing NULs
+            yield row
+
+    def rows(self, fields: list, after: Optional[tuple] = None):
+        """
+        Selected rows as dicts in global (timestamp, _id) order, after an
+        optional (ms, oid bytes). Segments are sorted inside but can overlap
+        (events archived by a later run, once their geo was final), so rows
+        are merged across segments; a segment is only loaded once the merge
+        reaches its first timestamp.
+        """
+        paths = self.archive.segment_paths(self.collection, self.gte, self.lt)
+        heap, opened = [], 0
+        while heap or opened < len(paths):
+            # Open every segment that may hold a row at or before the current head
+            while opened < len(paths) and (not heap or ArchiveSegment.first_ms(paths[opened]) <= heap[0][0][0]):
+                rows = self._segment_rows(paths[opened], fields, after)
+                row = next(rows, None)
+                if row is not None:
+                    heapq.heappush(heap, (export_sort_key(row), opened, row, rows))
+                opened += 1
+            if not heap:
+                continue
+            _, order, row, rows = heapq.heappop(heap)
+            yield row
+            following = next(rows, None)
+            if following is not None:
+                heapq.heappush(heap, (export_sort_key(following), order, following, rows))
+
+event_archive = EventArchive(ARCHIVE_PATH, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE)
+
+# ===================== EVENT TRACKING PIPELINE =====================
+# All tracking endpoints (click, page view, share, QR scan) build a
+# TrackingEvent and hand it to the `tracking` pipeline:
+#   validate -> filter (bots, prefetches, duplicates) -> flood detection
+#   -> sample -> bounded queue -> batch writer -> sinks
+# Sinks: raw event documents (MongoEventSink), counters (CounterSink), daily
+# and hourly rollups (RollupSink, HourlyRollupSink), top-K summaries
+# (HeavyHittersSink), unique-visitor sketches (VisitorSink) and an optional
+# NDJSON append log. Batching, sampling and filtering are tuned here.
+
+TRACK_QUEUE_MAX_SIZE = int(os.environ.get('TRACK_QUEUE_MAX_SIZE', '20000'))
+TRACK_BATCH_SIZE = int(os.environ.get('TRACK_BATCH_SIZE', '500'))
+TRACK_BATCH_WAIT_SECONDS = float(os.environ.get('TRACK_BATCH_WAIT_SECONDS', '1'))
+# Fraction of events kept (load shedding); 1.0 keeps everything
+TRACK_SAMPLE_RATE = float(os.environ.get('TRACK_SAMPLE_RATE', '1.0'))
+# Optional NDJSON append log of every accepted event
+TRACK_EVENT_LOG_PATH = os.environ.get('TRACK_EVENT_LOG_PATH', '')
+
+EVENT_COLLECTIONS = {"click": "clicks", "view": "views", "share": "shares", "qr": "shares"}
+SHARE_TYPES = {"link", "qr", "social"}
+
+@dataclass(slots=True)
+class TrackingEvent:
+    """Compact tracking event; client_ip and user_agent are transient and never persisted"""
+    kind: str  # click, view, share, qr
+    page_id: str
+    timestamp: datetime
+    ip_hash: str = ""
+    country: str = GEO_UNKNOWN
+    city: str = GEO_UNKNOWN
+    geo_pending: bool = False
+    link_id: Optional[str] = None
+    share_type: Optional[str] = None
+    referrer: Optional[str] = None
+    client_ip: str = ""
+    user_agent: str = ""
+    prefetch: bool = False
+    bot: bool = False
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+    @classmethod
+    def from_request(cls, kind: str, page_id: str, request: Optional[Request], **kwargs) -> "TrackingEvent":
+        return cls(
+            kind=kind,
+            page_id=page_id,
+            timestamp=utc_now(),
+            user_agent=request.headers.get("user-agent", "") if request else "",
+            prefetch=is_prefetch(request),
+            **get_tracking_context(request),
+            **kwargs
+        )
+
+    @property
+    def collection(self) -> str:
+        return EVENT_COLLECTIONS[self.kind]
+
+    def to_document(self) -> dict:
+        """Stored document (same shape the analytics queries always read)"""
+        doc = {"id": self.id}
+        if self.kind == "click":
+            doc["link_id"] = self.link_id
+        doc["page_id"] = self.page_id
+        doc["timestamp"] = self.timestamp
+        if self.kind == "click":
+            doc["referrer"] = self.referrer
+        elif self.kind in ("share", "qr"):
+            doc["type"] = "qr" if self.kind == "qr" else self.share_type
+        doc["country"] = self.country
+        doc["city"] = self.city
+        doc["ip_hash"] = self.ip_hash
+        if self.kind == "click":
+            doc["source"] = "link"
+        elif self.kind == "view":
+            doc["source"] = "direct"
+        if self.geo_pending:
+            doc["geo_pending"] = True
+        if self.bot:
+            doc["bot"] = True
+        return doc
+
+    @classmethod
+    def from_document(cls, collection: str, doc: dict) -> "TrackingEvent":
+        """Inverse of to_document() for stored clicks/views/shares"""
+        if collection == "clicks":
+            kind = "click"
+        elif collection == "views":
+            kind = "view"
+        else:
+            kind = "qr" if doc.get("type") == "qr" else "share"
+        return cls(
+            kind=kind,
+            page_id=doc.get("page_id"),
+            timestamp=as_datetime(doc.get("timestamp")),
+            ip_hash=doc.get("ip_hash", ""),
+            country=doc.get("country") or GEO_UNKNOWN,
+            city=doc.get("city") or GEO_UNKNOWN,
+            geo_pending=bool(doc.get("geo_pending")),
+            link_id=doc.get("link_id"),
+            share_type=doc.get("type") if kind == "share" else None,
+            referrer=doc.get("referrer"),
+            id=doc.get("id") or str(uuid.uuid4())
+        )
+
+    def to_log_record(self) -> dict:
+        doc = serialize_timestamps(self.to_document())
+        doc["kind"] = self.kind
+        doc.pop("geo_pending", None)
+        return doc
+
+class MongoEventSink:
+    """
+    Raw events: one insert_many per collection, then geo enrichment for pending events.
+    Primary sink: returns the events actually stored, and only those reach the derived sinks.
+    """
+    name = "mongo"
+    stores_flagged = True
+    primary = True
+
+    def __init__(self):
+        self.written = 0
+        self.failed = 0
+
+    async def write(self, events: list) -> list:
+        by_collection = {}
+        for event in events:
+            by_collection.setdefault(event.collection, []).append(event)
+        stored = []
+        for collection, items in by_collection.items():
+            try:
+                await db[collection].insert_many([e.to_document() for e in items], ordered=False)
+            except BulkWriteError as e:
+                failed = {err["index"] for err in e.details.get("writeErrors", [])}
+                logging.error(f"Raw event insert partially failed for {collection}: {len(failed)} of {len(items)} events")
+                items = [item for i, item in enumerate(items) if i not in failed]
+                self.failed += len(failed)
+            except Exception as e:
+                logging.error(f"Raw event insert failed for {collection} ({len(items)} events): {e}")
+                self.failed += len(items)
+                continue
+            self.written += len(items)
+            stored.extend(items)
+            for e in items:
+                if e.geo_pending:
+                    geo_enrichment.submit(e)
+        return stored
+
+    def stats(self) -> dict:
+        return {"written": self.written, "failed": self.failed}
+
+class CounterSink:
+    """Denormalized counters (links.clicks, pages.shares/qr_scans) via the write-behind buffer"""
+    name = "counters"
+
+    async def write(self, events: list):
+        for e in events:
+            if e.kind == "click":
+                counter_buffer.incr("links", e.link_id, "clicks")
+            elif e.kind == "share":
+                counter_buffer.incr("pages", e.page_id, "shares")
+                counter_buffer.incr("pages", e.page_id, f"shares_{e.share_type}")
+            elif e.kind == "qr":
+                counter_buffer.incr("pages", e.page_id, "qr_scans")
+
+    def stats(self) -> dict:
+        return {}
+
+class NDJSONLogSink:
+    """Append-only NDJSON log of accepted events (one JSON object per line)"""
+    name = "ndjson"
+    stores_flagged = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.written = 0
+
+    def _append(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def write(self, events: list):
+        lines = "".join(json.dumps(e.to_log_record(), ensure_ascii=False) + "\n" for e in events)
+        await asyncio.to_thread(self._append, lines)
+        self.written += len(events)
+
+    def stats(self) -> dict:
+        return {"path": self.path, "written": self.written}
+
+class RollupSink:
+    """Daily rollups for events whose geo is already known; pending ones are counted after enrichment"""
+    name = "rollups"
+
+    async def write(self, events: list):
+        await rollups.record([e for e in events if not e.geo_pending])
+
+    def stats(self) -> dict:
+        return rollups.stats()
+
+class HourlyRollupSink:
+    """Hourly timeline buckets; no geo in them, so pending events are counted too"""
+    name = "hourly_rollups"
+
+    async def write(self, events: list):
+        await hourly_rollups.record(events)
+
+    def stats(self) -> dict:
+        return hourly_rollups.stats()
+
+class HeavyHittersSink:
+    """Top country/city summaries for clicks whose geo is already known"""
+    name = "heavy_hitters"
+
+    async def write(self, events: list):
+        await heavy_hitters.record([e for e in events if not e.geo_pending])
+
+    def stats(self) -> dict:
+        return {}
+
+class VisitorSink:
+    """Page view events feed the unique-visitor sketches"""
+    name = "visitors"
+
+    async def write(self, events: list):
+        for e in events:
+            if e.kind == "view" and e.client_ip:
+                unique_visitors.observe(e.page_id, e.client_ip, e.user_agent, e.timestamp)
+
+    def stats(self) -> dict:
+        return {}
+
+# Ingest filtering: bot user agents, prefetches and repeated events
+TRACK_BOT_MODES = ("drop", "flag", "off")  # flag: stored with bot=true, never counted, exported or archived
+TRACK_BOT_MODE = os.environ.get('TRACK_BOT_MODE', 'drop')
+TRACK_DEDUP_WINDOW_SECONDS = float(os.environ.get('TRACK_DEDUP_WINDOW_SECONDS', '10'))
+TRACK_DEDUP_MAX_KEYS = int(os.environ.get('TRACK_DEDUP_MAX_KEYS', '200000'))
+
+# Bot-specific tokens only: BOT_USER_AGENTS (used for OG tags) also matches
+# in-app browsers of real visitors ("[Pinterest/iOS]", "Viber/...", "YandexSearch/...")
+TRACK_BOT_UA_TOKENS = [
+    "telegrambot", "facebookexternalhit", "facebookcatalog", "twitterbot", "discordbot", "slackbot",
+    "linkedinbot", "pinterestbot", "googlebot", "bingbot", "yandexbot", "yandex.com/bots", "baiduspider",
+    "duckduckbot", "applebot", "embedly", "quora link preview", "outbrain", "vkshare", "skypeuripreview",
+]
+
+# Link-preview bots plus generic crawlers, HTTP libraries and headless browsers;
+# WhatsApp and Viber link previews send the bare app name as the whole user agent
+TRACK_BOT_UA_PATTERN = re.compile(
+    "|".join([re.escape(bot) for bot in TRACK_BOT_UA_TOKENS] + [
+        r"^whatsapp/", r"^viber(?:/|$)",
+        r"(?:^|[^a-z])(?:bot|crawler|spider|scraper)(?:[^a-z]|$)", r"[a-z]bot/", r"\+https?://",
+        r"crawl", r"slurp", r"headlesschrome", r"phantomjs", r"lighthouse", r"pingdom", r"uptimerobot",
+        r"python-requests", r"python-urllib", r"aiohttp", r"httpx", r"curl/", r"wget/", r"go-http-client",
+        r"java/", r"libwww-perl", r"okhttp/", r"axios/", r"node-fetch", r"scrapy", r"feedfetcher", r"preview",
+    ]),
+    re.IGNORECASE
+)
+
+def is_prefetch(request: Optional[Request]) -> bool:
+    """Browser prefetch/prerender requests, which a visitor may never see"""
+    if not request:
+        return False
+    purpose = request.headers.get("sec-purpose") or request.headers.get("purpose") or request.headers.get("x-purpose") or ""
+    return "prefetch" in purpose.lower() or request.headers.get("x-moz", "").lower() == "prefetch"
+
+class DedupWindow:
+    """
+    Was the same key seen within the last `window` seconds? Two time buckets
+    of `window` seconds each (current and previous) of 64-bit key hashes, so
+    a key is remembered for between one and two windows. Each bucket keeps
+    at most `max_keys`; past that, new keys pass through unrecorded.
+    """
+    def __init__(self, window: float, max_keys: int):
+        self.window = window
+        self.max_keys = max_keys
+        self.overflow = 0
+        self._bucket = 0
+        self._current = set()
+        self._previous = set()
+
+    def seen(self, key: tuple, now: Optional[float] = None) -> bool:
+        bucket = int((now if now is not None else time.monotonic()) // self.window)
+        if bucket != self._bucket:
+            self._previous = self._current if bucket == self._bucket + 1 else set()
+            self._current = set()
+            self._bucket = bucket
+        digest = hash(key)
+        if digest in self._current or digest in self._previous:
+            return True
+        if len(self._current) < self.max_keys:
+            self._current.add(digest)
+        else:
+            self.overflow += 1
+        return False
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+class IngestFilter:
+    """
+    Bot and duplicate filtering for the pipeline's validate stage. Returns a
+    drop reason, or None to keep the event (bots are marked in "flag" mode).
+    Duplicates: same kind, target and client (IP hash + user agent) within
+    the dedup window; state is per worker.
+    """
+    def __init__(self, bot_mode: str, dedup_window: float, dedup_max_keys: int):
+        if bot_mode not in TRACK_BOT_MODES:
+            raise ValueError(f"TRACK_BOT_MODE must be one of {', '.join(TRACK_BOT_MODES)}, got {bot_mode!r}")
+        self.bot_mode = bot_mode
+        self.dedup = DedupWindow(dedup_window, dedup_max_keys) if dedup_window > 0 else None
+        self.flagged = 0
+
+    def check(self, event: TrackingEvent) -> Optional[str]:
+        if event.prefetch:
+            return "prefetch"
+        if self.bot_mode != "off":
+            if not event.user_agent:
+                return "empty_user_agent"
+            if TRACK_BOT_UA_PATTERN.search(event.user_agent):
+                if self.bot_mode == "drop":
+                    return "bot"
+                event.bot = True
+                # Not counted anywhere, so there's no point resolving its geo
+                event.geo_pending = False
+                self.flagged += 1
+        if self.dedup is not None and event.ip_hash:
+            target = event.link_id if event.kind == "click" else event.page_id
+            if self.dedup.seen((event.kind, target, event.share_type, event.ip_hash, event.user_agent)):
+                return "duplicate"
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "bot_mode": self.bot_mode,
+            "flagged_bots": self.flagged,
+            "dedup_window_seconds": self.dedup.window if self.dedup else 0,
+            "dedup_keys": len(self.dedup) if self.dedup else 0,
+            "dedup_overflow": self.dedup.overflow if self.dedup else 0
+        }
+
+# Flood detection: per-IP and per-target event rates over a sliding window.
+# Events from an IP over its limit are quarantined (kept out of the event
+# collections, counters and geo lookups) into the capped quarantined_events
+# collection. A target over its limit is only flagged as a burst for review:
+# a viral link looks the same, so its events are still counted.
+TRACK_FLOOD_WINDOW_SECONDS = float(os.environ.get('TRACK_FLOOD_WINDOW_SECONDS', '60'))
+TRACK_FLOOD_IP_MAX_EVENTS = int(os.environ.get('TRACK_FLOOD_IP_MAX_EVENTS', '120'))
+TRACK_FLOOD_TARGET_MAX_EVENTS = int(os.environ.get('TRACK_FLOOD_TARGET_MAX_EVENTS', '5000'))
+TRACK_FLOOD_MAX_KEYS = int(os.environ.get('TRACK_FLOOD_MAX_KEYS', '100000'))
+QUARANTINE_CAPPED_BYTES = int(os.environ.get('QUARANTINE_CAPPED_BYTES', str(64 * 1024 * 1024)))
+
+class SlidingWindowRate:
+    """
+    Approximate sliding-window counts per key in bounded memory: each key
+    keeps the current and previous fixed window, the previous one weighted by
+    how much of it still overlaps the sliding window. Least recently seen
+    keys are evicted past `max_keys`.
+    """
+    def __init__(self, window: float, max_keys: int):
+        self.window = window
+        self.max_keys = max_keys
+        self.evictions = 0
+        self._counts = OrderedDict()  # key -> [window index, previous, current]
+
+    def hit(self, key, now: Optional[float] = None) -> float:
+        """Count one event and return the key's rate over the last window"""
+        now = now if now is not None else time.monotonic()
+        index, offset = divmod(now, self.window)
+        entry = self._counts.get(key)
+        if entry is None:
+            entry = self._counts[key] = [index, 0, 0]
+            if len(self._counts) > self.max_keys:
+                self._counts.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._counts.move_to_end(key)
+            if index != entry[0]:
+                entry[1] = entry[2] if index == entry[0] + 1 else 0
+                entry[2] = 0
+                entry[0] = index
+        entry[2] += 1
+        return entry[1] * (1 - offset / self.window) + entry[2]
+
+    def __len__(self):
+        return len(self._counts)
+
+class FloodDetector:
+    """Quarantines events from IPs over the limit; flags bursts to targets over the limit"""
+    MAX_BURSTS = 1000
+
+    def __init__(self, window: float, ip_max: int, target_max: int, max_keys: int):
+        self.ip_max = ip_max
+        self.target_max = target_max
+        self.ip_rates = SlidingWindowRate(window, max_keys)
+        self.target_rates = SlidingWindowRate(window, max_keys)
+        # Active/recent bursts on this worker: (reason, key) -> summary
+        self.bursts = OrderedDict()
+        self.flagged = 0
+
+    def check(self, event: TrackingEvent, now: Optional[float] = None) -> Optional[str]:
+        """Return the quarantine reason, or None if the event is kept"""
+        if event.ip_hash and self.ip_rates.hit(event.ip_hash, now) > self.ip_max:
+            self._burst("ip_flood", event.ip_hash, event)
+            return "ip_flood"
+        # Only events that passed the IP check count towards the target, so a
+        # flooding IP can't push a link's real visitors over the limit
+        target = f"{event.kind}:{event.link_id if event.kind == 'click' else event.page_id}"
+        if self.target_rates.hit(target, now) > self.target_max:
+            self._burst("target_burst", target, event)
+            self.flagged += 1
+        return None
+
+    def _burst(self, reason: str, key: str, event: TrackingEvent):
+        burst = self.bursts.get((reason, key))
+        if burst is None:
+            burst = self.bursts[(reason, key)] = {
+                "reason": reason, "key": key, "page_id": event.page_id,
+                "started_at": event.timestamp, "events": 0
+            }
+            if len(self.bursts) > self.MAX_BURSTS:
+                self.bursts.popitem(last=False)
+        else:
+            self.bursts.move_to_end((reason, key))
+        burst["events"] += 1
+        burst["last_at"] = event.timestamp
+
+    def stats(self) -> dict:
+        return {
+            "ip_keys": len(self.ip_rates),
+            "target_keys": len(self.target_rates),
+            "evictions": self.ip_rates.evictions + self.target_rates.evictions,
+            "bursts": len(self.bursts),
+            "flagged_target_events": self.flagged
+        }
+
+class QuarantineWriter(BatchingQueue):
+    """Quarantined events, written in batches into a capped collection (dropped when the queue is full)"""
+    async def _write(self, batch: list):
+        docs = []
+        for event, reason in batch:
+            doc = event.to_document()
+            doc.pop("geo_pending", None)
+            docs.append({**doc, "kind": event.kind, "reason": reason, "user_agent": event.user_agent[:300]})
+        try:
+            await db.quarantined_events.insert_many(docs, ordered=False)
+            self.written += len(docs)
+        except Exception as e:
+            self.failed += len(docs)
+            logging.error(f"Quarantine write failed ({len(docs)} events): {e}")
+
+async def ensure_quarantine_collection():
+    existing = await db.list_collection_names(filter={"name": "quarantined_events"})
+    if not existing:
+        try:
+            await db.create_collection("quarantined_events", capped=True, size=QUARANTINE_CAPPED_BYTES)
+        except CollectionInvalid:
+            pass  # Created concurrently by another worker
+
+quarantine = QuarantineWriter(10000, 500, 2)
+
+class TrackingPipeline(BatchingQueue):
+    """
+    Validation and sampling run inline in the request (cheap, synchronous);
+    everything that touches storage runs in the batch writer.
+    """
+    def __init__(self, max_size: int, batch_size: int, batch_wait: float, sinks: list, sample_rate: float = 1.0,
+                 ingest_filter: Optional[IngestFilter] = None, flood_detector: Optional[FloodDetector] = None):
+        super().__init__(max_size, batch_size, batch_wait)
+        self.sinks = sinks
+        self.sample_rate = sample_rate
+        self.ingest_filter = ingest_filter
+        self.flood_detector = flood_detector
+        self.rejected = {}
+        self.dropped = {}
+        self.quarantined = {}
+        self.sampled_out = 0
+        self.sink_errors = {sink.name: 0 for sink in sinks}
+        self.accepted_by_kind = {kind: 0 for kind in EVENT_COLLECTIONS}
+
+    def validate(self, event: TrackingEvent) -> Optional[str]:
+        """Return a rejection reason, or None if the event is valid"""
+        if event.kind not in EVENT_COLLECTIONS:
+            return "unknown_kind"
+        if not event.page_id:
+            return "missing_page_id"
+        if event.kind == "click" and not event.link_id:
+            return "missing_link_id"
+        if event.kind == "share" and event.share_type not in SHARE_TYPES:
+            return "invalid_share_type"
+        return None
+
+    def track(self, event: TrackingEvent) -> bool:
+        """Run the inline stages and enqueue; False if the event was not accepted"""
+        reason = self.validate(event)
+        if reason:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            return False
+        if self.ingest_filter:
+            reason = self.ingest_filter.check(event)
+            if reason:
+                self.dropped[reason] = self.dropped.get(reason, 0) + 1
+                return False
+        if self.flood_detector and not event.bot:
+            reason = self.flood_detector.check(event)
+            if reason:
+                self.quarantined[reason] = self.quarantined.get(reason, 0) + 1
+                quarantine.submit((event, reason))
+                return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        if not self.submit(event):
+            return False
+        self.accepted_by_kind[event.kind] += 1
+        return True
+
+    async def _write(self, batch: list):
+        # Derived sinks (counters, rollups, ...) only see events the primary sink stored,
+        # so they never drift from the raw events; flagged bot events are stored, never counted
+        stored = batch
+        for sink in self.sinks:
+            primary = getattr(sink, "primary", False)
+            events = stored if getattr(sink, "stores_flagged", False) else [e for e in stored if not e.bot]
+            if not events:
+                continue
+            try:
+                result = await sink.write(events)
+                failed = len(events) - len(result) if primary else 0
+            except Exception as e:
+                result, failed = [], len(events)
+                logging.error(f"Tracking sink {sink.name} failed ({len(events)} events): {e}")
+            self.sink_errors[sink.name] += failed
+            if primary:
+                stored = result
+        self.written += len(stored)
+        self.failed += len(batch) - len(stored)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "accepted_by_kind": self.accepted_by_kind,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "filter": self.ingest_filter.stats() if self.ingest_filter else None,
+            "quarantined": self.quarantined,
+            "flood": self.flood_detector.stats() if self.flood_detector else None,
+            "quarantine_writer": quarantine.stats(),
+            "sampled_out": self.sampled_out,
+            "sample_rate": self.sample_rate,
+            "sink_errors": self.sink_errors,
+            "sinks": {sink.name: sink.stats() for sink in self.sinks}
+        }
+
+def build_tracking_sinks() -> list:
+    sinks = [MongoEventSink(), CounterSink(), RollupSink(), HourlyRollupSink(), HeavyHittersSink(), VisitorSink()]
+    if TRACK_EVENT_LOG_PATH:
+        sinks.append(NDJSONLogSink(TRACK_EVENT_LOG_PATH))
+    return sinks
+
+tracking = TrackingPipeline(
+    TRACK_QUEUE_MAX_SIZE, TRACK_BATCH_SIZE, TRACK_BATCH_WAIT_SECONDS,
+    sinks=build_tracking_sinks(),
+    sample_rate=TRACK_SAMPLE_RATE,
+    ingest_filter=IngestFilter(TRACK_BOT_MODE, TRACK_DEDUP_WINDOW_SECONDS, TRACK_DEDUP_MAX_KEYS),
+    flood_detector=FloodDetector(
+        TRACK_FLOOD_WINDOW_SECONDS, TRACK_FLOOD_IP_MAX_EVENTS, TRACK_FLOOD_TARGET_MAX_EVENTS, TRACK_FLOOD_MAX_KEYS
+    )
+)
+
+class _BenchmarkSink:
+    name = "benchmark"
+
+    def __init__(self):
+        self.written = 0
+
+    async def write(self, events: list):
+        self.written += len(events)
+        for e in events:
+            e.to_document()
+
+    def stats(self) -> dict:
+        return {"written": self.written}
+
+async def benchmark_tracking_pipeline(events: int = 100000, batch_size: int = TRACK_BATCH_SIZE) -> dict:
+    """Measure pipeline throughput (validation, queueing, batching, document building) without storage"""
+    sink = _BenchmarkSink()
+    pipeline = TrackingPipeline(events, batch_size, 0.05, sinks=[sink])
+    started = time.perf_counter()
+    writer = asyncio.create_task(pipeline.run())
+    for i in range(events):
+        pipeline.track(TrackingEvent(
+            kind=("click", "view", "share", "qr")[i % 4],
+            page_id=f"page-{i % 100}",
+            timestamp=utc_now(),
+            ip_hash=hash_client_ip(f"10.0.{i % 256}.{i % 250}"),
+            link_id=f"link-{i % 500}",
+            share_type="link"
+        ))
+    while sink.written < sum(pipeline.accepted_by_kind.values()):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    writer.cancel()
+    await asyncio.gather(writer, return_exceptions=True)
+    return {
+        "events": events,
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(events / elapsed) if elapsed else None
+    }
+
 # ===================== AUTH ROUTES =====================
 
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -956,12 +4010,17 @@ async def delete_account(user: dict = Depends(get_current_user)):
         await db.clicks.delete_many({"page_id": {"$in": page_ids}})
         await db.views.delete_many({"page_id": {"$in": page_ids}})
         await db.shares.delete_many({"page_id": {"$in": page_ids}})
+        await rollups.delete_pages(page_ids)
+        await unique_visitors.delete_pages(page_ids)
+        await heavy_hitters.delete_pages(page_ids)
+        await hourly_rollups.delete_pages(page_ids)
     
     # Delete pages
     await db.pages.delete_many({"user_id": user_id})
     
     # Delete user
     await db.users.delete_one({"id": user_id})
+    await invalidate_public_page_cache("user", user_id)
     
     return {"message": "Аккаунт и все связанные данные удалены"}
 
@@ -974,6 +4033,7 @@ async def toggle_site_navigation(data: dict, user: dict = Depends(get_current_us
         {"id": user["id"]},
         {"$set": {"site_navigation_enabled": enabled}}
     )
+    await invalidate_public_page_cache("user", user["id"])
     
     return {"enabled": enabled, "message": "Настройка сохранена"}
 
@@ -1031,6 +4091,7 @@ async def update_contact_info(data: ContactInfoUpdate, user: dict = Depends(get_
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
     
     await db.users.update_one({"id": user["id"]}, {"$set": update_data})
+    await invalidate_public_page_cache("user", user["id"])
     
     return {"message": "Контактная информация обновлена"}
 
@@ -1111,6 +4172,7 @@ async def toggle_verification_badge(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$set": {"show_verification_badge": not current}}
     )
+    await invalidate_public_page_cache("user", user["id"])
     return {"show_badge": not current}
 
 # ===================== NOTIFICATIONS ROUTES =====================
@@ -1122,6 +4184,8 @@ async def get_notifications(user: dict = Depends(get_current_user)):
         {"user_id": user["id"]},
         {"_id": 0}
     ).sort("created_at", -1).limit(50).to_list(50)
+    for notification in notifications:
+        serialize_timestamps(notification, ("created_at",))
     
     unread_count = await db.notifications.count_documents({
         "user_id": user["id"],
@@ -1230,6 +4294,7 @@ async def update_page(page_id: str, data: PageUpdate, user: dict = Depends(get_c
     
     if update_data:
         await db.pages.update_one({"id": page_id}, {"$set": update_data})
+        await invalidate_public_page_cache("page", page_id)
     
     updated = await db.pages.find_one({"id": page_id}, {"_id": 0})
     return updated
@@ -1244,6 +4309,11 @@ async def delete_page(page_id: str, user: dict = Depends(get_current_user)):
     # Delete associated links and clicks
     await db.links.delete_many({"page_id": page_id})
     await db.clicks.delete_many({"page_id": page_id})
+    await rollups.delete_pages([page_id])
+    await unique_visitors.delete_pages([page_id])
+    await heavy_hitters.delete_pages([page_id])
+    await hourly_rollups.delete_pages([page_id])
+    await invalidate_public_page_cache("page", page_id)
     
     return {"message": "Page deleted"}
 
@@ -1279,6 +4349,7 @@ async def create_link(page_id: str, data: LinkCreate, user: dict = Depends(get_c
     
     await db.links.insert_one(link)
     link.pop("_id", None)
+    await invalidate_public_page_cache("page", page_id)
     return link
 
 @api_router.put("/pages/{page_id}/links/reorder")
@@ -1292,6 +4363,7 @@ async def reorder_links(page_id: str, data: LinkReorder, user: dict = Depends(ge
             {"id": link_id, "page_id": page_id},
             {"$set": {"order": index}}
         )
+    await invalidate_public_page_cache("page", page_id)
     
     # Return updated links in new order
     links = await db.links.find({"page_id": page_id}, {"_id": 0}).sort("order", 1).to_list(100)
@@ -1305,6 +4377,7 @@ async def update_link(page_id: str, link_id: str, data: LinkUpdate, user: dict =
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
         await db.links.update_one({"id": link_id, "page_id": page_id}, {"$set": update_data})
+        await invalidate_public_page_cache("page", page_id)
     
     updated = await db.links.find_one({"id": link_id}, {"_id": 0})
     return updated
@@ -1317,6 +4390,7 @@ async def delete_link(page_id: str, link_id: str, user: dict = Depends(get_curre
     result = await db.links.delete_one({"id": link_id, "page_id": page_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Link not found")
+    await invalidate_public_page_cache("page", page_id)
     
     return {"message": "Link deleted"}
 
@@ -1476,39 +4550,23 @@ async def share_link_with_og(slug: str, request: Request):
 # ===================== PUBLIC ROUTES =====================
 
 @api_router.get("/artist/{slug}")
-async def get_public_page(slug: str):
-    page = await db.pages.find_one({"slug": slug, "status": "active"}, {"_id": 0})
-    if not page:
-        raise HTTPException(status_code=404, detail="Page not found")
-    
-    # Increment view count
-    await db.pages.update_one({"slug": slug}, {"$inc": {"views": 1}})
-    
-    links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
-    page["links"] = links
+async def get_public_page(slug: str, request: Request = None):
+    page = _public_page_cache.get(slug)
+    if page is None:
+        generation = _public_page_cache.generation
+        page = await build_public_page_payload(slug)
+        if not page:
+            raise HTTPException(status_code=404, detail="Page not found")
+        _public_page_cache.set(slug, page, generation=generation)
+    
+    # Increment view count (buffered) and record the visitor
+    counter_buffer.incr("pages", page["id"], "views")
+    unique_visitors.observe_request(page["id"], request)
+    
+    # Keep the cached counter moving between refills
     page["views"] = page.get("views", 0) + 1
     
-    # Get user info (verification, site navigation, plan features, and contact info)
-    user = await db.users.find_one({"id": page["user_id"]}, {"_id": 0, "verified": 1, "show_verification_badge": 1, "site_navigation_enabled": 1, "plan": 1, "contact_email": 1, "social_links": 1})
-    if user:
-        page["user_verified"] = user.get("verified", False) and user.get("show_verification_badge", True)
-        page["site_navigation_enabled"] = user.get("site_navigation_enabled", False)
-        
-        # Add contact info for public page
-        page["contact_email"] = user.get("contact_email", "")
-        page["social_links"] = user.get("social_links", {})
-        
-        # Get plan config for branding removal
-        plan_config = await get_plan_config(user.get("plan", "free"))
-        page["can_remove_branding"] = plan_config.get("can_remove_branding", False)
-    else:
-        page["user_verified"] = False
-        page["site_navigation_enabled"] = False
-        page["can_remove_branding"] = False
-        page["contact_email"] = ""
-        page["social_links"] = {}
-    
-    return page
+    return {**page}
 
 @api_router.get("/click/{link_id}")
 async def track_click(
@@ -1516,193 +4574,367 @@ async def track_click(
     referrer: Optional[str] = None,
     request: Request = None
 ):
-    link = await db.links.find_one({"id": link_id}, {"_id": 0})
+    link = await db.links.find_one({"id": link_id}, {"_id": 0, "url": 1, "page_id": 1})
     if not link:
         raise HTTPException(status_code=404, detail="Link not found")
     
-    # Get geo info from IP
-    country = "Неизвестно"
-    city = "Неизвестно"
-    if request:
-        # First try CDN headers (Cloudflare, etc.)
-        country = request.headers.get("CF-IPCountry", "")
-        city = request.headers.get("CF-IPCity", "")
-        
-        # If no CDN headers, use IP geolocation
-        if not country or country == "Unknown":
-            client_ip = get_client_ip(request)
-            geo = await get_geo_from_ip(client_ip)
-            country = geo["country"]
-            city = geo["city"]
-    
-    # Track click with geo data
-    click = {
-        "id": str(uuid.uuid4()),
-        "link_id": link_id,
-        "page_id": link["page_id"],
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "referrer": referrer,
-        "country": country,
-        "city": city,
-        "source": "link"
-    }
-    await db.clicks.insert_one(click)
-    
-    # Increment click count
-    await db.links.update_one({"id": link_id}, {"$inc": {"clicks": 1}})
+    # Writes, counters and geo enrichment happen in the tracking pipeline
+    tracking.track(TrackingEvent.from_request("click", link["page_id"], request, link_id=link_id, referrer=referrer))
     
     return RedirectResponse(url=link["url"], status_code=302)
 
 # Track page view with geo
 @api_router.post("/track/view/{page_id}")
 async def track_page_view(page_id: str, request: Request = None):
-    page = await db.pages.find_one({"id": page_id})
+    page = await db.pages.find_one({"id": page_id}, {"_id": 0, "id": 1})
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    country = "Неизвестно"
-    city = "Неизвестно"
-    if request:
-        # First try CDN headers
-        country = request.headers.get("CF-IPCountry", "")
-        city = request.headers.get("CF-IPCity", "")
-        
-        # If no CDN headers, use IP geolocation
-        if not country or country == "Unknown":
-            client_ip = get_client_ip(request)
-            geo = await get_geo_from_ip(client_ip)
-            country = geo["country"]
-            city = geo["city"]
-    
-    view = {
-        "id": str(uuid.uuid4()),
-        "page_id": page_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "country": country,
-        "city": city,
-        "source": "direct"
-    }
-    await db.views.insert_one(view)
-    
+    tracking.track(TrackingEvent.from_request("view", page_id, request))
+    
     return {"success": True}
 
 # Track share
 @api_router.post("/track/share/{page_id}")
 async def track_share(page_id: str, share_type: str = "link", request: Request = None):
-    page = await db.pages.find_one({"id": page_id})
+    if share_type not in SHARE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid share_type. Valid types: {sorted(SHARE_TYPES)}")
+    page = await db.pages.find_one({"id": page_id}, {"_id": 0, "id": 1})
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    country = "Неизвестно"
-    city = "Неизвестно"
-    if request:
-        # First try CDN headers
-        country = request.headers.get("CF-IPCountry", "")
-        city = request.headers.get("CF-IPCity", "")
-        
-        # If no CDN headers, use IP geolocation
-        if not country or country == "Unknown":
-            client_ip = get_client_ip(request)
-            geo = await get_geo_from_ip(client_ip)
-            country = geo["country"]
-            city = geo["city"]
-    
-    share = {
-        "id": str(uuid.uuid4()),
-        "page_id": page_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "type": share_type,  # "link", "qr", "social"
-        "country": country,
-        "city": city
-    }
-    await db.shares.insert_one(share)
-    
-    # Increment share count on page
-    await db.pages.update_one({"id": page_id}, {"$inc": {"shares": 1, f"shares_{share_type}": 1}})
+    tracking.track(TrackingEvent.from_request("share", page_id, request, share_type=share_type))
     
     return {"success": True}
 
 # Track QR scan
 @api_router.get("/qr/{page_id}")
 async def track_qr_scan(page_id: str, request: Request = None):
-    page = await db.pages.find_one({"id": page_id, "status": "active"}, {"_id": 0})
+    page = await db.pages.find_one({"id": page_id, "status": "active"}, {"_id": 0, "slug": 1})
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    country = "Неизвестно"
-    city = "Неизвестно"
-    if request:
-        # First try CDN headers
-        country = request.headers.get("CF-IPCountry", "")
-        city = request.headers.get("CF-IPCity", "")
-        
-        # If no CDN headers, use IP geolocation
-        if not country or country == "Unknown":
-            client_ip = get_client_ip(request)
-            geo = await get_geo_from_ip(client_ip)
-            country = geo["country"]
-            city = geo["city"]
-    
-    # Track QR scan as a share
-    share = {
-        "id": str(uuid.uuid4()),
-        "page_id": page_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "type": "qr",
-        "country": country,
-        "city": city
-    }
-    await db.shares.insert_one(share)
-    
-    # Increment QR scan count
-    await db.pages.update_one({"id": page_id}, {"$inc": {"qr_scans": 1}})
+    # Tracked as a share of type "qr"
+    tracking.track(TrackingEvent.from_request("qr", page_id, request))
     
     # Redirect to public page
     return RedirectResponse(url=f"/{page['slug']}", status_code=302)
 
+# ===================== LIVE ANALYTICS =====================
+# Server-Sent Events stream of counter deltas for the user's pages, so an open
+# analytics page doesn't have to poll. Every counter increment (views, link
+# clicks, shares, QR scans) goes through the counter buffer, which hands it to
+# `live_analytics`: local streams get it right away, and the worker batches
+# what it saw into one cluster event per LIVE_PUBLISH_INTERVAL_SECONDS for the
+# streams held by other workers. A slow client never queues events: deltas
+# are merged into the stream's pending state (bounded by its pages and links)
+# and sent as one message once the connection accepts more. Streams per user
+# are capped cluster-wide through heartbeat slots in live_streams.
+#
+# EventSource can't send headers: the client first gets a short-lived,
+# stream-only token from POST /analytics/live/token and passes that as
+# ?token= (the long-lived login token is never put in a URL, where access
+# logs would keep it).
+# Registered before /analytics/{page_id}, which would otherwise match "live".
+
+LIVE_PUBLISH_INTERVAL_SECONDS = float(os.environ.get('LIVE_PUBLISH_INTERVAL_SECONDS', '1'))
+LIVE_MAX_STREAMS_PER_USER = int(os.environ.get('LIVE_MAX_STREAMS_PER_USER', '3'))
+LIVE_HEARTBEAT_SECONDS = float(os.environ.get('LIVE_HEARTBEAT_SECONDS', '15'))
+LIVE_MIN_SEND_INTERVAL_SECONDS = float(os.environ.get('LIVE_MIN_SEND_INTERVAL_SECONDS', '0.5'))
+LIVE_TOKEN_TTL_SECONDS = int(os.environ.get('LIVE_TOKEN_TTL_SECONDS', '60'))
+LIVE_TOKEN_SCOPE = "live_stream"
+
+# (counter collection, field) -> delta name
+LIVE_FIELDS = {
+    ("pages", "views"): "views",
+    ("pages", "shares"): "shares",
+    ("pages", "qr_scans"): "qr",
+    ("links", "clicks"): "clicks",
+}
+
+class LiveStream:
+    """One SSE connection: pending deltas per page, merged until sent"""
+    def __init__(self, user_id: str, page_ids: list, link_pages: dict):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.page_ids = page_ids
+        self.link_pages = link_pages
+        self.pending = {}
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.merged = 0
+
+    def push(self, collection: str, doc_id: str, field: str, amount: int):
+        if collection == "links":
+            delta = self.pending.setdefault(self.link_pages[doc_id], {})
+            clicks = delta.setdefault("clicks", {})
+            clicks[doc_id] = clicks.get(doc_id, 0) + amount
+        else:
+            delta = self.pending.setdefault(doc_id, {})
+            name = LIVE_FIELDS[(collection, field)]
+            delta[name] = delta.get(name, 0) + amount
+        if self.ready.is_set():
+            self.merged += 1
+        self.ready.set()
+
+    def take(self) -> dict:
+        pending, self.pending = self.pending, {}
+        self.ready.clear()
+        self.sent += 1
+        return pending
+
+class LiveAnalytics:
+    def __init__(self, publish_interval: float, max_streams_per_user: int):
+        self.publish_interval = publish_interval
+        self.max_streams_per_user = max_streams_per_user
+        self.streams = set()
+        self.rejected = 0
+        self.published = 0
+        self.received = 0
+        # Increments seen by this worker, not yet sent to the others
+        self._outbox = {}
+        # (collection, id) -> streams interested in it
+        self._targets = {}
+        # Streams open anywhere in the cluster, refreshed by run()
+        self._cluster_streams = 0
+
+    def record(self, collection: str, doc_id: str, field: str, amount: int):
+        """Counter buffer listener: called for every increment"""
+        if (collection, field) not in LIVE_FIELDS:
+            return
+        self._dispatch(collection, doc_id, field, amount)
+        if self._cluster_streams > len(self.streams):
+            key = (collection, doc_id, field)
+            self._outbox[key] = self._outbox.get(key, 0) + amount
+
+    def _dispatch(self, collection: str, doc_id: str, field: str, amount: int):
+        for stream in self._targets.get((collection, doc_id), ()):
+            stream.push(collection, doc_id, field, amount)
+
+    def receive(self, payload: dict):
+        """Deltas published by another worker"""
+        for collection, doc_id, name, amount in payload.get("deltas", []):
+            self._dispatch(collection, doc_id, name, amount)
+        self.received += 1
+
+    async def _acquire_slot(self, stream: LiveStream) -> bool:
+        now = utc_now()
+        await db.live_streams.insert_one({
+            "_id": stream.id,
+            "user_id": stream.user_id,
+            "worker": WORKER_ID,
+            "expires_at": now + timedelta(seconds=LIVE_HEARTBEAT_SECONDS * 2)
+        })
+        # Insert first, then count: two concurrent connects can't both squeeze in
+        open_streams = await db.live_streams.count_documents({"user_id": stream.user_id, "expires_at": {"$gt": now}})
+        if open_streams > self.max_streams_per_user:
+            await db.live_streams.delete_one({"_id": stream.id})
+            return False
+        return True
+
+    async def heartbeat(self, stream: LiveStream):
+        await db.live_streams.update_one(
+            {"_id": stream.id},
+            {"$set": {"expires_at": utc_now() + timedelta(seconds=LIVE_HEARTBEAT_SECONDS * 2)}}
+        )
+
+    async def subscribe(self, user_id: str, page_ids: list, link_pages: dict) -> Optional[LiveStream]:
+        stream = LiveStream(user_id, page_ids, link_pages)
+        if not await self._acquire_slot(stream):
+            self.rejected += 1
+            return None
+        self.streams.add(stream)
+        for target in [("pages", p) for p in page_ids] + [("links", l) for l in link_pages]:
+            self._targets.setdefault(target, set()).add(stream)
+        self._cluster_streams += 1
+        return stream
+
+    def unsubscribe(self, stream: LiveStream):
+        """Detach a closed stream; its slot is released by release_slot() or expires with its heartbeat"""
+        self.streams.discard(stream)
+        for target in [("pages", p) for p in stream.page_ids] + [("links", l) for l in stream.link_pages]:
+            streams = self._targets.get(target)
+            if streams is not None:
+                streams.discard(stream)
+                if not streams:
+                    del self._targets[target]
+        self._cluster_streams = max(0, self._cluster_streams - 1)
+
+    async def release_slot(self, stream: LiveStream):
+        await db.live_streams.delete_one({"_id": stream.id})
+
+    async def run(self):
+        """Publish this worker's increments to the others; refresh the cluster stream count"""
+        refresh_every = max(1, int(LIVE_HEARTBEAT_SECONDS / self.publish_interval))
+        ticks = 0
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            try:
+                if ticks % refresh_every == 0:
+                    self._cluster_streams = await db.live_streams.count_documents({"expires_at": {"$gt": utc_now()}})
+                ticks += 1
+                if not self._outbox:
+                    continue
+                outbox, self._outbox = self._outbox, {}
+                deltas = [[c, doc_id, f, n] for (c, doc_id, f), n in outbox.items()]
+                for i in range(0, len(deltas), 1000):
+                    await publish_cluster_event("live_deltas", {"deltas": deltas[i:i + 1000]})
+                self.published += 1
+            except Exception as e:
+                logging.warning(f"Live analytics publish failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self.streams),
+            "cluster_streams": self._cluster_streams,
+            "rejected": self.rejected,
+            "published": self.published,
+            "received": self.received,
+            "merged_deltas": sum(s.merged for s in self.streams)
+        }
+
+live_analytics = LiveAnalytics(LIVE_PUBLISH_INTERVAL_SECONDS, LIVE_MAX_STREAMS_PER_USER)
+counter_buffer.listeners.append(live_analytics.record)
+
+@on_cluster_event("live_deltas")
+def _on_live_deltas(payload: dict):
+    live_analytics.receive(payload)
+
+def sse_message(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+def create_stream_token(user_id: str) -> str:
+    payload = {
+        "user_id": user_id,
+        "scope": LIVE_TOKEN_SCOPE,
+        "exp": datetime.now(timezone.utc) + timedelta(seconds=LIVE_TOKEN_TTL_SECONDS)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+async def get_stream_user(authorization: str = Header(None), token: Optional[str] = None):
+    """Login token in the header, or a stream token (only checked when the stream opens) as ?token="""
+    if authorization or not token:
+        return await get_current_user(authorization)
+    payload = decode_token(token)
+    if payload.get("scope") != LIVE_TOKEN_SCOPE:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return await get_token_user(payload)
+
+@api_router.post("/analytics/live/token")
+async def create_live_stream_token(user: dict = Depends(get_current_user)):
+    """Short-lived token for opening /analytics/live with EventSource"""
+    return {"token": create_stream_token(user["id"]), "expires_in": LIVE_TOKEN_TTL_SECONDS}
+
+@api_router.get("/analytics/live")
+async def stream_live_analytics(request: Request, page_id: Optional[str] = None, user: dict = Depends(get_stream_user)):
+    """SSE: a `snapshot` of the current counters, then `delta` events as they change"""
+    page_query = {"user_id": user["id"], **({"id": page_id} if page_id else {})}
+    pages = await db.pages.find(page_query, {"_id": 0, "id": 1, "views": 1, "shares": 1, "qr_scans": 1}).to_list(100)
+    if page_id and not pages:
+        raise HTTPException(status_code=404, detail="Page not found")
+    page_ids = [p["id"] for p in pages]
+    links = await db.links.find({"page_id": {"$in": page_ids}}, {"_id": 0, "id": 1, "page_id": 1, "clicks": 1}).to_list(1000)
+    stream = await live_analytics.subscribe(user["id"], page_ids, {link["id"]: link["page_id"] for link in links})
+    if stream is None:
+        raise HTTPException(status_code=429, detail="Слишком много открытых окон аналитики")
+    
+    snapshot = {p["id"]: {
+        "views": p.get("views", 0),
+        "shares": p.get("shares", 0),
+        "qr": p.get("qr_scans", 0),
+        "clicks": {link["id"]: link.get("clicks", 0) for link in links if link["page_id"] == p["id"]}
+    } for p in pages}
+    
+    async def events():
+        cancelled = False
+        try:
+            yield "retry: 3000\n\n"
+            yield sse_message("snapshot", {"pages": snapshot})
+            last_heartbeat = time.monotonic()
+            while not await request.is_disconnected():
+                try:
+                    await asyncio.wait_for(stream.ready.wait(), LIVE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                else:
+                    yield sse_message("delta", {"pages": stream.take()})
+                    # Let a burst pile up into the next message
+                    await asyncio.sleep(LIVE_MIN_SEND_INTERVAL_SECONDS)
+                if time.monotonic() - last_heartbeat >= LIVE_HEARTBEAT_SECONDS:
+                    await live_analytics.heartbeat(stream)
+                    last_heartbeat = time.monotonic()
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            live_analytics.unsubscribe(stream)
+            # A cancelled task can't await Mongo reliably: the slot expires with its heartbeat instead
+            if not cancelled:
+                await live_analytics.release_slot(stream)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # nginx: don't buffer the stream
+    })
+
 # ===================== ANALYTICS ROUTES =====================
 
+class QueryTimings:
+    """Per-query wall time (ms) for the analytics debug breakdown"""
+    def __init__(self):
+        self.timings = {}
+
+    async def timed(self, name: str, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    async def gather(self, **awaitables) -> dict:
+        """Run independent queries concurrently; results by name"""
+        results = await asyncio.gather(*(self.timed(name, aw) for name, aw in awaitables.items()))
+        return dict(zip(awaitables.keys(), results))
+
+async def _no_top_geo() -> dict:
+    return {"by_country": [], "by_city": []}
+
+async def _plan_has_advanced_analytics(user: dict) -> bool:
+    plan_config = await get_plan_config(user.get("plan", "free"))
+    return plan_config.get("has_advanced_analytics", False)
+
 @api_router.get("/analytics/{page_id}")
-async def get_page_analytics(page_id: str, user: dict = Depends(get_current_user)):
-    page = await db.pages.find_one({"id": page_id, "user_id": user["id"]}, {"_id": 0})
+async def get_page_analytics(page_id: str, debug: bool = False, granularity: Optional[str] = None,
+                             since: Optional[str] = None, until: Optional[str] = None, tz: Optional[str] = None,
+                             user: dict = Depends(get_current_user)):
+    """`granularity` (hour/day/week/month) adds a dense `series` for [since, until) in `tz`"""
+    timings = QueryTimings()
+    timeline = TimelineRequest(granularity, since, until, tz) if granularity else None
+    
+    # Page, its links and the plan are independent lookups
+    first = await timings.gather(
+        page=db.pages.find_one({"id": page_id, "user_id": user["id"]}, {"_id": 0}),
+        links=db.links.find({"page_id": page_id}, {"_id": 0}).to_list(100),
+        plan=_plan_has_advanced_analytics(user),
+        visitors=unique_visitors.count([page_id], analytics_since_day(30)),
+        visitors_today=unique_visitors.count([page_id], analytics_since_day(0))
+    )
+    page, links, has_advanced = first["page"], first["links"], first["plan"]
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    links = await db.links.find({"page_id": page_id}, {"_id": 0}).to_list(100)
-    
     total_clicks = sum(link.get("clicks", 0) for link in links)
     clicks_by_platform = {link["platform"]: link.get("clicks", 0) for link in links}
     
-    # Check if user has advanced analytics access
-    plan_config = await get_plan_config(user.get("plan", "free"))
-    has_advanced = plan_config.get("has_advanced_analytics", False)
-    
     by_country = []
     by_city = []
     
     # Only fetch detailed geo data for PRO users
     if has_advanced:
-        # Get clicks by country for this page
-        clicks_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": page_id}},
-            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in clicks_cursor:
-            by_country.append({"country": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-        
-        # Get clicks by city for this page
-        city_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": page_id}},
-            {"$group": {"_id": "$city", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in city_cursor:
-            by_city.append({"city": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
+        top = await timings.timed("top_geo", top_geo(f"page:{page_id}", {"page_id": page_id}))
+        by_country, by_city = top["by_country"], top["by_city"]
     
-    return {
+    response = {
         "page_id": page_id,
         "views": page.get("views", 0),
         "total_clicks": total_clicks,
@@ -1710,133 +4942,300 @@ async def get_page_analytics(page_id: str, user: dict = Depends(get_current_user
         "links": links,
         "shares": page.get("shares", 0),
         "qr_scans": page.get("qr_scans", 0),
+        "unique_visitors": first["visitors"],
+        "unique_visitors_today": first["visitors_today"],
         "by_country": by_country,
         "by_city": by_city,
         "has_advanced_analytics": has_advanced
     }
+    if timeline:
+        response["series"] = await timings.timed("series", timelines.series(f"page:{page_id}", [page_id], timeline))
+    if debug:
+        response["timings_ms"] = timings.timings
+    return response
 
 # Global analytics for all user pages
 @api_router.get("/analytics/global/summary")
-async def get_global_analytics(user: dict = Depends(get_current_user)):
-    # Check if user has advanced analytics access
-    plan_config = await get_plan_config(user.get("plan", "free"))
-    has_advanced = plan_config.get("has_advanced_analytics", False)
-    
-    # Get all user pages
-    pages = await db.pages.find({"user_id": user["id"]}, {"_id": 0}).to_list(100)
+async def get_global_analytics(debug: bool = False, granularity: Optional[str] = None,
+                               since: Optional[str] = None, until: Optional[str] = None, tz: Optional[str] = None,
+                               user: dict = Depends(get_current_user)):
+    """`granularity` (hour/day/week/month) adds a dense `series` over all pages for [since, until) in `tz`"""
+    timings = QueryTimings()
+    timeline = TimelineRequest(granularity, since, until, tz) if granularity else None
+    
+    first = await timings.gather(
+        plan=_plan_has_advanced_analytics(user),
+        pages=db.pages.find({"user_id": user["id"]}, {"_id": 0}).to_list(100)
+    )
+    has_advanced, pages = first["plan"], first["pages"]
     page_ids = [p["id"] for p in pages]
     
     if not page_ids:
-        return {
+        response = {
             "total_views": 0,
             "total_clicks": 0,
             "total_shares": 0,
             "total_qr_scans": 0,
+            "unique_visitors": 0,
+            "unique_visitors_today": 0,
             "by_country": [],
             "by_city": [],
             "timeline": [],
             "pages": [],
             "has_advanced_analytics": has_advanced
         }
+        if timeline:
+            response["series"] = await timelines.series(f"user:{user['id']}", [], timeline)
+        if debug:
+            response["timings_ms"] = timings.timings
+        return response
     
     # Aggregate stats from pages
     total_views = sum(p.get("views", 0) for p in pages)
     total_shares = sum(p.get("shares", 0) for p in pages)
     total_qr_scans = sum(p.get("qr_scans", 0) for p in pages)
     
-    # Get all links for these pages
-    links = await db.links.find({"page_id": {"$in": page_ids}}, {"_id": 0}).to_list(1000)
+    # Links and one rollup pass (geo tops only for PRO) run concurrently
+    second = await timings.gather(
+        links=db.links.find({"page_id": {"$in": page_ids}}, {"_id": 0, "page_id": 1, "clicks": 1}).to_list(1000),
+        rollups_facet=rollups.dashboard({"page_id": {"$in": page_ids}}, geo=False, timeline_days=30),
+        top_geo=top_geo(f"user:{user['id']}", {"page_id": {"$in": page_ids}}) if has_advanced else _no_top_geo(),
+        visitors=unique_visitors.count(page_ids, analytics_since_day(30)),
+        visitors_today=unique_visitors.count(page_ids, analytics_since_day(0)),
+        **({"series": timelines.series(f"user:{user['id']}", page_ids, timeline)} if timeline else {})
+    )
+    links, dashboard = second["links"], second["rollups_facet"]
     total_clicks = sum(link.get("clicks", 0) for link in links)
     
-    by_country = []
-    by_city = []
-    
-    # Only fetch detailed geo data for PRO users
-    if has_advanced:
-        # Get clicks by country
-        clicks_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": {"$in": page_ids}}},
-            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in clicks_cursor:
-            by_country.append({"country": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-        
-        # Get clicks by city
-        city_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": {"$in": page_ids}}},
-            {"$group": {"_id": "$city", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in city_cursor:
-            by_city.append({"city": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-    
-    # Get timeline (last 30 days) - available for all
-    thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
-    timeline_cursor = db.clicks.aggregate([
-        {"$match": {"page_id": {"$in": page_ids}, "timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "clicks": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    timeline = []
-    async for doc in timeline_cursor:
-        timeline.append({"date": doc["_id"], "clicks": doc["clicks"]})
-    
-    # Get shares timeline
-    shares_cursor = db.shares.aggregate([
-        {"$match": {"page_id": {"$in": page_ids}, "timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "shares": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    shares_timeline = {}
-    async for doc in shares_cursor:
-        shares_timeline[doc["_id"]] = doc["shares"]
-    
-    # Merge timeline
-    for item in timeline:
-        item["shares"] = shares_timeline.get(item["date"], 0)
-    
-    # Get shares by type
-    shares_by_type_cursor = db.shares.aggregate([
-        {"$match": {"page_id": {"$in": page_ids}}},
-        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
-    ])
-    shares_by_type = {}
-    async for doc in shares_by_type_cursor:
-        shares_by_type[doc["_id"] or "link"] = doc["count"]
-    
     # Page stats (only for PRO)
     page_stats = []
     if has_advanced:
+        clicks_by_page = {}
+        for l in links:
+            clicks_by_page[l["page_id"]] = clicks_by_page.get(l["page_id"], 0) + l.get("clicks", 0)
         for p in pages:
-            page_links = [l for l in links if l["page_id"] == p["id"]]
-            page_clicks = sum(l.get("clicks", 0) for l in page_links)
             page_stats.append({
                 "id": p["id"],
                 "title": p["title"],
                 "slug": p["slug"],
                 "views": p.get("views", 0),
-                "clicks": page_clicks,
+                "clicks": clicks_by_page.get(p["id"], 0),
                 "shares": p.get("shares", 0),
                 "qr_scans": p.get("qr_scans", 0)
             })
     
-    return {
+    response = {
         "total_views": total_views,
         "total_clicks": total_clicks,
         "total_shares": total_shares,
         "total_qr_scans": total_qr_scans,
-        "shares_by_type": shares_by_type,
-        "by_country": by_country,
-        "by_city": by_city,
-        "timeline": timeline,
+        "unique_visitors": second["visitors"],
+        "unique_visitors_today": second["visitors_today"],
+        "shares_by_type": dashboard["shares_by_type"],
+        "by_country": second["top_geo"]["by_country"],
+        "by_city": second["top_geo"]["by_city"],
+        "timeline": dashboard["timeline"],
         "pages": page_stats,
         "has_advanced_analytics": has_advanced
     }
+    if timeline:
+        response["series"] = second["series"]
+    if debug:
+        response["timings_ms"] = timings.timings
+    return response
+
+# ===================== ANALYTICS EXPORT =====================
+# Raw clicks/views/shares streamed from a Mongo cursor in (timestamp, _id)
+# order as NDJSON or CSV, optionally gzipped, in constant memory. Every row
+# carries an opaque `cursor`; passing the last one received as `after`
+# resumes an interrupted download right after that row. Rows moved to the
+# cold archive are read from there first. Only BSON date timestamps are
+# exported, so run migrate-timestamps first on old databases.
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_FIELDS = {
+    "clicks": ["id", "page_id", "link_id", "timestamp", "referrer", "country", "city", "source"],
+    "views": ["id", "page_id", "timestamp", "country", "city", "source"],
+    "shares": ["id", "page_id", "timestamp", "type", "country", "city"],
+}
+
+def encode_export_cursor(doc: dict) -> str:
+    raw = f"{epoch_ms(doc['timestamp'])}:{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_export_cursor(token: str) -> tuple:
+    """(timestamp, _id) of the row the cursor was taken from"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        millis, oid = raw.split(":")
+        return UNIX_EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+    except (ValueError, InvalidId, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор экспорта")
+
+def export_query(page_ids: Optional[list], gte: datetime, lt: Optional[datetime], after: Optional[tuple]) -> dict:
+    # A date lower bound also leaves out legacy string timestamps (BSON type bracketing)
+    # Flagged bot events are never exported (nor archived) as traffic
+    query = {"timestamp": {"$gte": gte, **({"$lt": lt} if lt else {})}, "bot": {"$ne": True}}
+    if page_ids is not None:
+        query["page_id"] = page_ids[0] if len(page_ids) == 1 else {"$in": page_ids}
+    if after:
+        ts, oid = after
+        query = {"$and": [query, {"$or": [{"timestamp": {"$gt": ts}}, {"timestamp": ts, "_id": {"$gt": oid}}]}]}
+    return query
+
+async def export_documents(collection: str, page_ids: Optional[list], gte: datetime, lt: Optional[datetime],
+                           after: Optional[tuple], fields: list):
+    """
+    Rows in one global (timestamp, _id) order, so a cursor resumes exactly:
+    the archived range first (archive segments merged with the events still
+    in Mongo before the watermark, e.g. archived late or never), then the live range.
+    """
+    projection = {f: 1 for f in fields}
+    archived_until = await event_archive.watermark(collection)
+    if archived_until and gte < archived_until:
+        archived_lt = min(lt, archived_until) if lt else archived_until
+        # Few by construction: compaction moved everything else out
+        leftovers = await db[collection].find(export_query(page_ids, gte, archived_lt, after), projection).sort(
+            [("timestamp", 1), ("_id", 1)]
+        ).to_list(None)
+        rows = heapq.merge(
+            ArchiveQuery(event_archive, collection, gte, archived_lt, page_ids).rows(
+                fields, (epoch_ms(after[0]), after[1].binary) if after else None
+            ),
+            leftovers,
+            key=export_sort_key
+        )
+        while True:
+            batch = await asyncio.to_thread(list, itertools.islice(rows, EXPORT_BATCH_SIZE))
+            if not batch:
+                break
+            for doc in batch:
+                yield doc
+        if lt and lt <= archived_until:
+            return
+        gte = archived_until
+    query = export_query(page_ids, gte, lt, after)
+    cursor = db[collection].find(query, projection).sort([("timestamp", 1), ("_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        yield doc
+
+async def export_rows(documents, fields: list, fmt: str):
+    """Serialized export chunks (str), flushed every EXPORT_CHUNK_BYTES"""
+    columns = fields + ["cursor"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(columns)
+    async for doc in documents:
+        row = {f: doc.get(f) for f in fields}
+        row["timestamp"] = format_timestamp(row["timestamp"])
+        row["cursor"] = encode_export_cursor(doc)
+        if writer:
+            writer.writerow(["" if row[c] is None else row[c] for c in columns])
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False))
+            buffer.write("\n")
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_response(kind: str, page_ids: Optional[list], fmt: str, since: Optional[str], until: Optional[str],
+                    after: Optional[str], compress: bool, filename: str, extra_fields: tuple = ()) -> StreamingResponse:
+    if kind not in EXPORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Неизвестный тип данных: clicks, views или shares")
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Формат экспорта: ndjson или csv")
+    try:
+        gte = as_datetime(since) if since else UNIX_EPOCH
+        lt = as_datetime(until) if until else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный формат даты")
+    fields = EXPORT_FIELDS[kind] + list(extra_fields)
+    documents = export_documents(kind, page_ids, gte, lt, decode_export_cursor(after) if after else None, fields)
+    chunks = export_rows(documents, fields, fmt)
+    media_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    filename = f"{filename}-{kind}.{fmt}"
+    if compress:
+        chunks, media_type, filename = gzip_stream(chunks), "application/gzip", filename + ".gz"
+    return StreamingResponse(chunks, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Cache-Control": "no-store"
+    })
+
+async def _require_export_access(user: dict):
+    if not await _plan_has_advanced_analytics(user):
+        raise HTTPException(status_code=403, detail="Экспорт данных доступен в расширенной аналитике")
+
+@api_router.get("/analytics/export/{kind}")
+async def export_user_events(kind: str, format: str = "ndjson", since: Optional[str] = None, until: Optional[str] = None,
+                             after: Optional[str] = None, gzip: bool = False, user: dict = Depends(get_current_user)):
+    """Raw events of all the user's pages"""
+    await _require_export_access(user)
+    page_ids = await db.pages.distinct("id", {"user_id": user["id"]})
+    return export_response(kind, page_ids, format, since, until, after, gzip, "muslink")
+
+@api_router.get("/analytics/{page_id}/export/{kind}")
+async def export_page_events(page_id: str, kind: str, format: str = "ndjson", since: Optional[str] = None, until: Optional[str] = None,
+                             after: Optional[str] = None, gzip: bool = False, user: dict = Depends(get_current_user)):
+    page = await db.pages.find_one({"id": page_id, "user_id": user["id"]}, {"_id": 0, "slug": 1})
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+    await _require_export_access(user)
+    return export_response(kind, [page_id], format, since, until, after, gzip, page["slug"])
+
+# ===================== BATCH LOOKUPS =====================
+# Admin lists resolve their per-row lookups with a single $in / $group query
+# for the whole page of rows instead of one round trip per row.
+
+async def load_batch(batch_fn, keys: list, default=None) -> list:
+    """
+    Values for `keys`, in order, from one `batch_fn(unique_keys)` call that
+    returns {key: value}; missing keys resolve to `default`.
+    """
+    unique = list(dict.fromkeys(key for key in keys if key is not None))
+    found = await batch_fn(unique) if unique else {}
+    return [found.get(key, default) for key in keys]
+
+async def _batch_users(user_ids: list) -> dict:
+    users = await db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "password_hash": 0}).to_list(None)
+    return {u["id"]: u for u in users}
+
+async def _batch_page_counts(user_ids: list) -> dict:
+    pipeline = [
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+    ]
+    return {row["_id"]: row["count"] async for row in db.pages.aggregate(pipeline)}
+
+async def _batch_page_clicks(page_ids: list) -> dict:
+    pipeline = [
+        {"$match": {"page_id": {"$in": page_ids}}},
+        {"$group": {"_id": "$page_id", "clicks": {"$sum": {"$ifNull": ["$clicks", 0]}}}}
+    ]
+    return {row["_id"]: row["clicks"] async for row in db.links.aggregate(pipeline)}
+
+async def _batch_click_events(page_ids: list, since: Optional[datetime] = None) -> dict:
+    """Stored click events per page (flagged bots excluded), optionally since a time"""
+    match = {"page_id": {"$in": page_ids}, "bot": {"$ne": True}}
+    if since is not None:
+        match.update(timestamp_range(gte=since))
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$page_id", "count": {"$sum": 1}}}
+    ]
+    return {row["_id"]: row["count"] async for row in db.clicks.aggregate(pipeline)}
 
 # ===================== ADMIN ROUTES =====================
 
@@ -1844,9 +5243,9 @@ async def get_global_analytics(user: dict = Depends(get_current_user)):
 async def admin_get_users(admin_user: dict = Depends(get_admin_user)):
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
     
-    # Get page counts for each user
-    for user in users:
-        page_count = await db.pages.count_documents({"user_id": user["id"]})
+    # Page counts for all users in one $group
+    page_counts = await load_batch(_batch_page_counts, [user["id"] for user in users], 0)
+    for user, page_count in zip(users, page_counts):
         user["page_count"] = page_count
     
     return users
@@ -1855,13 +5254,14 @@ async def admin_get_users(admin_user: dict = Depends(get_admin_user)):
 async def admin_get_pages(admin_user: dict = Depends(get_admin_user)):
     pages = await db.pages.find({}, {"_id": 0}).to_list(1000)
     
-    # Get user info and clicks for each page
-    for page in pages:
-        user = await db.users.find_one({"id": page["user_id"]}, {"_id": 0, "password_hash": 0})
-        page["user"] = user
-        
-        links = await db.links.find({"page_id": page["id"]}, {"_id": 0}).to_list(100)
-        page["total_clicks"] = sum(link.get("clicks", 0) for link in links)
+    # User info and clicks for all pages: one $in and one $group, run concurrently
+    owners, clicks = await asyncio.gather(
+        load_batch(_batch_users, [page["user_id"] for page in pages]),
+        load_batch(_batch_page_clicks, [page["id"] for page in pages], 0)
+    )
+    for page, owner, total_clicks in zip(pages, owners, clicks):
+        page["user"] = owner
+        page["total_clicks"] = total_clicks
     
     return pages
 
@@ -1873,6 +5273,7 @@ async def admin_block_user(user_id: str, admin_user: dict = Depends(get_admin_us
     
     new_status = "blocked" if user["status"] == "active" else "active"
     await db.users.update_one({"id": user_id}, {"$set": {"status": new_status}})
+    await invalidate_public_page_cache("user", user_id)
     
     return {"message": f"User {new_status}", "status": new_status}
 
@@ -1884,6 +5285,7 @@ async def admin_disable_page(page_id: str, admin_user: dict = Depends(get_admin_
     
     new_status = "disabled" if page["status"] == "active" else "active"
     await db.pages.update_one({"id": page_id}, {"$set": {"status": new_status}})
+    await invalidate_public_page_cache("page", page_id)
     
     return {"message": f"Page {new_status}", "status": new_status}
 
@@ -1913,6 +5315,7 @@ async def admin_approve_verification(user_id: str, admin_user: dict = Depends(ge
             "verification_status": "approved"
         }}
     )
+    await invalidate_public_page_cache("user", user_id)
     
     # Update request
     await db.verification_requests.update_one(
@@ -1932,7 +5335,7 @@ async def admin_approve_verification(user_id: str, admin_user: dict = Depends(ge
         "title": "Верификация одобрена",
         "message": "Поздравляем! Ваша заявка на верификацию одобрена. Теперь рядом с вашим именем будет отображаться галочка.",
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     await db.notifications.insert_one(notification)
     
@@ -1970,7 +5373,7 @@ async def admin_reject_verification(user_id: str, reason: str = "", admin_user:
         "title": "Верификация отклонена",
         "message": f"К сожалению, ваша заявка на верификацию отклонена.{' Причина: ' + reason if reason else ''} Вы можете подать новую заявку.",
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     await db.notifications.insert_one(notification)
     
@@ -1994,6 +5397,7 @@ async def admin_grant_verification(user_id: str, admin_user: dict = Depends(get_
             "verification_status": "approved"
         }}
     )
+    await invalidate_public_page_cache("user", user_id)
     
     # Create notification
     notification = {
@@ -2003,7 +5407,7 @@ async def admin_grant_verification(user_id: str, admin_user: dict = Depends(get_
         "title": "Верификация получена",
         "message": "Администратор выдал вам верификацию. Теперь рядом с вашим именем будет отображаться галочка.",
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     await db.notifications.insert_one(notification)
     
@@ -2024,6 +5428,7 @@ async def admin_revoke_verification(user_id: str, admin_user: dict = Depends(get
             "verification_status": "none"
         }}
     )
+    await invalidate_public_page_cache("user", user_id)
     
     # Create notification
     notification = {
@@ -2033,119 +5438,225 @@ async def admin_revoke_verification(user_id: str, admin_user: dict = Depends(get
         "title": "Верификация отозвана",
         "message": "Ваша верификация была отозвана администратором.",
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     await db.notifications.insert_one(notification)
     
     return {"message": "Верификация отозвана"}
 
 # Admin global analytics - all users
-@api_router.get("/admin/analytics/global")
-async def admin_global_analytics(admin_user: dict = Depends(get_admin_user)):
-    """Global analytics for all users - admin only"""
-    
-    # Get all pages
-    pages = await db.pages.find({}, {"_id": 0}).to_list(10000)
-    page_ids = [p["id"] for p in pages]
-    
-    # Get all links
-    links = await db.links.find({}, {"_id": 0}).to_list(10000)
-    
-    # Calculate totals
-    total_views = sum(p.get("views", 0) for p in pages)
-    total_clicks = sum(l.get("clicks", 0) for l in links)
-    total_shares = sum(p.get("shares", 0) for p in pages)
-    total_qr_scans = sum(p.get("qr_scans", 0) for p in pages)
-    
-    # Get clicks by country
-    by_country = []
-    if page_ids:
-        clicks_cursor = db.clicks.aggregate([
-            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in clicks_cursor:
-            by_country.append({"country": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-    
-    # Get clicks by city
-    by_city = []
-    if page_ids:
-        city_cursor = db.clicks.aggregate([
-            {"$group": {"_id": "$city", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in city_cursor:
-            by_city.append({"city": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-    
-    # Timeline (last 30 days)
-    timeline = []
-    thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
-    
-    timeline_cursor = db.clicks.aggregate([
-        {"$match": {"timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "clicks": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    async for doc in timeline_cursor:
-        timeline.append({"date": doc["_id"], "clicks": doc["clicks"]})
-    
-    # Shares timeline
-    shares_cursor = db.shares.aggregate([
-        {"$match": {"timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "shares": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    shares_timeline = {}
-    async for doc in shares_cursor:
-        shares_timeline[doc["_id"]] = doc["shares"]
-    
-    for item in timeline:
-        item["shares"] = shares_timeline.get(item["date"], 0)
-    
-    # Top pages by views
-    top_pages = sorted(pages, key=lambda x: x.get("views", 0), reverse=True)[:10]
-    top_pages_data = []
-    for p in top_pages:
-        page_links = [l for l in links if l["page_id"] == p["id"]]
-        page_clicks = sum(l.get("clicks", 0) for l in page_links)
-        user = await db.users.find_one({"id": p["user_id"]}, {"_id": 0, "username": 1})
-        top_pages_data.append({
-            "id": p["id"],
-            "title": p["title"],
-            "slug": p["slug"],
-            "views": p.get("views", 0),
-            "clicks": page_clicks,
-            "shares": p.get("shares", 0),
-            "username": user.get("username", "Unknown") if user else "Unknown"
-        })
-    
-    # Shares by type
-    shares_by_type = {}
-    type_cursor = db.shares.aggregate([
-        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
-    ])
-    async for doc in type_cursor:
-        shares_by_type[doc["_id"] or "link"] = doc["count"]
-    
-    # Users count
-    users_count = await db.users.count_documents({})
+async def compute_admin_global_analytics(timings: QueryTimings) -> dict:
+    """Global analytics for all users (served from the admin dashboard snapshot)"""
+    # Everything is computed in MongoDB: totals and top-K rows only, memory stays flat
+    results = await timings.gather(
+        page_totals=db.pages.aggregate([
+            {"$group": {
+                "_id": None,
+                "pages": {"$sum": 1},
+                "views": {"$sum": {"$ifNull": ["$views", 0]}},
+                "shares": {"$sum": {"$ifNull": ["$shares", 0]}},
+                "qr_scans": {"$sum": {"$ifNull": ["$qr_scans", 0]}}
+            }}
+        ]).to_list(1),
+        link_totals=db.links.aggregate([
+            {"$group": {"_id": None, "clicks": {"$sum": {"$ifNull": ["$clicks", 0]}}}}
+        ]).to_list(1),
+        top_pages=db.pages.aggregate([
+            {"$sort": {"views": -1}},
+            {"$limit": 10},
+            # Only the top 10 pages reach the lookups (links.page_id / users.id indexes)
+            {"$lookup": {"from": "links", "localField": "id", "foreignField": "page_id", "as": "page_links"}},
+            {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "id", "as": "owner"}},
+            {"$project": {
+                "_id": 0,
+                "id": 1,
+                "title": 1,
+                "slug": 1,
+                "views": {"$ifNull": ["$views", 0]},
+                "clicks": {"$sum": "$page_links.clicks"},
+                "shares": {"$ifNull": ["$shares", 0]},
+                "username": {"$ifNull": [{"$first": "$owner.username"}, "Unknown"]}
+            }}
+        ]).to_list(10),
+        users_count=db.users.count_documents({}),
+        visitors=unique_visitors.count([ALL_PAGES], analytics_since_day(30)),
+        # 30-day timeline and shares by type: one rollup pass
+        rollups_facet=rollups.dashboard({}, geo=False, timeline_days=30),
+        top_geo=top_geo("global", {})
+    )
+    page_totals = results["page_totals"][0] if results["page_totals"] else {}
+    link_totals = results["link_totals"][0] if results["link_totals"] else {}
+    dashboard = results["rollups_facet"]
+    has_pages = page_totals.get("pages", 0) > 0
     
     return {
-        "total_views": total_views,
-        "total_clicks": total_clicks,
-        "total_shares": total_shares,
-        "total_qr_scans": total_qr_scans,
-        "total_pages": len(pages),
-        "total_users": users_count,
-        "shares_by_type": shares_by_type,
-        "by_country": by_country,
-        "by_city": by_city,
-        "timeline": timeline,
-        "top_pages": top_pages_data
+        "total_views": page_totals.get("views", 0),
+        "total_clicks": link_totals.get("clicks", 0),
+        "total_shares": page_totals.get("shares", 0),
+        "total_qr_scans": page_totals.get("qr_scans", 0),
+        "total_pages": page_totals.get("pages", 0),
+        "total_users": results["users_count"],
+        "unique_visitors": results["visitors"],
+        "shares_by_type": dashboard["shares_by_type"],
+        "by_country": results["top_geo"]["by_country"] if has_pages else [],
+        "by_city": results["top_geo"]["by_city"] if has_pages else [],
+        "timeline": dashboard["timeline"],
+        "top_pages": [
+            {
+                "id": p["id"],
+                "title": p.get("title"),
+                "slug": p.get("slug"),
+                "views": p["views"],
+                "clicks": p["clicks"],
+                "shares": p["shares"],
+                "username": p["username"]
+            }
+            for p in results["top_pages"]
+        ]
+    }
+
+# ===================== ADMIN DASHBOARD SNAPSHOT =====================
+# Global admin metrics are computed by one leader-elected worker every
+# ADMIN_SNAPSHOT_INTERVAL_MINUTES and stored in dashboard_snapshots; every
+# dashboard load reads the stored snapshot (with its `as_of`).
+
+ADMIN_SNAPSHOT_INTERVAL_MINUTES = float(os.environ.get('ADMIN_SNAPSHOT_INTERVAL_MINUTES', '5'))
+SNAPSHOT_REFRESH_WAIT_SECONDS = 60
+
+class DashboardSnapshot:
+    def __init__(self, name: str, compute, interval_seconds: float):
+        self.name = name
+        self.compute = compute
+        self.interval_seconds = interval_seconds
+        self.lease = LeaderLease(f"snapshot:{name}", ttl_seconds=interval_seconds * 2)
+        # Held while any worker recomputes, so on-demand refreshes coalesce across workers
+        self.refresh_lock = LeaderLease(f"snapshot-refresh:{name}", ttl_seconds=SNAPSHOT_REFRESH_WAIT_SECONDS)
+        self.flight = SingleFlight()
+        self.refreshes = 0
+        self.waited = 0
+
+    async def get(self) -> Optional[dict]:
+        return await db.dashboard_snapshots.find_one({"_id": self.name})
+
+    async def refresh(self) -> dict:
+        """Recompute now; concurrent callers (in this and other workers) share one refresh"""
+        return await self.flight.do(self.name, self._refresh)
+
+    async def _refresh(self) -> dict:
+        previous = await self.get()
+        if await self.refresh_lock.acquire():
+            try:
+                return await self._compute_and_store()
+            finally:
+                await self.refresh_lock.release()
+        
+        # Another worker is computing: wait for its snapshot instead of computing twice
+        self.waited += 1
+        previous_as_of = previous["as_of"] if previous else None
+        deadline = time.monotonic() + SNAPSHOT_REFRESH_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            current = await self.get()
+            if current and current["as_of"] != previous_as_of:
+                return current
+        return await self._compute_and_store()
+
+    async def _compute_and_store(self) -> dict:
+        as_of = utc_now()
+        timings = QueryTimings()
+        started = time.perf_counter()
+        data = await self.compute(timings)
+        doc = {
+            "_id": self.name,
+            "data": data,
+            "as_of": as_of,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "timings_ms": timings.timings,
+            "worker_id": WORKER_ID
+        }
+        await db.dashboard_snapshots.replace_one({"_id": self.name}, doc, upsert=True)
+        self.refreshes += 1
+        return doc
+
+    async def run(self):
+        """Background refresh on the leader worker; others only serve the stored snapshot"""
+        while True:
+            try:
+                if await self.lease.acquire():
+                    current = await self.get()
+                    age = (utc_now() - as_datetime(current["as_of"])).total_seconds() if current else None
+                    if age is None or age >= self.interval_seconds * 0.9:
+                        await self.refresh()
+            except Exception as e:
+                logging.error(f"Snapshot refresh failed ({self.name}): {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    @staticmethod
+    def response(doc: dict, debug: bool = False) -> dict:
+        response = {**doc["data"], "as_of": format_timestamp(doc["as_of"])}
+        if debug:
+            response["timings_ms"] = doc.get("timings_ms", {})
+            response["duration_ms"] = doc.get("duration_ms")
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "leader": self.lease.is_leader,
+            "refreshes": self.refreshes,
+            "waited_for_other_worker": self.waited,
+            "single_flight": self.flight.stats()
+        }
+
+admin_snapshot = DashboardSnapshot("admin_global", compute_admin_global_analytics, ADMIN_SNAPSHOT_INTERVAL_MINUTES * 60)
+
+@api_router.get("/admin/analytics/global")
+async def admin_global_analytics(debug: bool = False, admin_user: dict = Depends(get_admin_user)):
+    """Global analytics for all users from the latest snapshot - admin only"""
+    doc = await admin_snapshot.get()
+    if not doc:
+        doc = await admin_snapshot.refresh()
+    return DashboardSnapshot.response(doc, debug)
+
+@api_router.post("/admin/analytics/global/refresh")
+async def admin_refresh_global_analytics(debug: bool = False, owner_user: dict = Depends(get_owner_user)):
+    """Recompute the global analytics snapshot now - owner only"""
+    doc = await admin_snapshot.refresh()
+    return DashboardSnapshot.response(doc, debug)
+
+@api_router.get("/admin/analytics/export/{kind}")
+async def admin_export_events(kind: str, format: str = "ndjson", page_id: Optional[str] = None, user_id: Optional[str] = None,
+                              since: Optional[str] = None, until: Optional[str] = None, after: Optional[str] = None,
+                              gzip: bool = False, admin_user: dict = Depends(get_admin_user)):
+    """Full event dump (optionally one page or one user) - admin or owner"""
+    if not has_role_permission(admin_user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    page_ids = None
+    if page_id:
+        page_ids = [page_id]
+    elif user_id:
+        page_ids = await db.pages.distinct("id", {"user_id": user_id})
+    return export_response(kind, page_ids, format, since, until, after, gzip, "muslink-admin", extra_fields=("ip_hash",))
+
+@api_router.get("/admin/archive/query")
+async def admin_query_archive(kind: str, by: str = "", day: bool = False, page_id: Optional[str] = None,
+                              since: Optional[str] = None, until: Optional[str] = None, limit: int = 100,
+                              admin_user: dict = Depends(get_admin_user)):
+    """Group-by counts over archived events (older than ARCHIVE_AFTER_DAYS)"""
+    columns = tuple(c for c in by.split(",") if c)
+    if kind not in ARCHIVE_COLUMNS:
+        raise HTTPException(status_code=400, detail="Неизвестный тип данных: clicks, views или shares")
+    categorical, _ = ARCHIVE_COLUMNS[kind]
+    if any(c not in categorical for c in columns):
+        raise HTTPException(status_code=400, detail=f"Группировка возможна по: {', '.join(categorical)}")
+    try:
+        query = ArchiveQuery(event_archive, kind, as_datetime(since), as_datetime(until), [page_id] if page_id else None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный формат даты")
+    rows = await asyncio.to_thread(query.group_count, columns, day)
+    return {
+        "archived_until": format_timestamp(await event_archive.watermark(kind)),
+        "groups": len(rows),
+        "rows": rows[:limit]
     }
 
 # VPS Resource Monitoring - admin only
@@ -2218,14 +5729,85 @@ async def admin_system_metrics(admin_user: dict = Depends(get_admin_user)):
 async def admin_system_metrics_history(admin_user: dict = Depends(get_admin_user), hours: int = 24):
     """Get historical VPS metrics - admin only"""
     
-    since = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
     
+    # Legacy string timestamps sort before BSON dates, which is also chronological
     metrics = await db.system_metrics.find(
-        {"timestamp": {"$gte": since}},
+        timestamp_range(gte=since),
         {"_id": 0}
     ).sort("timestamp", 1).to_list(1000)
     
-    return metrics
+    return [serialize_timestamps(m) for m in metrics]
+
+# In-process runtime stats (per worker)
+@api_router.get("/admin/system/runtime")
+async def admin_runtime_stats(admin_user: dict = Depends(get_admin_user)):
+    """Get in-process cache and pipeline stats for the worker serving the request - admin only"""
+    return {
+        "worker_id": WORKER_ID,
+        "public_page_cache": _public_page_cache.stats(),
+        "counter_buffer": counter_buffer.stats(),
+        "tracking": tracking.stats(),
+        "rollups": rollups.stats(),
+        "unique_visitors": unique_visitors.stats(),
+        "heavy_hitters": heavy_hitters.stats(),
+        "timelines": timelines.stats(),
+        "live_analytics": live_analytics.stats(),
+        "archive": await asyncio.to_thread(event_archive.stats),
+        "indexes": index_manager.stats(),
+        "admin_snapshot": admin_snapshot.stats(),
+        "retention": retention.stats(),
+        "geo_enrichment": geo_enrichment.stats(),
+        "geo_db": geo_db.stats(),
+        "geo_cache": geo_cache.stats(),
+        "geo_single_flight": geo_flight.stats(),
+        "lookup_single_flight": lookup_flight.stats(),
+        "http_clients": http_clients.stats(),
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+@api_router.get("/admin/tracking/quarantine")
+async def admin_tracking_quarantine(hours: int = 24, admin_user: dict = Depends(get_admin_user)):
+    """Quarantined tracking bursts: active ones on this worker and stored ones across workers - admin only"""
+    if not has_role_permission(admin_user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    hours = max(1, min(hours, 24 * 7))
+    since = utc_now() - timedelta(hours=hours)
+    detector = tracking.flood_detector
+    
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": since}}},
+        {"$group": {
+            "_id": {"reason": "$reason", "ip_hash": "$ip_hash", "page_id": "$page_id", "kind": "$kind"},
+            "events": {"$sum": 1},
+            "first_at": {"$min": "$timestamp"},
+            "last_at": {"$max": "$timestamp"}
+        }},
+        {"$sort": {"events": -1}},
+        {"$limit": 200}
+    ]
+    stored = []
+    async for row in db.quarantined_events.aggregate(pipeline):
+        stored.append({
+            **row["_id"], "events": row["events"],
+            "first_at": format_timestamp(row["first_at"]), "last_at": format_timestamp(row["last_at"])
+        })
+    
+    return {
+        "worker_id": WORKER_ID,
+        "limits": {
+            "window_seconds": TRACK_FLOOD_WINDOW_SECONDS,
+            "ip_max_events": TRACK_FLOOD_IP_MAX_EVENTS,
+            "target_max_events": TRACK_FLOOD_TARGET_MAX_EVENTS
+        },
+        "active": [
+            serialize_timestamps(dict(burst), ("started_at", "last_at"))
+            for burst in reversed(detector.bursts.values())
+        ] if detector else [],
+        "quarantined": tracking.quarantined,
+        "stored": stored,
+        "hours": hours
+    }
 
 # ===================== RBAC MANAGEMENT API =====================
 
@@ -2270,6 +5852,8 @@ async def update_plan_config(plan_name: str, data: PlanConfigUpdate, user: dict
         upsert=True
     )
     
+    await invalidate_public_page_cache("all")
+    
     config = await db.plan_configs.find_one({"plan_name": plan_name}, {"_id": 0})
     logging.info(f"Plan config updated: {plan_name} by {user['email']}")
     
@@ -2290,6 +5874,7 @@ async def create_plan_config(data: PlanConfigCreate, user: dict = Depends(get_ad
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.plan_configs.insert_one(config)
+    await invalidate_public_page_cache("all")
     
     return {k: v for k, v in config.items() if k != "_id"}
 
@@ -2324,8 +5909,9 @@ async def admin_list_users(
     total = await db.users.count_documents(query)
     
     # Add page count for each user
-    for u in users:
-        u["page_count"] = await db.pages.count_documents({"user_id": u["id"]})
+    page_counts = await load_batch(_batch_page_counts, [u["id"] for u in users], 0)
+    for u, page_count in zip(users, page_counts):
+        u["page_count"] = page_count
     
     return {
         "users": users,
@@ -2371,6 +5957,7 @@ async def admin_update_user_plan(user_id: str, data: UserPlanUpdate, user: dict
         {"id": user_id},
         {"$set": {"plan": data.plan, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await invalidate_public_page_cache("user", user_id)
     
     logging.info(f"User plan changed: {user_id} -> {data.plan} by {user['email']}")
     
@@ -2386,6 +5973,7 @@ async def owner_update_own_plan(data: UserPlanUpdate, user: dict = Depends(get_o
         {"id": user["id"]},
         {"$set": {"plan": data.plan, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await invalidate_public_page_cache("user", user["id"])
     
     logging.info(f"Owner changed own plan to {data.plan} for testing")
     
@@ -2412,6 +6000,7 @@ async def admin_ban_user(user_id: str, data: UserBanUpdate, user: dict = Depends
             "banned_by": user["id"] if data.is_banned else None
         }}
     )
+    await invalidate_public_page_cache("user", user_id)
     
     action = "забанен" if data.is_banned else "разбанен"
     logging.info(f"User {action}: {user_id} by {user['email']}")
@@ -2435,6 +6024,7 @@ async def admin_verify_user(user_id: str, data: UserVerifyUpdate, user: dict = D
             "verified_by": user["id"] if data.is_verified else None
         }}
     )
+    await invalidate_public_page_cache("user", user_id)
     
     action = "верифицирован" if data.is_verified else "снята верификация"
     logging.info(f"User {action}: {user_id} by {user['email']}")
@@ -2459,7 +6049,7 @@ async def admin_get_user(user_id: str, user: dict = Depends(get_admin_user)):
     pages = await db.pages.find({"user_id": user_id}, {"id": 1}).to_list(100)
     if pages:
         page_ids = [p["id"] for p in pages]
-        target_user["total_clicks"] = await db.clicks.count_documents({"page_id": {"$in": page_ids}})
+        target_user["total_clicks"] = await db.clicks.count_documents({"page_id": {"$in": page_ids}, "bot": {"$ne": True}})
     
     # Log admin view action
     await log_admin_action(user["id"], "ADMIN_VIEW_USER_PROFILE", {"target_user_id": user_id})
@@ -2488,15 +6078,16 @@ async def admin_get_user_pages(
     pages = await pages_cursor.to_list(limit)
     total = await db.pages.count_documents({"user_id": user_id})
     
-    # Add click count for each page
-    for page in pages:
-        page["total_clicks"] = await db.clicks.count_documents({"page_id": page["id"]})
-        # Get last 7 days clicks
-        seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        page["clicks_7d"] = await db.clicks.count_documents({
-            "page_id": page["id"],
-            "timestamp": {"$gte": seven_days_ago.isoformat()}
-        })
+    # Total and last 7 days clicks for all pages: two $group queries, run concurrently
+    page_ids = [page["id"] for page in pages]
+    seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    total_clicks, clicks_7d = await asyncio.gather(
+        load_batch(_batch_click_events, page_ids, 0),
+        load_batch(lambda ids: _batch_click_events(ids, seven_days_ago), page_ids, 0)
+    )
+    for page, total, recent in zip(pages, total_clicks, clicks_7d):
+        page["total_clicks"] = total
+        page["clicks_7d"] = recent
     
     # Log admin view action
     await log_admin_action(admin_user["id"], "ADMIN_VIEW_USER_PAGES", {
@@ -2521,7 +6112,7 @@ async def log_admin_action(admin_id: str, event: str, details: dict = None):
         "admin_id": admin_id,
         "event": event,
         "details": details or {},
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": utc_now(),
         "ip_address": None  # Can be populated from request if needed
     }
     await db.audit_logs.insert_one(log_entry)
@@ -2546,12 +6137,14 @@ async def admin_get_audit_logs(
     if admin_id:
         query["admin_id"] = admin_id
     
+    # BSON dates sort after legacy string timestamps, so newest-first still holds mid-migration
     logs = await db.audit_logs.find(query, {"_id": 0}).sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
     total = await db.audit_logs.count_documents(query)
     
     # Enrich with admin info
-    for log in logs:
-        admin = await db.users.find_one({"id": log["admin_id"]}, {"_id": 0, "email": 1, "username": 1})
+    admins = await load_batch(_batch_users, [log.get("admin_id") for log in logs])
+    for log, admin in zip(logs, admins):
+        serialize_timestamps(log)
         log["admin_email"] = admin.get("email") if admin else "Unknown"
         log["admin_username"] = admin.get("username") if admin else "Unknown"
     
@@ -2712,9 +6305,9 @@ async def admin_list_subdomains(
     total = await db.subdomains.count_documents(query)
     
     # Add user info for each subdomain
-    for sub in subdomains:
-        owner = await db.users.find_one({"id": sub["user_id"]}, {"_id": 0, "username": 1, "email": 1})
-        sub["owner"] = owner
+    owners = await load_batch(_batch_users, [sub["user_id"] for sub in subdomains])
+    for sub, owner in zip(subdomains, owners):
+        sub["owner"] = {k: owner[k] for k in ("username", "email") if k in owner} if owner else None
     
     return {
         "subdomains": subdomains,
@@ -2800,7 +6393,7 @@ async def resolve_subdomain(subdomain: str):
     }
 
 @api_router.get("/resolve/{subdomain}/page/{path}")
-async def resolve_subdomain_page(subdomain: str, path: str):
+async def resolve_subdomain_page(subdomain: str, path: str, request: Request = None):
     """Resolve subdomain + path to a specific page"""
     subdomain = subdomain.lower().strip()
     
@@ -2825,8 +6418,9 @@ async def resolve_subdomain_page(subdomain: str, path: str):
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    # Increment view count
-    await db.pages.update_one({"id": page["id"]}, {"$inc": {"views": 1}})
+    # Increment view count (buffered) and record the visitor
+    counter_buffer.incr("pages", page["id"], "views")
+    unique_visitors.observe_request(page["id"], request)
     
     # Get links
     links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
@@ -2892,8 +6486,9 @@ async def get_subdomain_page(request: Request, slug: Optional[str] = None):
     if not page:
         raise HTTPException(status_code=404, detail="Страница не найдена")
     
-    # Increment view count
-    await db.pages.update_one({"id": page["id"]}, {"$inc": {"views": 1}})
+    # Increment view count (buffered) and record the visitor
+    counter_buffer.incr("pages", page["id"], "views")
+    unique_visitors.observe_request(page["id"], request)
     
     # Get links
     links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
@@ -2928,36 +6523,43 @@ async def get_my_limits(user: dict = Depends(get_current_user)):
 
 # ===================== METADATA LOOKUP =====================
 
+# Identical lookups that arrive together (e.g. several editors pasting the
+# same release link) share one upstream request
+lookup_flight = SingleFlight()
+
 @api_router.get("/lookup/itunes")
 async def lookup_itunes(id: Optional[str] = None, term: Optional[str] = None):
     """Proxy endpoint for iTunes API to avoid CORS issues"""
+    return await lookup_flight.do(("itunes", id, term), lambda: _fetch_itunes(id, term))
+
+async def _fetch_itunes(id: Optional[str], term: Optional[str]) -> dict:
     try:
-        async with httpx.AsyncClient() as client:
-            if id:
-                url = f"https://itunes.apple.com/lookup?id={id}"
-            elif term:
-                url = f"https://itunes.apple.com/search?term={term}&media=music&limit=1"
-            else:
-                raise HTTPException(status_code=400, detail="Provide id or term parameter")
+        client = http_clients.get("itunes")
+        if id:
+            url = f"https://itunes.apple.com/lookup?id={id}"
+        elif term:
+            url = f"https://itunes.apple.com/search?term={term}&media=music&limit=1"
+        else:
+            raise HTTPException(status_code=400, detail="Provide id or term parameter")
             
-            response = await client.get(url, timeout=10.0)
-            data = response.json()
+        response = await client.get(url)
+        data = response.json()
             
-            if data.get("results") and len(data["results"]) > 0:
-                result = data["results"][0]
-                artwork = result.get("artworkUrl100") or result.get("artworkUrl60") or ""
-                # Convert to high resolution
-                if artwork:
-                    artwork = artwork.replace("100x100bb", "600x600bb").replace("60x60bb", "600x600bb")
+        if data.get("results") and len(data["results"]) > 0:
+            result = data["results"][0]
+            artwork = result.get("artworkUrl100") or result.get("artworkUrl60") or ""
+            # Convert to high resolution
+            if artwork:
+                artwork = artwork.replace("100x100bb", "600x600bb").replace("60x60bb", "600x600bb")
                 
-                return {
-                    "artwork": artwork,
-                    "trackName": result.get("trackName") or result.get("collectionName"),
-                    "artistName": result.get("artistName"),
-                    "collectionName": result.get("collectionName")
-                }
+            return {
+                "artwork": artwork,
+                "trackName": result.get("trackName") or result.get("collectionName"),
+                "artistName": result.get("artistName"),
+                "collectionName": result.get("collectionName")
+            }
             
-            return {"artwork": "", "trackName": "", "artistName": "", "collectionName": ""}
+        return {"artwork": "", "trackName": "", "artistName": "", "collectionName": ""}
     except Exception as e:
         logging.error(f"iTunes lookup error: {e}")
         return {"artwork": "", "trackName": "", "artistName": "", "collectionName": ""}
@@ -2965,17 +6567,20 @@ async def lookup_itunes(id: Optional[str] = None, term: Optional[str] = None):
 @api_router.get("/lookup/spotify")
 async def lookup_spotify(url: str):
     """Proxy endpoint for Spotify oEmbed to avoid CORS issues"""
+    return await lookup_flight.do(("spotify", url), lambda: _fetch_spotify(url))
+
+async def _fetch_spotify(url: str) -> dict:
     try:
-        async with httpx.AsyncClient() as client:
-            oembed_url = f"https://open.spotify.com/oembed?url={url}"
-            response = await client.get(oembed_url, timeout=10.0)
-            data = response.json()
+        client = http_clients.get("spotify")
+        oembed_url = f"https://open.spotify.com/oembed?url={url}"
+        response = await client.get(oembed_url)
+        data = response.json()
             
-            return {
-                "artwork": data.get("thumbnail_url", ""),
-                "title": data.get("title", ""),
-                "provider": "spotify"
-            }
+        return {
+            "artwork": data.get("thumbnail_url", ""),
+            "title": data.get("title", ""),
+            "provider": "spotify"
+        }
     except Exception as e:
         logging.error(f"Spotify lookup error: {e}")
         return {"artwork": "", "title": "", "provider": "spotify"}
@@ -2984,100 +6589,103 @@ async def lookup_spotify(url: str):
 async def lookup_odesli(url: str, country: Optional[str] = "RU"):
     """Proxy endpoint for Odesli (song.link) API to get links for all platforms.
     Supports URLs and UPC codes (via iTunes lookup first)."""
+    return await lookup_flight.do(("odesli", url.strip(), country), lambda: _fetch_odesli(url, country))
+
+async def _fetch_odesli(url: str, country: Optional[str]) -> dict:
     try:
-        async with httpx.AsyncClient() as client:
-            # Check if input is a UPC code (numeric, typically 12-14 digits)
-            clean_input = url.strip()
-            is_upc = clean_input.isdigit() and 10 <= len(clean_input) <= 14
+        client = http_clients.get("odesli")
+        # Check if input is a UPC code (numeric, typically 12-14 digits)
+        clean_input = url.strip()
+        is_upc = clean_input.isdigit() and 10 <= len(clean_input) <= 14
             
-            lookup_url = clean_input
+        lookup_url = clean_input
             
-            if is_upc:
-                # For UPC codes, first search in iTunes to get a proper URL
-                itunes_url = f"https://itunes.apple.com/lookup?upc={clean_input}&country={country}"
-                itunes_response = await client.get(itunes_url, timeout=10.0)
+        if is_upc:
+            # For UPC codes, first search in iTunes to get a proper URL
+            itunes_url = f"https://itunes.apple.com/lookup?upc={clean_input}&country={country}"
+            itunes_response = await http_clients.get("itunes").get(itunes_url)
                 
-                if itunes_response.status_code == 200:
-                    itunes_data = itunes_response.json()
-                    results = itunes_data.get("results", [])
+            if itunes_response.status_code == 200:
+                itunes_data = itunes_response.json()
+                results = itunes_data.get("results", [])
                     
-                    if results:
-                        # Get the collection URL (album) or track URL
-                        collection_url = results[0].get("collectionViewUrl") or results[0].get("trackViewUrl")
-                        if collection_url:
-                            lookup_url = collection_url
-                            logging.info(f"UPC {clean_input} resolved to: {collection_url}")
-                        else:
-                            return {"error": "Релиз не найден по UPC коду", "links": {}}
+                if results:
+                    # Get the collection URL (album) or track URL
+                    collection_url = results[0].get("collectionViewUrl") or results[0].get("trackViewUrl")
+                    if collection_url:
+                        lookup_url = collection_url
+                        logging.info(f"UPC {clean_input} resolved to: {collection_url}")
                     else:
                         return {"error": "Релиз не найден по UPC коду", "links": {}}
                 else:
-                    return {"error": "Не удалось найти релиз по UPC", "links": {}}
+                    return {"error": "Релиз не найден по UPC коду", "links": {}}
+            else:
+                return {"error": "Не удалось найти релиз по UPC", "links": {}}
             
-            # Call Odesli API
-            odesli_url = f"https://api.song.link/v1-alpha.1/links?url={lookup_url}&userCountry={country}"
-            response = await client.get(odesli_url, timeout=15.0)
+        # Call Odesli API
+        odesli_url = f"https://api.song.link/v1-alpha.1/links?url={lookup_url}&userCountry={country}"
+        response = await client.get(odesli_url)
             
-            if response.status_code != 200:
-                logging.error(f"Odesli API error: {response.status_code}")
-                return {"error": "Failed to fetch from Odesli", "links": {}}
+        if response.status_code != 200:
+            logging.error(f"Odesli API error: {response.status_code}")
+            return {"error": "Failed to fetch from Odesli", "links": {}}
             
-            data = response.json()
+        data = response.json()
             
-            # Extract platform links
-            links_by_platform = data.get("linksByPlatform", {})
+        # Extract platform links
+        links_by_platform = data.get("linksByPlatform", {})
             
-            # Map ALL Odesli platform names to our platform IDs
-            platform_mapping = {
-                "spotify": "spotify",
-                "itunes": "itunes",
-                "appleMusic": "appleMusic",
-                "youtube": "youtube",
-                "youtubeMusic": "youtubeMusic",
-                "google": "google",
-                "googleStore": "googleStore",
-                "pandora": "pandora",
-                "deezer": "deezer",
-                "tidal": "tidal",
-                "amazonStore": "amazonStore",
-                "amazonMusic": "amazonMusic",
-                "soundcloud": "soundcloud",
-                "napster": "napster",
-                "yandex": "yandex",
-                "spinrilla": "spinrilla",
-                "audius": "audius",
-                "anghami": "anghami",
-                "boomplay": "boomplay",
-                "audiomack": "audiomack",
-            }
+        # Map ALL Odesli platform names to our platform IDs
+        platform_mapping = {
+            "spotify": "spotify",
+            "itunes": "itunes",
+            "appleMusic": "appleMusic",
+            "youtube": "youtube",
+            "youtubeMusic": "youtubeMusic",
+            "google": "google",
+            "googleStore": "googleStore",
+            "pandora": "pandora",
+            "deezer": "deezer",
+            "tidal": "tidal",
+            "amazonStore": "amazonStore",
+            "amazonMusic": "amazonMusic",
+            "soundcloud": "soundcloud",
+            "napster": "napster",
+            "yandex": "yandex",
+            "spinrilla": "spinrilla",
+            "audius": "audius",
+            "anghami": "anghami",
+            "boomplay": "boomplay",
+            "audiomack": "audiomack",
+        }
             
-            result_links = {}
-            for odesli_platform, link_info in links_by_platform.items():
-                our_platform = platform_mapping.get(odesli_platform, odesli_platform)
-                if link_info.get("url"):
-                    # Don't overwrite if we already have this platform
-                    if our_platform not in result_links:
-                        result_links[our_platform] = link_info["url"]
+        result_links = {}
+        for odesli_platform, link_info in links_by_platform.items():
+            our_platform = platform_mapping.get(odesli_platform, odesli_platform)
+            if link_info.get("url"):
+                # Don't overwrite if we already have this platform
+                if our_platform not in result_links:
+                    result_links[our_platform] = link_info["url"]
             
-            # Get entity info for metadata
-            entity_unique_id = data.get("entityUniqueId", "")
-            entities_by_unique_id = data.get("entitiesByUniqueId", {})
-            entity_info = entities_by_unique_id.get(entity_unique_id, {})
+        # Get entity info for metadata
+        entity_unique_id = data.get("entityUniqueId", "")
+        entities_by_unique_id = data.get("entitiesByUniqueId", {})
+        entity_info = entities_by_unique_id.get(entity_unique_id, {})
             
-            # Get artwork URL (prefer high resolution)
-            artwork_url = ""
-            thumbnail_url = entity_info.get("thumbnailUrl", "")
-            if thumbnail_url:
-                # Try to get higher resolution image
-                artwork_url = thumbnail_url.replace("100x100", "600x600").replace("300x300", "600x600")
+        # Get artwork URL (prefer high resolution)
+        artwork_url = ""
+        thumbnail_url = entity_info.get("thumbnailUrl", "")
+        if thumbnail_url:
+            # Try to get higher resolution image
+            artwork_url = thumbnail_url.replace("100x100", "600x600").replace("300x300", "600x600")
             
-            return {
-                "links": result_links,
-                "pageUrl": data.get("pageUrl", ""),
-                "title": entity_info.get("title", ""),
-                "artistName": entity_info.get("artistName", ""),
-                "thumbnailUrl": artwork_url or thumbnail_url
-            }
+        return {
+            "links": result_links,
+            "pageUrl": data.get("pageUrl", ""),
+            "title": entity_info.get("title", ""),
+            "artistName": entity_info.get("artistName", ""),
+            "thumbnailUrl": artwork_url or thumbnail_url
+        }
     except Exception as e:
         logging.error(f"Odesli lookup error: {e}")
         return {"error": str(e), "links": {}}
@@ -3409,42 +7017,42 @@ async def generate_ai_background(request: AIGenerateRequest, user: dict = Depend
     }
     
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(api_url, headers=headers, json=payload)
+        client = http_clients.get("huggingface")
+        response = await client.post(api_url, headers=headers, json=payload)
             
-            if response.status_code == 503:
-                # Model is loading, return loading status
-                return JSONResponse(
-                    status_code=503,
-                    content={"detail": "Модель загружается. Попробуйте через 20-30 секунд."}
-                )
+        if response.status_code == 503:
+            # Model is loading, return loading status
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Модель загружается. Попробуйте через 20-30 секунд."}
+            )
             
-            if response.status_code != 200:
-                error_detail = response.text[:200] if response.text else "Unknown error"
-                logging.error(f"HuggingFace API error: {response.status_code} - {error_detail}")
-                raise HTTPException(
-                    status_code=response.status_code, 
-                    detail=f"Ошибка генерации: {error_detail}"
-                )
+        if response.status_code != 200:
+            error_detail = response.text[:200] if response.text else "Unknown error"
+            logging.error(f"HuggingFace API error: {response.status_code} - {error_detail}")
+            raise HTTPException(
+                status_code=response.status_code, 
+                detail=f"Ошибка генерации: {error_detail}"
+            )
             
-            # Response is binary image data
-            image_bytes = response.content
+        # Response is binary image data
+        image_bytes = response.content
             
-            # Convert to base64
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        # Convert to base64
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
             
-            # Also save to uploads folder
-            filename = f"ai_bg_{uuid.uuid4().hex[:8]}.png"
-            filepath = UPLOAD_DIR / filename
+        # Also save to uploads folder
+        filename = f"ai_bg_{uuid.uuid4().hex[:8]}.png"
+        filepath = UPLOAD_DIR / filename
             
-            async with aiofiles.open(filepath, 'wb') as f:
-                await f.write(image_bytes)
+        async with aiofiles.open(filepath, 'wb') as f:
+            await f.write(image_bytes)
             
-            return {
-                "success": True,
-                "image_base64": f"data:image/png;base64,{image_base64}",
-                "image_url": f"/api/uploads/{filename}"
-            }
+        return {
+            "success": True,
+            "image_base64": f"data:image/png;base64,{image_base64}",
+            "image_url": f"/api/uploads/{filename}"
+        }
             
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Время ожидания генерации истекло. Попробуйте ещё раз.")
@@ -3639,6 +7247,576 @@ async def admin_update_ticket_status(ticket_id: str, data: TicketStatusUpdate, u
     
     return {"success": True, "status": data.status}
 
+# ===================== INDEXES =====================
+# Declarative index registry: every index the queries in this file rely on.
+# reconcile_indexes() creates the missing ones in the background at startup
+# and drops only the superseded ones listed in RETIRED_INDEXES;
+# `python server.py check-indexes` runs explain() on the hot query shapes
+# below and flags collection scans.
+
+ASC, DESC = 1, -1
+
+def _index(keys, **options) -> IndexModel:
+    if isinstance(keys, str):
+        keys = [(keys, ASC)]
+    return IndexModel(keys, **options)
+
+_GEO_PENDING = {"partialFilterExpression": {"geo_pending": True}}
+
+INDEX_REGISTRY = {
+    "users": [
+        _index("email", unique=True),
+        _index("username", unique=True),
+        _index("id"),
+    ],
+    "pages": [
+        _index("slug", unique=True),
+        _index("user_id"),
+        _index("id"),
+        _index([("user_id", ASC), ("created_at", DESC)]),
+        _index([("views", DESC)]),
+    ],
+    "links": [
+        _index("page_id"),
+        _index("id"),
+        _index([("page_id", ASC), ("order", ASC)]),
+    ],
+    "clicks": [
+        _index("link_id"),
+        _index("id"),
+        _index([("geo_pending", ASC), ("timestamp", ASC)], **_GEO_PENDING),
+        # Per-page time ranges (either direction) and exports in (timestamp, _id) order
+        _index([("page_id", ASC), ("timestamp", ASC), ("_id", ASC)]),
+        _index([("timestamp", ASC), ("_id", ASC)]),
+    ],
+    "views": [
+        _index("id"),
+        _index([("geo_pending", ASC), ("timestamp", ASC)], **_GEO_PENDING),
+        # Per-page time ranges (either direction) and exports in (timestamp, _id) order
+        _index([("page_id", ASC), ("timestamp", ASC), ("_id", ASC)]),
+        _index([("timestamp", ASC), ("_id", ASC)]),
+    ],
+    "shares": [
+        _index("id"),
+        _index([("geo_pending", ASC), ("timestamp", ASC)], **_GEO_PENDING),
+        # Per-page time ranges (either direction) and exports in (timestamp, _id) order
+        _index([("page_id", ASC), ("timestamp", ASC), ("_id", ASC)]),
+        _index([("timestamp", ASC), ("_id", ASC)]),
+    ],
+    "analytics_daily": [
+        _index([("page_id", ASC), ("day", ASC)]),
+        _index("day"),
+    ],
+    "visitor_sketches": [
+        _index([("page_id", ASC), ("day", ASC)]),
+    ],
+    "live_streams": [
+        _index([("user_id", ASC), ("expires_at", ASC)]),
+        _index("expires_at", expireAfterSeconds=0),
+    ],
+    "analytics_hourly": [
+        _index([("page_id", ASC), ("hour", ASC)]),
+        _index("hour"),
+    ],
+    "heavy_hitters": [
+        _index("scope"),
+    ],
+    "notifications": [
+        _index([("user_id", ASC), ("created_at", DESC)]),
+        _index([("user_id", ASC), ("read", ASC)]),
+    ],
+    "audit_logs": [
+        _index([("timestamp", DESC)]),
+        _index([("event", ASC), ("timestamp", DESC)]),
+        _index([("admin_id", ASC), ("timestamp", DESC)]),
+    ],
+    "verification_requests": [
+        _index([("user_id", ASC), ("status", ASC)]),
+        _index([("created_at", DESC)]),
+    ],
+    "covers": [
+        _index([("user_id", ASC), ("created_at", DESC)]),
+        _index("id"),
+    ],
+    "cover_projects": [
+        _index("user_id"),
+        _index("id"),
+        _index([("user_id", ASC), ("updated_at", DESC)]),
+    ],
+    "waitlist": [
+        _index("email"),
+        _index([("created_at", DESC)]),
+    ],
+    "tickets": [
+        _index("user_id"),
+        _index([("status", ASC), ("is_read_by_staff", ASC)]),
+        _index("id"),
+        _index([("user_id", ASC), ("updated_at", DESC)]),
+        _index([("user_id", ASC), ("is_read_by_user", ASC)]),
+        _index([("updated_at", DESC)]),
+        _index([("status", ASC), ("updated_at", DESC)]),
+    ],
+    "subdomains": [
+        _index("subdomain", unique=True),
+        _index("user_id"),
+        _index("id"),
+    ],
+    "plan_configs": [
+        _index("plan_name", unique=True),
+    ],
+    "system_metrics": [
+        _index("timestamp"),
+    ],
+    "quarantined_events": [
+        _index("timestamp"),
+    ],
+}
+
+# Indexes made redundant by a registry index with the same prefix: dropped on reconcile
+RETIRED_INDEXES = {
+    collection: [[("page_id", ASC), ("timestamp", DESC)]]  # by (page_id, timestamp, _id)
+    for collection in ("clicks", "views", "shares")
+}
+
+def _index_key(spec) -> tuple:
+    return tuple((field, int(direction)) for field, direction in spec)
+
+class IndexManager:
+    def __init__(self, registry: dict):
+        self.registry = registry
+        self.report = {}
+
+    async def reconcile(self) -> dict:
+        """Create registered indexes that are missing; report extra and conflicting ones"""
+        report = {}
+        for collection, models in self.registry.items():
+            entry = {"created": [], "dropped": [], "present": [], "extra": [], "conflicts": [], "failed": []}
+            try:
+                existing = await db[collection].index_information()
+            except Exception as e:
+                logging.error(f"Index reconcile failed for {collection}: {e}")
+                continue
+            by_key = {_index_key(info["key"]): name for name, info in existing.items()}
+            for retired in RETIRED_INDEXES.get(collection, []):
+                name = by_key.pop(_index_key(retired), None)
+                if not name:
+                    continue
+                try:
+                    await db[collection].drop_index(name)
+                    entry["dropped"].append(name)
+                    logging.info(f"Retired index dropped: {collection}.{name}")
+                except OperationFailure as e:
+                    if e.code != 27:  # IndexNotFound: another worker dropped it first
+                        entry["failed"].append(name)
+                        logging.error(f"Dropping retired index {collection}.{name} failed: {e}")
+                except Exception as e:
+                    entry["failed"].append(name)
+                    logging.error(f"Dropping retired index {collection}.{name} failed: {e}")
+            wanted = set()
+            for model in models:
+                doc = model.document
+                key = _index_key(doc["key"].items())
+                wanted.add(key)
+                name = by_key.get(key)
+                if name:
+                    info = existing[name]
+                    if bool(info.get("unique")) != bool(doc.get("unique")):
+                        entry["conflicts"].append(name)
+                    else:
+                        entry["present"].append(name)
+                    continue
+                try:
+                    # Index builds don't hold exclusive locks for their duration (MongoDB 4.2+)
+                    created = await db[collection].create_indexes([model])
+                    entry["created"].extend(created)
+                    logging.info(f"Index created: {collection}.{created[0]}")
+                except Exception as e:
+                    entry["failed"].append(doc["name"])
+                    logging.error(f"Index build failed for {collection}.{doc['name']}: {e}")
+            # ttl_* indexes belong to the retention policy
+            entry["extra"] = [
+                name for key, name in by_key.items()
+                if key not in wanted and name != "_id_" and not name.startswith("ttl_")
+            ]
+            report[collection] = entry
+        self.report = report
+        return report
+
+    def stats(self) -> dict:
+        """Only what needs attention: created, extra, conflicting or failed indexes"""
+        return {
+            collection: {k: v for k, v in entry.items() if v and k != "present"}
+            for collection, entry in self.report.items()
+            if any(v for k, v in entry.items() if k != "present")
+        }
+
+index_manager = IndexManager(INDEX_REGISTRY)
+
+# Query shapes of the hot endpoints: (name, collection, filter, sort)
+def hot_query_shapes() -> list:
+    since = datetime.now(timezone.utc) - timedelta(days=7)
+    return [
+        ("get_current_user", "users", {"id": "x"}, None),
+        ("public_page", "pages", {"slug": "x", "status": "active"}, None),
+        ("public_page_links", "links", {"page_id": "x", "active": True}, [("order", ASC)]),
+        ("track_click", "links", {"id": "x"}, None),
+        ("get_pages", "pages", {"user_id": "x"}, [("created_at", DESC)]),
+        ("admin_top_pages", "pages", {}, [("views", DESC)]),
+        ("get_page_analytics", "analytics_daily", {"page_id": "x", "clicks": {"$gt": 0}}, None),
+        ("global_timeline", "analytics_daily", {"page_id": {"$in": ["x", "y"]}, "day": {"$gte": "2026-01-01"}}, None),
+        ("timeline_hourly", "analytics_hourly", {"page_id": {"$in": ["x", "y"]}, "hour": {"$gte": since}}, None),
+        ("admin_user_clicks", "clicks", {"page_id": {"$in": ["x", "y"]}}, None),
+        ("admin_user_pages_clicks_7d", "clicks", {"page_id": "x", "timestamp": {"$gte": since}}, None),
+        ("geo_enrichment", "clicks", {"id": "x"}, None),
+        ("geo_pending_sweep", "views", {"geo_pending": True, "timestamp": {"$lt": since}}, None),
+        ("notifications", "notifications", {"user_id": "x"}, [("created_at", DESC)]),
+        ("notifications_unread", "notifications", {"user_id": "x", "read": False}, None),
+        ("audit_logs", "audit_logs", {}, [("timestamp", DESC)]),
+        ("audit_logs_by_event", "audit_logs", {"event": "x"}, [("timestamp", DESC)]),
+        ("audit_logs_by_admin", "audit_logs", {"admin_id": "x"}, [("timestamp", DESC)]),
+        ("verification_pending", "verification_requests", {"user_id": "x", "status": "pending"}, None),
+        ("admin_verification_requests", "verification_requests", {}, [("created_at", DESC)]),
+        ("covers", "covers", {"user_id": "x"}, [("created_at", DESC)]),
+        ("cover_projects", "cover_projects", {"user_id": "x"}, [("updated_at", DESC)]),
+        ("waitlist_signup", "waitlist", {"email": "x"}, None),
+        ("admin_waitlist", "waitlist", {}, [("created_at", DESC)]),
+        ("my_tickets", "tickets", {"user_id": "x"}, [("updated_at", DESC)]),
+        ("tickets_unread_user", "tickets", {"user_id": "x", "is_read_by_user": False}, None),
+        ("admin_tickets", "tickets", {}, [("updated_at", DESC)]),
+        ("admin_tickets_by_status", "tickets", {"status": "open"}, [("updated_at", DESC)]),
+        ("tickets_unread_staff", "tickets", {"status": {"$in": ["open", "in_progress"]}, "is_read_by_staff": False}, None),
+        ("subdomain_lookup", "subdomains", {"subdomain": "x"}, None),
+        ("metrics_history", "system_metrics", {"timestamp": {"$gte": since}}, [("timestamp", ASC)]),
+    ]
+
+def _plan_stages(plan) -> list:
+    """All stage names in an explain plan tree (classic and SBE formats)"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+async def explain_hot_queries() -> list:
+    results = []
+    for name, collection, query, sort in hot_query_shapes():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explain = await cursor.explain()
+        except Exception as e:
+            results.append({"query": name, "collection": collection, "error": str(e)})
+            continue
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        results.append({
+            "query": name,
+            "collection": collection,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages
+        })
+    return results
+
+# ===================== RETENTION =====================
+# Per-collection retention enforced by MongoDB TTL indexes on BSON date
+# fields (RETENTION_<COLLECTION>_DAYS, 0 = keep forever). Applying a policy
+# (`python server.py apply-retention`) creates or retunes the TTL index; for
+# raw clicks/views/shares it first checks that everything about to expire is
+# already counted in links.clicks / pages.views / pages.shares / pages.qr_scans
+# and in the daily rollups, and refuses otherwise. The same check keeps
+# running on the leader worker every RETENTION_GUARD_INTERVAL_MINUTES for the
+# events about to expire; while it fails the TTL index is paused (expiry set to
+# the maximum) and restored once it passes. With the cold archive enabled
+# (ARCHIVE_AFTER_DAYS > 0) event retention must be longer than the archive
+# horizon, otherwise events would expire before they are archived.
+
+RETENTION_FIELDS = {
+    "clicks": "timestamp",
+    "views": "timestamp",
+    "shares": "timestamp",
+    # Hour buckets: hour-granularity series and days in other timezones older than this read as zeros
+    "analytics_hourly": "hour",
+    "audit_logs": "timestamp",
+    "notifications": "created_at",
+    "system_metrics": "timestamp",
+}
+RETENTION_DEFAULT_DAYS = {"notifications": 90, "system_metrics": 30, "analytics_hourly": 400}
+RETENTION_GUARD_INTERVAL_MINUTES = float(os.environ.get('RETENTION_GUARD_INTERVAL_MINUTES', '60'))
+# Largest expireAfterSeconds MongoDB accepts: a paused TTL index never fires
+TTL_PAUSED_SECONDS = 2147483647
+RETENTION_DAYS = {
+    collection: int(os.environ.get(f'RETENTION_{collection.upper()}_DAYS', str(RETENTION_DEFAULT_DAYS.get(collection, 0))))
+    for collection in RETENTION_FIELDS
+}
+
+class RetentionPolicy:
+    def __init__(self, days: dict, guard_interval: float = RETENTION_GUARD_INTERVAL_MINUTES * 60):
+        self.days = days
+        self.guard_interval = guard_interval
+        self.lease = LeaderLease("retention-guard", ttl_seconds=guard_interval * 2)
+        self.guard_runs = 0
+        self.paused = 0
+        self.resumed = 0
+
+    @staticmethod
+    def cutoff(days: int) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(days=days)
+
+    async def _uncounted_counters(self, collection: str, cutoff: datetime) -> list:
+        """Targets whose stored counter is below the raw events that would expire"""
+        match = {"timestamp": {"$lt": cutoff}, "bot": {"$ne": True}}
+        if collection == "clicks":
+            group_id, target, counters = "$link_id", "links", {"clicks": {"$sum": 1}}
+        elif collection == "views":
+            group_id, target, counters = "$page_id", "pages", {"views": {"$sum": 1}}
+        else:
+            group_id, target = "$page_id", "pages"
+            counters = {
+                "shares": {"$sum": {"$cond": [{"$eq": ["$type", "qr"]}, 0, 1]}},
+                "qr_scans": {"$sum": {"$cond": [{"$eq": ["$type", "qr"]}, 1, 0]}}
+            }
+        raw = {}
+        async for doc in db[collection].aggregate([{"$match": match}, {"$group": {"_id": group_id, **counters}}], allowDiskUse=True):
+            raw[doc["_id"]] = doc
+        problems = []
+        ids = list(raw)
+        for i in range(0, len(ids), 1000):
+            chunk = ids[i:i + 1000]
+            stored = {}
+            async for doc in db[target].find({"id": {"$in": chunk}}, {"_id": 0, "id": 1, **{c: 1 for c in counters}}):
+                stored[doc["id"]] = doc
+            for target_id in chunk:
+                if target_id not in stored:
+                    continue  # deleted link/page: nothing left to count into
+                for counter in counters:
+                    if stored[target_id].get(counter, 0) < raw[target_id][counter]:
+                        problems.append(f"{target}.{counter} {target_id}: {stored[target_id].get(counter, 0)} < {raw[target_id][counter]}")
+        return problems
+
+    async def _uncounted_days(self, collection: str, cutoff: datetime) -> list:
+        """Analytics days whose raw events outnumber the rollup total"""
+        counter = EVENT_SOURCE_COLLECTIONS[collection]
+        raw = {}
+        async for doc in db[collection].aggregate([
+            {"$match": {"timestamp": {"$lt": cutoff}, "bot": {"$ne": True}}},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp", "timezone": ANALYTICS_TIMEZONE}},
+                "events": {"$sum": 1}
+            }}
+        ], allowDiskUse=True):
+            raw[doc["_id"]] = doc["events"]
+        if not raw:
+            return []
+        counted = {}
+        async for doc in rollups.coll.aggregate([
+            {"$match": {"day": {"$in": list(raw)}}},
+            {"$group": {"_id": "$day", "count": {"$sum": f"${counter}"}}}
+        ]):
+            counted[doc["_id"]] = doc["count"]
+        return [f"{day}: {events} events, {counted.get(day, 0)} in rollups" for day, events in sorted(raw.items()) if counted.get(day, 0) < events]
+
+    @staticmethod
+    def archive_conflict(collection: str, days: int) -> Optional[str]:
+        if collection in EVENT_SOURCE_COLLECTIONS and days and ARCHIVE_AFTER_DAYS and days <= ARCHIVE_AFTER_DAYS:
+            return f"retention {days} days <= ARCHIVE_AFTER_DAYS {ARCHIVE_AFTER_DAYS}: events would expire before they are archived"
+        return None
+
+    async def check(self, collection: str, days: int, ahead: timedelta = timedelta(0)) -> dict:
+        """Refusal reasons for expiring `collection` after `days`, `ahead` of now (raw events only)"""
+        if collection not in EVENT_SOURCE_COLLECTIONS:
+            return {"safe": True}
+        cutoff = self.cutoff(days) + ahead
+        reasons = {}
+        conflict = self.archive_conflict(collection, days)
+        if conflict:
+            reasons["archive"] = conflict
+        pending = await TimestampMigration().pending()
+        if pending[collection]:
+            reasons["string_timestamps"] = pending[collection]
+        geo_pending = await db[collection].count_documents({"geo_pending": True, "timestamp": {"$lt": cutoff}})
+        if geo_pending:
+            reasons["geo_pending"] = geo_pending
+        counters = await self._uncounted_counters(collection, cutoff)
+        if counters:
+            reasons["counters"] = counters[:20]
+        uncounted_days = await self._uncounted_days(collection, cutoff)
+        if uncounted_days:
+            reasons["rollups"] = uncounted_days[:20]
+        return {"safe": not reasons, **({"reasons": reasons} if reasons else {})}
+
+    async def _ttl_index(self, collection: str) -> Optional[tuple]:
+        """(name, info) of the single-field index on the retention field"""
+        field_name = RETENTION_FIELDS[collection]
+        for name, info in (await db[collection].index_information()).items():
+            if len(info["key"]) == 1 and info["key"][0][0] == field_name:
+                return name, info
+        return None
+
+    async def apply_collection(self, collection: str) -> dict:
+        days = self.days[collection]
+        field_name = RETENTION_FIELDS[collection]
+        existing = await self._ttl_index(collection)
+        current = existing[1].get("expireAfterSeconds") if existing else None
+        if not days:
+            if current is None:
+                return {"action": "none"}
+            # TTL can't be switched off in place: drop it and let the registry recreate a plain index
+            await db[collection].drop_index(existing[0])
+            await index_manager.reconcile()
+            return {"action": "disabled"}
+        conflict = self.archive_conflict(collection, days)
+        if conflict:
+            logging.warning(f"Retention for {collection} refused: {conflict}")
+            return {"action": "refused", "safe": False, "reasons": {"archive": conflict}}
+        seconds = days * 86400
+        if current == seconds:
+            return {"action": "none"}
+        if current is None or seconds < current:
+            check = await self.check(collection, days)
+            if not check["safe"]:
+                logging.warning(f"Retention for {collection} refused: {check['reasons']}")
+                return {"action": "refused", **check}
+        expiring = await db[collection].count_documents({field_name: {"$lt": self.cutoff(days)}})
+        if existing:
+            await self._set_ttl(collection, existing[1]["key"], seconds)
+            action = "updated"
+        else:
+            await db[collection].create_index([(field_name, ASC)], name=f"ttl_{field_name}", expireAfterSeconds=seconds)
+            action = "created"
+        stats = await self.storage(collection)
+        await db.migrations.update_one({"_id": f"retention:{collection}"}, {"$set": {
+            "days": days,
+            "applied_at": utc_now(),
+            "expiring_documents": expiring,
+            "expiring_bytes": expiring * stats.get("avg_document_bytes", 0),
+            "storage_at_apply": stats
+        }, "$unset": {"paused_at": "", "paused_reasons": ""}}, upsert=True)
+        logging.info(f"Retention for {collection}: {days} days ({action}, {expiring} documents expiring)")
+        return {"action": action, "expiring_documents": expiring}
+
+    async def apply(self) -> dict:
+        return {collection: await self.apply_collection(collection) for collection in RETENTION_FIELDS}
+
+    async def _set_ttl(self, collection: str, key: list, seconds: int):
+        await db.command("collMod", collection, index={"keyPattern": dict(key), "expireAfterSeconds": seconds})
+
+    async def guard(self) -> dict:
+        """Re-check events expiring before the next run; pause TTL expiry while that fails"""
+        result = {}
+        for collection in EVENT_SOURCE_COLLECTIONS:
+            existing = await self._ttl_index(collection)
+            current = existing[1].get("expireAfterSeconds") if existing else None
+            if current is None:
+                continue
+            applied = await db.migrations.find_one({"_id": f"retention:{collection}"}, {"days": 1}) or {}
+            days = applied.get("days")
+            if not days:
+                # Not applied through apply-retention: the index TTL may be the pause value, not a retention
+                logging.error(f"Retention guard skips {collection}: TTL index without stored retention days, re-run apply-retention")
+                result[collection] = "unknown"
+                continue
+            check = await self.check(collection, days, ahead=timedelta(seconds=self.guard_interval * 2))
+            if not check["safe"] and current != TTL_PAUSED_SECONDS:
+                await self._set_ttl(collection, existing[1]["key"], TTL_PAUSED_SECONDS)
+                await db.migrations.update_one({"_id": f"retention:{collection}"}, {"$set": {
+                    "paused_at": utc_now(), "paused_reasons": check["reasons"]
+                }}, upsert=True)
+                self.paused += 1
+                logging.warning(f"Retention for {collection} paused: {check['reasons']}")
+                result[collection] = "paused"
+            elif check["safe"] and current == TTL_PAUSED_SECONDS:
+                await self._set_ttl(collection, existing[1]["key"], days * 86400)
+                await db.migrations.update_one({"_id": f"retention:{collection}"}, {"$unset": {"paused_at": "", "paused_reasons": ""}})
+                self.resumed += 1
+                logging.info(f"Retention for {collection} resumed: {days} days")
+                result[collection] = "resumed"
+            else:
+                result[collection] = "paused" if current == TTL_PAUSED_SECONDS else "ok"
+        self.guard_runs += 1
+        return result
+
+    async def run(self):
+        """Background guard on the leader worker"""
+        while True:
+            try:
+                if await self.lease.acquire():
+                    await self.guard()
+            except Exception as e:
+                logging.error(f"Retention guard failed: {e}")
+            await asyncio.sleep(self.guard_interval)
+
+    def stats(self) -> dict:
+        return {"leader": self.lease.is_leader, "guard_runs": self.guard_runs, "paused": self.paused, "resumed": self.resumed}
+
+    @staticmethod
+    async def storage(collection: str) -> dict:
+        try:
+            stats = await db.command("collStats", collection)
+        except Exception as e:
+            logging.warning(f"collStats failed for {collection}: {e}")
+            return {}
+        return {
+            "documents": stats.get("count", 0),
+            "avg_document_bytes": stats.get("avgObjSize", 0),
+            "data_bytes": stats.get("size", 0),
+            "storage_bytes": stats.get("storageSize", 0),
+            # Space freed by deletions, reused by new writes (compact returns it to the OS)
+            "free_bytes": stats.get("freeStorageSize", 0),
+            "index_bytes": stats.get("totalIndexSize", 0)
+        }
+
+    async def report(self) -> dict:
+        """Per retention class: policy, TTL index state and storage reclaimed since it was applied"""
+        result = {}
+        for collection, field_name in RETENTION_FIELDS.items():
+            existing = await self._ttl_index(collection)
+            applied = await db.migrations.find_one({"_id": f"retention:{collection}"}, {"_id": 0}) or {}
+            storage = await self.storage(collection)
+            before = applied.get("storage_at_apply", {})
+            ttl_seconds = existing[1].get("expireAfterSeconds") if existing else None
+            entry = {
+                "days": self.days[collection],
+                "field": field_name,
+                "ttl_days": ttl_seconds / 86400 if ttl_seconds is not None and ttl_seconds != TTL_PAUSED_SECONDS else None,
+                "paused": ttl_seconds == TTL_PAUSED_SECONDS,
+                "paused_reasons": applied.get("paused_reasons"),
+                "applied_at": format_timestamp(applied.get("applied_at")),
+                "storage": storage
+            }
+            if applied:
+                entry["reclaimed"] = {
+                    "expired_at_apply_documents": applied.get("expiring_documents", 0),
+                    "expired_at_apply_bytes": applied.get("expiring_bytes", 0),
+                    "free_bytes_growth": max(0, storage.get("free_bytes", 0) - before.get("free_bytes", 0)),
+                    "data_bytes_change": storage.get("data_bytes", 0) - before.get("data_bytes", 0)
+                }
+            if ttl_seconds is not None and ttl_seconds != TTL_PAUSED_SECONDS:
+                # Documents past the horizon that the TTL monitor (60 s passes) hasn't removed yet
+                horizon = self.cutoff(int(existing[1]["expireAfterSeconds"] // 86400))
+                entry["awaiting_expiry"] = await db[collection].count_documents({field_name: {"$lt": horizon}})
+            result[collection] = entry
+        return result
+
+retention = RetentionPolicy(RETENTION_DAYS)
+
+@api_router.get("/admin/retention")
+async def admin_retention_report(admin_user: dict = Depends(get_admin_user)):
+    """Retention classes with their TTL state and reclaimed storage - admin or owner"""
+    if not has_role_permission(admin_user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    return await retention.report()
+
+@api_router.post("/admin/retention/apply")
+async def admin_apply_retention(owner_user: dict = Depends(get_owner_user)):
+    """Create/retune TTL indexes from RETENTION_*_DAYS - owner only"""
+    return await retention.apply()
+
 # ===================== STARTUP =====================
 
 @app.on_event("startup")
@@ -3689,18 +7867,10 @@ async def startup_event():
         logging.info(f"Migrated {users_migration.modified_count} users with RBAC fields")
     
     # Create indexes
-    await db.users.create_index("email", unique=True)
-    await db.users.create_index("username", unique=True)
-    await db.pages.create_index("slug", unique=True)
-    await db.pages.create_index("user_id")
-    await db.links.create_index("page_id")
-    await db.clicks.create_index("link_id")
-    await db.plan_configs.create_index("plan_name", unique=True)
-    await db.subdomains.create_index("subdomain", unique=True)
-    await db.subdomains.create_index("user_id")
-    await db.cover_projects.create_index("user_id")
-    await db.tickets.create_index("user_id")
-    await db.tickets.create_index([("status", 1), ("is_read_by_staff", 1)])
+    # Capped collections first, so index builds don't create them as plain ones
+    await ensure_quarantine_collection()
+    # Indexes from INDEX_REGISTRY; missing ones are built without blocking startup
+    start_background_task(index_manager.reconcile())
     
     # Update existing plan configs with new fields
     for plan_name in ["free", "pro"]:
@@ -3750,9 +7920,50 @@ async def startup_event():
         logging.info(f"Migrated {shares_result.modified_count} share records with Unknown values")
     
     logging.info(f"RBAC System initialized. Launch mode: {LAUNCH_MODE}")
+    
+    # Shared outbound HTTP clients
+    await http_clients.start()
+    
+    # Offline geo database (compiled on first start, then memory-mapped)
+    await asyncio.to_thread(geo_db.load, GEO_DB_PATH, GEO_NAMES_PATH)
+    
+    # Cross-worker events (cache invalidation)
+    await ensure_cluster_events_collection()
+    start_background_task(cluster_events_listener())
+    
+    # Write-behind counters and click ingestion
+    start_background_task(counter_buffer.run())
+    start_background_task(tracking.run())
+    start_background_task(quarantine.run())
+    start_background_task(unique_visitors.run())
+    start_background_task(heavy_hitters.run())
+    start_background_task(live_analytics.run())
+    
+    # Admin dashboard snapshot (refreshed by the lease holder only)
+    start_background_task(admin_snapshot.run())
+    start_background_task(retention.run())
+    start_background_task(geo_enrichment.run())
+    start_background_task(geo_enrichment.run_sweeps())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await stop_background_tasks()
+    # Hand the snapshot lease over right away instead of waiting for it to expire
+    await admin_snapshot.lease.release()
+    await retention.lease.release()
+    # Persist queued tracking events and buffered counters before the connection goes away
+    await tracking.drain()
+    await quarantine.drain()
+    try:
+        # Bounded: leftovers stay geo_pending and are swept as unknown later
+        await asyncio.wait_for(geo_enrichment.drain(), timeout=10)
+    except asyncio.TimeoutError:
+        logging.warning("Geo enrichment drain timed out")
+    await counter_buffer.flush()
+    await unique_visitors.flush()
+    await heavy_hitters.flush()
+    geo_cache.close()
+    await http_clients.close()
     client.close()
 
 # Include router and configure CORS
@@ -3771,3 +7982,99 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+
+# ===================== CLI =====================
+# Maintenance commands: python server.py <command> [options]
+
+async def run_timestamp_migration(batch_size: int, restart: bool) -> dict:
+    migration = TimestampMigration(batch_size)
+    if restart:
+        await migration.reset()
+    return {"converted": await migration.run(), "remaining": await migration.pending()}
+
+async def check_indexes(reconcile: bool) -> dict:
+    if reconcile:
+        await ensure_quarantine_collection()
+    report = await index_manager.reconcile() if reconcile else None
+    queries = await explain_hot_queries()
+    collscans = [q["query"] for q in queries if q.get("collscan")]
+    for name in collscans:
+        logging.warning(f"COLLSCAN: {name}")
+    return {"reconcile": report, "queries": queries, "collscans": collscans}
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+    parser = argparse.ArgumentParser(description="MyTrack backend maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    bench = commands.add_parser("bench-tracking", help="Benchmark tracking pipeline throughput (no storage)")
+    bench.add_argument("--events", type=int, default=100000)
+    bench.add_argument("--batch-size", type=int, default=TRACK_BATCH_SIZE)
+    
+    backfill = commands.add_parser("backfill-rollups", help="Rebuild daily and hourly rollups from raw events")
+    backfill.add_argument("--since", help="First day in ANALYTICS_TIMEZONE (YYYY-MM-DD), default: oldest event")
+    backfill.add_argument("--until", help="Exclusive last day in ANALYTICS_TIMEZONE (YYYY-MM-DD), default: up to the hours/days that still receive live events")
+    
+    migrate = commands.add_parser("migrate-timestamps", help="Convert ISO string timestamps to BSON dates (resumable)")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--restart", action="store_true", help="Ignore saved progress")
+    
+    commands.add_parser("rebuild-heavy-hitters", help="Seed top-K country/city summaries exactly from the daily rollups")
+    
+    commands.add_parser("apply-retention", help="Create/retune TTL indexes from RETENTION_*_DAYS (refuses uncounted events)")
+    
+    archive = commands.add_parser("archive-events", help="Move old clicks/views/shares to the columnar cold archive")
+    archive.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    
+    query = commands.add_parser("query-archive", help="Count archived events grouped by columns and/or day")
+    query.add_argument("collection", choices=list(ARCHIVE_COLUMNS))
+    query.add_argument("--by", default="", help="Comma-separated columns, e.g. country,city")
+    query.add_argument("--day", action="store_true", help="Also group by analytics day")
+    query.add_argument("--since", help="ISO date/time, inclusive")
+    query.add_argument("--until", help="ISO date/time, exclusive")
+    query.add_argument("--page-id", action="append", dest="page_ids")
+    
+    geo = commands.add_parser("compile-geo-db", help="Compile the DB-IP CSV into the memory-mapped geo index")
+    geo.add_argument("--force", action="store_true", help="Recompile even if the index is up to date")
+    
+    check = commands.add_parser("check-indexes", help="Explain hot queries and flag collection scans")
+    check.add_argument("--reconcile", action="store_true", help="Create missing registry indexes first")
+    
+    args = parser.parse_args(argv)
+    if args.command == "bench-tracking":
+        result = asyncio.run(benchmark_tracking_pipeline(args.events, args.batch_size))
+    elif args.command == "backfill-rollups":
+        async def backfill_all():
+            return {
+                "daily": await rollups.backfill(args.since, args.until),
+                "hourly": await hourly_rollups.backfill(args.since, args.until)
+            }
+        result = asyncio.run(backfill_all())
+    elif args.command == "migrate-timestamps":
+        result = asyncio.run(run_timestamp_migration(args.batch_size, args.restart))
+    elif args.command == "rebuild-heavy-hitters":
+        result = asyncio.run(heavy_hitters.rebuild())
+    elif args.command == "apply-retention":
+        result = asyncio.run(retention.apply())
+        print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+        if any(r["action"] == "refused" for r in result.values()):
+            sys.exit(1)
+        return
+    elif args.command == "archive-events":
+        result = asyncio.run(event_archive.run(args.older_than_days))
+    elif args.command == "query-archive":
+        result = ArchiveQuery(
+            event_archive, args.collection, as_datetime(args.since), as_datetime(args.until), args.page_ids
+        ).group_count(tuple(c for c in args.by.split(",") if c), args.day)
+    elif args.command == "compile-geo-db":
+        result = {"compiled": GeoDatabase.ensure_compiled(GEO_DB_PATH, GEO_NAMES_PATH, args.force), "path": GEO_DB_PATH}
+    elif args.command == "check-indexes":
+        result = asyncio.run(check_indexes(args.reconcile))
+        print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+        if result["collscans"]:
+            sys.exit(1)
+        return
+    print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
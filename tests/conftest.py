@@ -0,0 +1,15 @@
+"""
+Shared setup for backend unit tests that import server.py directly.
+Settings are only defaulted, so a real .env / environment still wins;
+no database connection is opened at import time.
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "mytrack_unit_tests")
+os.environ.setdefault("JWT_SECRET", "unit-test-secret")
+os.environ.setdefault("OWNER_EMAIL", "owner@example.com")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
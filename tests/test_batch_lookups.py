@@ -0,0 +1,47 @@
+"""
+Unit tests for batched admin lookups (no server or database needed)
+Tests: load_batch order, deduplication, defaults, missing keys, errors
+"""
+import asyncio
+
+import pytest
+
+from server import load_batch
+
+
+class RecordingBatch:
+    def __init__(self, values):
+        self.values = values
+        self.calls = []
+
+    async def __call__(self, keys):
+        self.calls.append(keys)
+        return {key: self.values[key] for key in keys if key in self.values}
+
+
+class TestLoadBatch:
+    """One batch call per list of keys, values returned in key order"""
+
+    def test_order_and_deduplication(self):
+        batch = RecordingBatch({"u1": "one", "u2": "two", "u3": "three"})
+        result = asyncio.run(load_batch(batch, ["u3", "u1", "u3", "u2", "u1"]))
+        assert result == ["three", "one", "three", "two", "one"]
+        assert batch.calls == [["u3", "u1", "u2"]]
+
+    def test_missing_and_none_keys_get_default(self):
+        batch = RecordingBatch({"p1": 5})
+        assert asyncio.run(load_batch(batch, ["p1", "gone", None], 0)) == [5, 0, 0]
+        assert batch.calls == [["p1", "gone"]]
+
+    def test_no_keys_skips_the_query(self):
+        batch = RecordingBatch({})
+        assert asyncio.run(load_batch(batch, [])) == []
+        assert asyncio.run(load_batch(batch, [None, None])) == [None, None]
+        assert batch.calls == []
+
+    def test_errors_propagate(self):
+        async def failing(keys):
+            raise RuntimeError("mongo down")
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(load_batch(failing, ["u1"]))
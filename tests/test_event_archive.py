@@ -0,0 +1,74 @@
+"""
+Unit tests for the cold event archive (no server or database needed)
+Tests: segment round trip, global row order across overlapping segments, export cursor resume
+"""
+import random
+from datetime import timedelta
+
+from bson import ObjectId
+
+from server import (
+    ArchiveQuery, EventArchive, UNIX_EPOCH, decode_export_cursor, encode_export_cursor, epoch_ms, export_sort_key
+)
+
+FIELDS = ["id", "page_id", "link_id", "timestamp", "country", "city"]
+START = UNIX_EPOCH + timedelta(days=19000)
+
+
+def make_clicks(count, rng, offset_ms=0):
+    docs = []
+    for n in range(count):
+        # Few distinct milliseconds, so rows also tie on timestamp and order by _id
+        ts = START + timedelta(milliseconds=offset_ms + rng.randrange(0, 40))
+        docs.append({"_id": ObjectId(), "id": f"c{offset_ms}-{n}", "page_id": rng.choice(["p1", "p2"]), "link_id": "l1",
+                     "timestamp": ts, "country": "RU", "city": "Москва", "ip_hash": "h"})
+    return sorted(docs, key=export_sort_key)
+
+
+class TestEventArchive:
+    """Rows come back in one (timestamp, _id) order, so an export cursor resumes exactly"""
+
+    def test_segment_round_trip(self, tmp_path):
+        archive = EventArchive(tmp_path, 180, 100)
+        docs = make_clicks(20, random.Random(1))
+        archive._write_segment("clicks", docs)
+        rows = list(ArchiveQuery(archive, "clicks").rows(FIELDS))
+        assert [row["_id"] for row in rows] == [doc["_id"] for doc in docs]
+        assert [row["timestamp"] for row in rows] == [doc["timestamp"] for doc in docs]
+        assert rows[0]["city"] == "Москва"
+
+    def test_overlapping_segments_are_merged(self, tmp_path):
+        rng = random.Random(2)
+        archive = EventArchive(tmp_path, 180, 100)
+        first, second, third = make_clicks(30, rng), make_clicks(10, rng, offset_ms=10), make_clicks(5, rng, offset_ms=100)
+        for docs in (first, third, second):
+            archive._write_segment("clicks", docs)
+        rows = list(ArchiveQuery(archive, "clicks").rows(FIELDS))
+        assert [row["_id"] for row in rows] == [doc["_id"] for doc in sorted(first + second + third, key=export_sort_key)]
+
+    def test_time_range_and_pages(self, tmp_path):
+        archive = EventArchive(tmp_path, 180, 100)
+        docs = make_clicks(40, random.Random(3))
+        archive._write_segment("clicks", docs)
+        since, until = START + timedelta(milliseconds=10), START + timedelta(milliseconds=30)
+        rows = list(ArchiveQuery(archive, "clicks", since, until, ["p1"]).rows(FIELDS))
+        expected = [d["_id"] for d in docs if since <= d["timestamp"] < until and d["page_id"] == "p1"]
+        assert [row["_id"] for row in rows] == expected
+
+    def test_resume_from_export_cursor(self, tmp_path):
+        rng = random.Random(4)
+        archive = EventArchive(tmp_path, 180, 100)
+        archive._write_segment("clicks", make_clicks(25, rng))
+        archive._write_segment("clicks", make_clicks(25, rng, offset_ms=20))
+        rows = list(ArchiveQuery(archive, "clicks").rows(FIELDS))
+        for cut in (0, 17, 31, len(rows) - 1):
+            ts, oid = decode_export_cursor(encode_export_cursor(rows[cut]))
+            assert (ts, oid) == (rows[cut]["timestamp"], rows[cut]["_id"])
+            resumed = list(ArchiveQuery(archive, "clicks").rows(FIELDS, (epoch_ms(ts), oid.binary)))
+            assert [row["_id"] for row in resumed] == [row["_id"] for row in rows[cut + 1:]]
+
+    def test_epoch_ms_is_exact(self):
+        rng = random.Random(5)
+        for _ in range(10000):
+            ms = rng.randrange(10 ** 12, 2 * 10 ** 12)
+            assert epoch_ms(UNIX_EPOCH + timedelta(milliseconds=ms)) == ms
@@ -0,0 +1,78 @@
+"""
+Unit tests for tracking flood detection (no server or database needed)
+Tests: sliding-window rates, LRU key eviction, IP floods, target bursts
+"""
+import pytest
+
+from server import FloodDetector, SlidingWindowRate, TrackingEvent, utc_now
+
+
+def make_event(ip_hash, link_id="l1"):
+    return TrackingEvent(kind="click", page_id="p1", link_id=link_id, timestamp=utc_now(),
+                         user_agent="Mozilla/5.0", ip_hash=ip_hash)
+
+
+class TestSlidingWindowRate:
+    """Approximate counts over the current and previous window"""
+
+    def test_counts_within_window(self):
+        rates = SlidingWindowRate(60, 10)
+        assert [rates.hit("a", now=t) for t in (0, 1, 2)] == [1, 2, 3]
+        assert rates.hit("b", now=3) == 1
+
+    def test_previous_window_is_weighted(self):
+        rates = SlidingWindowRate(60, 10)
+        for _ in range(10):
+            rates.hit("a", now=30)
+        # Half of the previous window still overlaps: 10 * 0.5 + 1
+        assert rates.hit("a", now=90) == pytest.approx(6)
+
+    def test_old_windows_are_forgotten(self):
+        rates = SlidingWindowRate(60, 10)
+        for _ in range(10):
+            rates.hit("a", now=0)
+        assert rates.hit("a", now=150) == 1
+
+    def test_least_recently_seen_key_is_evicted(self):
+        rates = SlidingWindowRate(60, 2)
+        rates.hit("a", now=0)
+        rates.hit("b", now=0)
+        rates.hit("a", now=1)
+        rates.hit("c", now=2)
+        assert len(rates) == 2 and rates.evictions == 1
+        assert rates.hit("a", now=3) == 3
+        assert rates.hit("b", now=3) == 1
+
+
+class TestFloodDetector:
+    """IP floods are quarantined, target bursts are only flagged"""
+
+    def test_ip_flood(self):
+        detector = FloodDetector(60, 3, 1000, 100)
+        reasons = [detector.check(make_event("h1"), now=0) for _ in range(5)]
+        assert reasons == [None, None, None, "ip_flood", "ip_flood"]
+        assert detector.check(make_event("h2"), now=0) is None
+        assert detector.bursts[("ip_flood", "h1")]["events"] == 2
+
+    def test_target_burst_is_flagged_not_dropped(self):
+        detector = FloodDetector(60, 100, 3, 100)
+        reasons = [detector.check(make_event(f"h{i}"), now=0) for i in range(5)]
+        assert reasons == [None] * 5
+        assert detector.bursts[("target_burst", "click:l1")]["events"] == 2
+        assert detector.stats()["flagged_target_events"] == 2
+
+    def test_ip_flood_does_not_count_towards_target(self):
+        detector = FloodDetector(60, 3, 10, 100)
+        for _ in range(100):
+            detector.check(make_event("attacker"), now=0)
+        for i in range(5):
+            assert detector.check(make_event(f"visitor{i}"), now=0) is None
+        assert ("target_burst", "click:l1") not in detector.bursts
+        assert detector.stats()["flagged_target_events"] == 0
+
+    def test_bursts_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(FloodDetector, "MAX_BURSTS", 2)
+        detector = FloodDetector(60, 0, 1000, 100)
+        for ip_hash in ("h1", "h2", "h3"):
+            detector.check(make_event(ip_hash), now=0)
+        assert list(detector.bursts) == [("ip_flood", "h2"), ("ip_flood", "h3")]
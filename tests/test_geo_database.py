@@ -0,0 +1,102 @@
+"""
+Unit tests for the offline geo database (no server or database needed)
+Tests: CSV compile + lookup for IPv4/IPv6, localized names (bundled table, override file, missing file),
+private ranges, recompiling when a name table changes
+"""
+import asyncio
+import ipaddress
+import os
+
+import pytest
+
+import server
+from server import GEO_UNKNOWN, GeoDatabase, get_geo_from_ip
+
+CITY_ROWS = [
+    "1.0.0.0,1.0.0.255,AS,AU,Queensland,Brisbane,-27.4,153.0",
+    "5.8.0.0,5.8.255.255,EU,RU,Moscow,Moscow,55.7,37.6",
+    "5.9.0.0,5.9.0.255,EU,DE,Bavaria,Gunzenhausen,49.1,10.7",
+    "8.8.8.0,8.8.8.255,NA,US,California,Mountain View,37.4,-122.1",
+    "2a02:6b8::,2a02:6b8:ffff:ffff:ffff:ffff:ffff:ffff,EU,RU,Saint Petersburg,Saint Petersburg,59.9,30.3",
+    "2001:4860::,2001:4860:ffff:ffff:ffff:ffff:ffff:ffff,NA,US,California,,37.4,-122.1",
+]
+
+
+def compile_db(tmp_path, rows, names=None):
+    csv_path = tmp_path / "dbip-city-lite.csv"
+    csv_path.write_text("\n".join(rows) + "\n", encoding="utf-8")
+    names_path = tmp_path / "names-ru.csv"
+    if names is not None:
+        names_path.write_text(names, encoding="utf-8")
+    db = GeoDatabase()
+    assert db.load(str(csv_path), str(names_path))
+    return db
+
+
+def lookup(db, ip):
+    return db.lookup(ipaddress.ip_address(ip))
+
+
+class TestGeoDatabase:
+    """Ranges resolve to the same Russian names ip-api.com returned"""
+
+    def test_ipv4_lookup_with_bundled_names(self, tmp_path):
+        db = compile_db(tmp_path, CITY_ROWS)
+        assert lookup(db, "5.8.1.2") == {"country": "Россия", "city": "Москва"}
+        assert lookup(db, "8.8.8.8") == {"country": "США", "city": "Mountain View"}
+        assert lookup(db, "5.9.0.255") == {"country": "Германия", "city": "Gunzenhausen"}
+
+    def test_ipv6_and_mapped_ipv4(self, tmp_path):
+        db = compile_db(tmp_path, CITY_ROWS)
+        assert lookup(db, "2a02:6b8:b010::1") == {"country": "Россия", "city": "Санкт-Петербург"}
+        assert lookup(db, "2001:4860:4860::8888") == {"country": "США", "city": GEO_UNKNOWN}
+        assert lookup(db, "::ffff:5.8.0.1") == {"country": "Россия", "city": "Москва"}
+
+    def test_range_bounds_and_gaps(self, tmp_path):
+        db = compile_db(tmp_path, CITY_ROWS)
+        assert lookup(db, "5.8.0.0")["city"] == "Москва"
+        assert lookup(db, "5.8.255.255")["city"] == "Москва"
+        for ip in ("0.255.255.255", "5.9.1.0", "9.9.9.9", "2a03::1"):
+            assert lookup(db, ip) is None
+        assert db.stats()["found"] == 2
+
+    def test_missing_names_file_uses_bundled_table(self, tmp_path):
+        db = compile_db(tmp_path, CITY_ROWS)
+        assert not (tmp_path / "names-ru.csv").exists()
+        assert lookup(db, "1.0.0.1") == {"country": "Австралия", "city": "Brisbane"}
+
+    def test_names_file_overrides_and_extends(self, tmp_path):
+        db = compile_db(tmp_path, CITY_ROWS, "country,US,Соединённые Штаты\ncity,Mountain View,Маунтин-Вью\n")
+        assert lookup(db, "8.8.8.8") == {"country": "Соединённые Штаты", "city": "Маунтин-Вью"}
+        assert lookup(db, "5.8.1.2") == {"country": "Россия", "city": "Москва"}
+
+    def test_country_lite_format(self, tmp_path):
+        db = compile_db(tmp_path, ["ip_start,ip_end,country", "5.8.0.0,5.8.255.255,RU", "5.9.0.0,5.9.255.255,ZZ"])
+        assert lookup(db, "5.8.0.1") == {"country": "Россия", "city": GEO_UNKNOWN}
+        assert lookup(db, "5.9.0.1") == {"country": GEO_UNKNOWN, "city": GEO_UNKNOWN}
+
+    def test_names_change_triggers_recompile(self, tmp_path):
+        compile_db(tmp_path, CITY_ROWS)
+        csv_path = str(tmp_path / "dbip-city-lite.csv")
+        names_path = tmp_path / "names-ru.csv"
+        assert not GeoDatabase.ensure_compiled(csv_path, str(names_path))
+        names_path.write_text("city,Brisbane,Брисбен\n", encoding="utf-8")
+        compiled = os.path.getmtime(tmp_path / "dbip-city-lite.csv.idx" / "locations.json")
+        os.utime(names_path, (compiled + 10, compiled + 10))
+        assert GeoDatabase.ensure_compiled(csv_path, str(names_path))
+        db = GeoDatabase()
+        assert db.load(csv_path, str(names_path))
+        assert lookup(db, "1.0.0.1")["city"] == "Брисбен"
+
+
+class TestGetGeoFromIp:
+    """Private and malformed addresses never reach the database or the network"""
+
+    @pytest.mark.parametrize("ip", ["10.1.2.3", "192.168.0.10", "127.0.0.1", "172.16.5.4", "fd00::1", "::1", "", "bogus"])
+    def test_private_and_invalid_are_unknown(self, ip, tmp_path, monkeypatch):
+        monkeypatch.setattr(server, "geo_db", compile_db(tmp_path, CITY_ROWS + ["10.0.0.0,10.255.255.255,ZZ,ZZ,,,0,0"]))
+        assert asyncio.run(get_geo_from_ip(ip)) == {"country": GEO_UNKNOWN, "city": GEO_UNKNOWN}
+
+    def test_public_address_uses_the_database(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(server, "geo_db", compile_db(tmp_path, CITY_ROWS))
+        assert asyncio.run(get_geo_from_ip("5.8.0.1")) == {"country": "Россия", "city": "Москва"}
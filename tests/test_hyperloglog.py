@@ -0,0 +1,102 @@
+"""
+Unit tests for the HyperLogLog unique-visitor sketch (no server or database needed)
+Tests: estimate accuracy, merge, serialization with stored precision, precision folding
+"""
+import random
+
+import numpy as np
+import pytest
+
+from server import HyperLogLog
+
+
+def random_hashes(count, seed):
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(count)]
+
+
+class TestHyperLogLogEstimate:
+    """Estimates stay within a few standard errors"""
+
+    def test_empty_sketch_estimates_zero(self):
+        assert HyperLogLog(12).estimate() == 0
+
+    def test_small_counts_are_near_exact(self):
+        sketch = HyperLogLog(12)
+        sketch.add_hashes(random_hashes(50, seed=1))
+        assert abs(sketch.estimate() - 50) <= 1
+
+    @pytest.mark.parametrize("count", [5000, 100000])
+    def test_large_counts_within_error_bound(self, count):
+        sketch = HyperLogLog(12)
+        sketch.add_hashes(random_hashes(count, seed=count))
+        # 1.04 / sqrt(4096) = 1.6%; allow 4 standard errors
+        assert abs(sketch.estimate() - count) / count < 0.065
+
+    def test_duplicates_do_not_change_registers(self):
+        hashes = random_hashes(1000, seed=2)
+        sketch = HyperLogLog(12)
+        assert sketch.add_hashes(hashes)
+        assert not sketch.add_hashes(hashes)
+
+
+class TestHyperLogLogMerge:
+    """Merging is the register-wise max, i.e. a union of visitors"""
+
+    def test_merge_equals_union(self):
+        first, second = random_hashes(3000, seed=3), random_hashes(3000, seed=4)
+        a, b, union = HyperLogLog(12), HyperLogLog(12), HyperLogLog(12)
+        a.add_hashes(first)
+        b.add_hashes(second + first[:1000])
+        union.add_hashes(first + second)
+        a.merge(b)
+        assert np.array_equal(a.registers, union.registers)
+
+    def test_merge_of_different_precision_folds_to_lower(self):
+        hashes = random_hashes(20000, seed=5)
+        high, low = HyperLogLog(14), HyperLogLog(10)
+        high.add_hashes(hashes[:10000])
+        low.add_hashes(hashes[10000:])
+        high.merge(low)
+        expected = HyperLogLog(10)
+        expected.add_hashes(hashes)
+        assert high.p == 10
+        assert np.array_equal(high.registers, expected.registers)
+
+    def test_fold_is_exact(self):
+        hashes = random_hashes(20000, seed=6)
+        high, low = HyperLogLog(14), HyperLogLog(11)
+        high.add_hashes(hashes)
+        low.add_hashes(hashes)
+        assert np.array_equal(high.fold(11).registers, low.registers)
+
+    def test_fold_cannot_raise_precision(self):
+        with pytest.raises(ValueError):
+            HyperLogLog(10).fold(12)
+
+
+class TestHyperLogLogSerialization:
+    """to_bytes / from_bytes keep registers and precision"""
+
+    @pytest.mark.parametrize("p,count", [(12, 0), (12, 20), (12, 20000), (8, 100), (14, 50)])
+    def test_round_trip(self, p, count):
+        sketch = HyperLogLog(p)
+        sketch.add_hashes(random_hashes(count, seed=count))
+        restored = HyperLogLog.from_bytes(sketch.to_bytes(), p=16)
+        assert restored.p == p
+        assert np.array_equal(restored.registers, sketch.registers)
+
+    def test_legacy_dense_precision_from_length(self):
+        sketch = HyperLogLog(10)
+        sketch.add_hashes(random_hashes(5000, seed=7))
+        legacy = bytes([HyperLogLog.DENSE]) + sketch.registers.tobytes()
+        assert HyperLogLog.from_bytes(legacy).p == 10
+
+    def test_legacy_sparse_uses_given_precision(self):
+        sketch = HyperLogLog(12)
+        sketch.add_hashes(random_hashes(10, seed=8))
+        nonzero = np.flatnonzero(sketch.registers)
+        legacy = (bytes([HyperLogLog.SPARSE]) + nonzero.astype("<u2").tobytes()
+                  + sketch.registers[nonzero].tobytes())
+        restored = HyperLogLog.from_bytes(legacy, p=12)
+        assert np.array_equal(restored.registers, sketch.registers)
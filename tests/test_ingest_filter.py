@@ -0,0 +1,114 @@
+"""
+Unit tests for tracking ingest filtering (no server or database needed)
+Tests: bot user-agent table (in-app browsers of real visitors vs bots), bot modes, dedup window
+"""
+import pytest
+
+from server import TRACK_BOT_UA_PATTERN, DedupWindow, IngestFilter, TrackingEvent, utc_now
+
+HUMAN_USER_AGENTS = [
+    # Desktop / mobile browsers
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Linux; Android 10; CUBOT X30) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.91 Mobile Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 YaBrowser/24.6.0.0 Safari/537.36",
+    # In-app browsers
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 [Pinterest/iOS]",
+    "Mozilla/5.0 (Linux; Android 13; SM-G991B Build/TP1A.220624.014; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/119.0.6045.163 Mobile Safari/537.36 [Pinterest/Android]",
+    "Mozilla/5.0 (Linux; Android 12; M2101K6G Build/SKQ1.210908.001; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/118.0.5993.80 Mobile Safari/537.36 Viber/20.5.1.0",
+    "Mozilla/5.0 (Linux; arm_64; Android 13; SM-A525F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.5993.111 YaApp_Android/23.111.1 YaSearchBrowser/23.111.1 BroPP/1.0 SA/3 Mobile Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 16_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148 YandexSearch/23.81.1 YaSearchApp/23.81.1",
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.6367.82 Mobile Safari/537.36 Telegram-Android/10.12.0 (Google Pixel 8; Android 14; SDK 34; HIGH)",
+    "Mozilla/5.0 (Linux; Android 13; SM-S911B; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/120.0.6099.144 Mobile Safari/537.36 Instagram 309.0.0.40.113 Android",
+    "Mozilla/5.0 (Linux; Android 11; Redmi Note 8; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/117.0 Mobile Safari/537.36 VKAndroidApp/8.52-15555 (Android 11; SDK 30; arm64-v8a; Xiaomi Redmi Note 8; ru; 2130x1080)",
+]
+
+BOT_USER_AGENTS = [
+    "Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)",
+    "Mozilla/5.0 (compatible; YandexImages/3.0; +http://yandex.com/bots)",
+    "Mozilla/5.0 (compatible; YandexMetrika/2.0; +http://yandex.com/bots yabs01)",
+    "Mozilla/5.0 (compatible; Pinterestbot/1.0; +http://www.pinterest.com/bot.html)",
+    "Pinterest/0.2 (+https://www.pinterest.com/bot.html)",
+    "TelegramBot (like TwitterBot)",
+    "WhatsApp/2.23.20.0 A",
+    "Viber/14.2 CFNetwork/1240.0.4 Darwin/20.6.0",
+    "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
+    "Mozilla/5.0 (compatible; vkShare; +http://vk.com/dev/Share)",
+    "Twitterbot/1.0",
+    "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)",
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) HeadlessChrome/120.0.0.0 Safari/537.36",
+    "curl/8.4.0",
+    "python-requests/2.31.0",
+]
+
+
+def make_event(user_agent, ip_hash="h1", link_id="l1", prefetch=False):
+    return TrackingEvent(kind="click", page_id="p1", link_id=link_id, timestamp=utc_now(),
+                         user_agent=user_agent, ip_hash=ip_hash, prefetch=prefetch)
+
+
+class TestBotUserAgents:
+    """Bot-specific tokens only: in-app browsers of real visitors are kept"""
+
+    @pytest.mark.parametrize("user_agent", HUMAN_USER_AGENTS)
+    def test_human_user_agents_pass(self, user_agent):
+        assert not TRACK_BOT_UA_PATTERN.search(user_agent)
+
+    @pytest.mark.parametrize("user_agent", BOT_USER_AGENTS)
+    def test_bot_user_agents_match(self, user_agent):
+        assert TRACK_BOT_UA_PATTERN.search(user_agent)
+
+
+class TestIngestFilter:
+    """Bot modes, prefetches and duplicates"""
+
+    def test_drop_mode_drops_bots(self):
+        assert IngestFilter("drop", 0, 100).check(make_event(BOT_USER_AGENTS[0])) == "bot"
+
+    def test_flag_mode_marks_bots(self):
+        event = make_event(BOT_USER_AGENTS[0])
+        event.geo_pending = True
+        assert IngestFilter("flag", 0, 100).check(event) is None
+        assert event.bot and not event.geo_pending
+        assert event.to_document()["bot"] is True
+
+    def test_off_mode_keeps_bots(self):
+        event = make_event(BOT_USER_AGENTS[0])
+        assert IngestFilter("off", 0, 100).check(event) is None
+        assert not event.bot
+
+    def test_unknown_mode_is_rejected(self):
+        with pytest.raises(ValueError):
+            IngestFilter("Drop", 0, 100)
+
+    def test_prefetch_and_empty_user_agent(self):
+        ingest = IngestFilter("drop", 0, 100)
+        assert ingest.check(make_event(HUMAN_USER_AGENTS[0], prefetch=True)) == "prefetch"
+        assert ingest.check(make_event("")) == "empty_user_agent"
+
+    def test_duplicates_within_window(self):
+        ingest = IngestFilter("drop", 10, 100)
+        assert ingest.check(make_event(HUMAN_USER_AGENTS[0])) is None
+        assert ingest.check(make_event(HUMAN_USER_AGENTS[0])) == "duplicate"
+        assert ingest.check(make_event(HUMAN_USER_AGENTS[0], link_id="l2")) is None
+        assert ingest.check(make_event(HUMAN_USER_AGENTS[0], ip_hash="h2")) is None
+
+
+class TestDedupWindow:
+    """Keys are remembered for one to two windows"""
+
+    def test_window_expiry(self):
+        window = DedupWindow(10, 100)
+        assert not window.seen("k", now=0)
+        assert window.seen("k", now=5)
+        assert window.seen("k", now=15)
+        assert not window.seen("k", now=35)
+
+    def test_max_keys_overflow_passes_through(self):
+        window = DedupWindow(10, 1)
+        assert not window.seen("a", now=0)
+        assert not window.seen("b", now=0)
+        assert not window.seen("b", now=1)
+        assert window.overflow == 2
@@ -0,0 +1,142 @@
+"""
+Unit tests for the Space-Saving top-K summary behind the heavy hitters (no server or database needed)
+Tests: exact counts under capacity, eviction error bounds, weighted adds, document round trip,
+heavy hitters flush (owner lookup failures, shutdown during a flush)
+"""
+import asyncio
+import random
+from collections import Counter
+
+from server import HeavyHitters, SpaceSaving, TrackingEvent, utc_now
+
+
+class TestSpaceSaving:
+    """count - error <= true count <= count, error <= N / capacity"""
+
+    def test_exact_while_under_capacity(self):
+        summary = SpaceSaving(10)
+        for value in ["RU", "RU", "DE", "RU", "US"]:
+            summary.add(value)
+        assert summary.counters == {"RU": [3, 0], "DE": [1, 0], "US": [1, 0]}
+        assert summary.top(1) == [("RU", [3, 0])]
+        assert summary.total == 5
+
+    def test_eviction_replaces_minimum_and_records_error(self):
+        summary = SpaceSaving(2)
+        summary.add("a", 5)
+        summary.add("b", 2)
+        summary.add("c", 1)
+        assert summary.counters == {"a": [5, 0], "c": [3, 2]}
+        assert summary.total == 8
+
+    def test_error_bounds_on_skewed_stream(self):
+        rng = random.Random(42)
+        values = [f"city-{int(rng.paretovariate(1.2))}" for _ in range(20000)]
+        capacity = 50
+        summary = SpaceSaving(capacity)
+        for value in values:
+            summary.add(value)
+        truth = Counter(values)
+        bound = len(values) / capacity
+        assert len(summary.counters) <= capacity
+        for value, (count, error) in summary.counters.items():
+            assert error <= bound
+            assert count - error <= truth[value] <= count
+        # Every value above N/k is monitored
+        for value, true_count in truth.items():
+            if true_count > bound:
+                assert value in summary.counters
+
+    def test_top_k_order(self):
+        summary = SpaceSaving(100)
+        for value, weight in [("x", 3), ("y", 10), ("z", 7)]:
+            summary.add(value, weight)
+        assert [value for value, _ in summary.top(2)] == ["y", "z"]
+
+    def test_document_round_trip(self):
+        summary = SpaceSaving(3)
+        for value, weight in [("a", 4), ("b", 2), ("c", 1), ("d", 1)]:
+            summary.add(value, weight)
+        restored = SpaceSaving.from_document(summary.to_document())
+        assert restored.capacity == 3
+        assert restored.total == summary.total
+        assert restored.counters == summary.counters
+
+
+def make_clicks(page_id, countries):
+    return [TrackingEvent(kind="click", page_id=page_id, link_id="l1", timestamp=utc_now(), country=country, city="M")
+            for country in countries]
+
+
+class TestHeavyHittersFlush:
+    """Recorded deltas survive failed owner lookups and a cancelled flush loop"""
+
+    def test_owner_lookup_failure_keeps_pending(self):
+        async def scenario():
+            hitters = HeavyHitters(10, 0.01)
+
+            async def page_owners(page_ids):
+                raise RuntimeError("mongo down")
+
+            hitters._page_owners = page_owners
+            await hitters.record(make_clicks("p1", ["RU", "RU"]))
+            assert await hitters.flush() == 0
+            await hitters.record(make_clicks("p1", ["DE"]))
+            return hitters
+
+        hitters = asyncio.run(scenario())
+        assert hitters._pending["p1"]["country"] == {"RU": 2, "DE": 1}
+        assert hitters._pending["p1"]["city"] == {"M": 3}
+
+    def test_cancelling_run_mid_flush_applies_the_batch(self):
+        applied = {}
+
+        async def scenario():
+            hitters = HeavyHitters(10, 0.01)
+            started, release = asyncio.Event(), asyncio.Event()
+
+            async def page_owners(page_ids):
+                return {page_id: "u1" for page_id in page_ids}
+
+            async def apply(key, deltas):
+                started.set()
+                await release.wait()
+                applied[key] = deltas
+                return True
+
+            hitters._page_owners = page_owners
+            hitters._apply = apply
+            await hitters.record(make_clicks("p1", ["RU"]))
+            task = asyncio.ensure_future(hitters.run())
+            await started.wait()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            release.set()
+            assert await hitters.flush() == 0
+            return hitters
+
+        hitters = asyncio.run(scenario())
+        assert applied[("page:p1", "country")] == {"RU": 1}
+        assert applied[("user:u1", "country")] == {"RU": 1}
+        assert applied[("global", "city")] == {"M": 1}
+        assert not hitters._pending and not hitters._retry
+
+    def test_failed_scope_is_retried_alone(self):
+        async def scenario():
+            hitters = HeavyHitters(10, 0.01)
+
+            async def page_owners(page_ids):
+                return {}
+
+            async def apply(key, deltas):
+                return key != ("global", "country")
+
+            hitters._page_owners = page_owners
+            hitters._apply = apply
+            await hitters.record(make_clicks("p1", ["RU", "DE"]))
+            assert await hitters.flush() == 3
+            return hitters
+
+        hitters = asyncio.run(scenario())
+        assert hitters._retry == {("global", "country"): {"RU": 1, "DE": 1}}
+        assert hitters.failed == 1
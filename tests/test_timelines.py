@@ -0,0 +1,133 @@
+"""
+Unit tests for timeline bucketing (no server or database needed)
+Tests: bucket floors and steps across DST changes, request alignment and limits, zero-filled series
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+from fastapi import HTTPException
+
+from server import TIMELINE_SERIES, TimelineRequest, Timelines, timeline_floor, timeline_next
+
+BERLIN = ZoneInfo("Europe/Berlin")
+UTC = timezone.utc
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=UTC)
+
+
+def walk(start, granularity, tz, count):
+    points = [start]
+    for _ in range(count - 1):
+        points.append(timeline_next(points[-1], granularity, tz))
+    return points
+
+
+class TestTimelineBuckets:
+    """Buckets are local calendar units; hours are real hours even when the clock jumps"""
+
+    def test_floor(self):
+        ts = utc(2025, 10, 15, 22, 30)  # Thursday 00:30 in Berlin
+        assert timeline_floor(ts, "hour", BERLIN) == datetime(2025, 10, 16, 0, tzinfo=BERLIN)
+        assert timeline_floor(ts, "day", BERLIN) == datetime(2025, 10, 16, tzinfo=BERLIN)
+        assert timeline_floor(ts, "week", BERLIN) == datetime(2025, 10, 13, tzinfo=BERLIN)
+        assert timeline_floor(ts, "month", BERLIN) == datetime(2025, 10, 1, tzinfo=BERLIN)
+
+    def test_hours_across_fall_back(self):
+        # 2025-10-26 03:00 CEST -> 02:00 CET: the 02:00 wall hour happens twice
+        hours = walk(timeline_floor(utc(2025, 10, 25, 22), "hour", BERLIN), "hour", BERLIN, 5)
+        assert [h.astimezone(UTC).hour for h in hours] == [22, 23, 0, 1, 2]
+        assert [h.hour for h in hours] == [0, 1, 2, 2, 3]
+
+    def test_hours_across_spring_forward(self):
+        # 2025-03-30 02:00 CET -> 03:00 CEST: no 02:00 wall hour
+        hours = walk(timeline_floor(utc(2025, 3, 29, 23), "hour", BERLIN), "hour", BERLIN, 3)
+        assert [h.hour for h in hours] == [0, 1, 3]
+        assert [h.astimezone(UTC).hour for h in hours] == [23, 0, 1]
+
+    def test_days_weeks_months_across_dst(self):
+        days = walk(datetime(2025, 10, 25, tzinfo=BERLIN), "day", BERLIN, 3)
+        lengths = [(b.astimezone(UTC) - a.astimezone(UTC)) / timedelta(hours=1) for a, b in zip(days, days[1:])]
+        assert lengths == [24, 25]
+        weeks = walk(datetime(2025, 10, 20, tzinfo=BERLIN), "week", BERLIN, 2)
+        assert weeks[1] == datetime(2025, 10, 27, tzinfo=BERLIN)
+        months = walk(datetime(2025, 11, 1, tzinfo=BERLIN), "month", BERLIN, 3)
+        assert months[1:] == [datetime(2025, 12, 1, tzinfo=BERLIN), datetime(2026, 1, 1, tzinfo=BERLIN)]
+
+
+class TestTimelineRequest:
+    """Requests are aligned to whole buckets and bounded"""
+
+    def test_aligned_to_buckets(self):
+        request = TimelineRequest("day", "2025-10-25T13:00:00+02:00", "2025-10-27T01:00:00+01:00", "Europe/Berlin")
+        assert request.since == datetime(2025, 10, 25, tzinfo=BERLIN)
+        assert request.until == datetime(2025, 10, 28, tzinfo=BERLIN)
+        assert len(request.buckets) == 3
+
+    def test_fall_back_day_has_25_hours(self):
+        request = TimelineRequest("hour", "2025-10-26T00:00:00", "2025-10-27T00:00:00", "Europe/Berlin")
+        assert len(request.buckets) == 25
+
+    @pytest.mark.parametrize("args", [
+        ("minute", None, None, None),
+        ("day", None, None, "Mars/Olympus"),
+        ("day", "yesterday", None, None),
+        ("day", "2025-10-02", "2025-10-01", None),
+        ("hour", "2020-01-01", "2025-01-01", None),
+    ])
+    def test_invalid(self, args):
+        with pytest.raises(HTTPException) as exc:
+            TimelineRequest(*args)
+        assert exc.value.status_code == 400
+
+
+class TestTimelineSeries:
+    """Series are dense: buckets without rows are zeros"""
+
+    def test_zero_filled_hours_across_fall_back(self, monkeypatch):
+        timelines = Timelines(30)
+        request = TimelineRequest("hour", "2025-10-26T00:00:00", "2025-10-26T04:00:00", "Europe/Berlin")
+        rows = [
+            (utc(2025, 10, 26, 0), {"views": 3, "clicks": 1}),  # 02:00 CEST
+            (utc(2025, 10, 26, 1), {"views": 5}),               # 02:00 CET
+            (utc(2025, 10, 26, 2), {"qr": 2}),                  # 03:00 CET
+        ]
+
+        async def fake_rows(page_match, timeline_request):
+            return rows
+
+        monkeypatch.setattr(timelines, "_rows", fake_rows)
+        result = asyncio.run(timelines.series("page:p1", ["p1"], request))
+        points = result["points"]
+        assert [p["t"] for p in points] == [
+            "2025-10-26T00:00:00+02:00", "2025-10-26T01:00:00+02:00", "2025-10-26T02:00:00+02:00",
+            "2025-10-26T02:00:00+01:00", "2025-10-26T03:00:00+01:00",
+        ]
+        assert [p["views"] for p in points] == [0, 0, 3, 5, 0]
+        assert [p["qr"] for p in points] == [0, 0, 0, 0, 2]
+        assert result["totals"] == {"views": 8, "clicks": 1, "shares": 0, "qr": 2}
+        # Cached: a second call does not read rows again
+        rows.clear()
+        assert asyncio.run(timelines.series("page:p1", ["p1"], request)) is result
+
+    def test_rows_are_rebucketed_to_coarser_steps(self, monkeypatch):
+        timelines = Timelines(30)
+        request = TimelineRequest("week", "2025-10-20", "2025-11-03", "Europe/Berlin")
+
+        async def fake_rows(page_match, timeline_request):
+            # Sunday 23:30 and Monday 00:30 in Berlin
+            return [(utc(2025, 10, 21, 12), {"clicks": 2}), (utc(2025, 10, 26, 22, 30), {"clicks": 4}),
+                    (utc(2025, 10, 26, 23, 30), {"clicks": 1})]
+
+        monkeypatch.setattr(timelines, "_rows", fake_rows)
+        result = asyncio.run(timelines.series("page:p1", ["p1"], request))
+        assert [p["clicks"] for p in result["points"]] == [6, 1]
+        assert set(result["points"][0]) == {"t", *TIMELINE_SERIES}
+
+    def test_no_pages(self):
+        request = TimelineRequest("day", "2025-10-01", "2025-10-04", "UTC")
+        result = asyncio.run(Timelines(30).series("user:u1", [], request))
+        assert [p["clicks"] for p in result["points"]] == [0, 0, 0]
@@ -0,0 +1,87 @@
+"""
+Unit tests for the in-process TTL cache behind the public page cache (no server or database needed)
+Tests: LRU bound, TTL expiry, generation guard against stale fills, pop_where invalidation by page/owner
+"""
+import server
+from server import TTLCache, _evict_public_pages
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    """Entries expire, the oldest is evicted first, invalidations win over slow fills"""
+
+    def test_lru_eviction(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert (cache.get("a"), cache.get("c")) == (1, 3)
+        assert cache.evictions == 1
+
+    def test_ttl_expiry(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr(server.time, "monotonic", clock)
+        cache = TTLCache(10, 5)
+        cache.set("a", 1)
+        clock.now += 4
+        assert cache.get("a") == 1
+        clock.now += 2
+        assert cache.get("a") is None
+        assert len(cache) == 0
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_stale_fill_is_discarded_after_invalidation(self):
+        cache = TTLCache(10, 60)
+        generation = cache.generation
+        # An invalidation lands while the payload is still being built
+        cache.pop("page")
+        cache.set("page", "stale", generation=generation)
+        assert cache.get("page") is None
+        cache.set("page", "fresh", generation=cache.generation)
+        assert cache.get("page") == "fresh"
+
+    def test_every_invalidation_bumps_generation(self):
+        cache = TTLCache(10, 60)
+        generations = [cache.generation]
+        cache.pop("missing")
+        generations.append(cache.generation)
+        cache.pop_where(lambda key, value: False)
+        generations.append(cache.generation)
+        cache.clear()
+        generations.append(cache.generation)
+        assert generations == sorted(set(generations))
+
+    def test_pop_where(self):
+        cache = TTLCache(10, 60)
+        cache.set("s1", {"id": "p1", "user_id": "u1"})
+        cache.set("s2", {"id": "p2", "user_id": "u1"})
+        cache.set("s3", {"id": "p3", "user_id": "u2"})
+        assert cache.pop_where(lambda slug, payload: payload["user_id"] == "u1") == 2
+        assert cache.get("s1") is None and cache.get("s2") is None
+        assert cache.get("s3") == {"id": "p3", "user_id": "u2"}
+
+
+class TestPublicPageEviction:
+    """Invalidation scopes: page id, owner id, everything"""
+
+    def test_scopes(self, monkeypatch):
+        cache = TTLCache(10, 60)
+        monkeypatch.setattr(server, "_public_page_cache", cache)
+        for slug, page_id, user_id in [("a", "p1", "u1"), ("b", "p2", "u1"), ("c", "p3", "u2")]:
+            cache.set(slug, {"id": page_id, "user_id": user_id})
+        assert _evict_public_pages("page", "p3") == 1
+        assert _evict_public_pages("page", "p3") == 0
+        assert _evict_public_pages("user", "u1") == 2
+        cache.set("d", {"id": "p4", "user_id": "u3"})
+        assert _evict_public_pages("all") == 1
+        assert len(cache) == 0
+        assert _evict_public_pages("unknown", "x") == 0
@@ -0,0 +1,72 @@
+"""
+Unit tests for the unique visitor buffer (no server or database needed)
+Tests: pending hashes per page and day, requeue of failed merges, shutdown during a flush
+"""
+import asyncio
+
+from server import ALL_PAGES, UniqueVisitors, analytics_day, utc_now
+
+
+def make_visitors(merge):
+    visitors = UniqueVisitors(0.01, 1000)
+    visitors._merge = merge
+    return visitors
+
+
+class TestUniqueVisitors:
+    """Hashes are only dropped once their merge succeeded"""
+
+    def test_observe_counts_page_and_all_pages(self):
+        visitors = UniqueVisitors(1, 1000)
+        visitors.observe("p1", "1.1.1.1", "ua")
+        visitors.observe("p1", "1.1.1.1", "ua")
+        visitors.observe("p1", "2.2.2.2", "ua")
+        day = analytics_day(utc_now())
+        assert len(visitors._pending[("p1", day)]) == 2
+        assert len(visitors._pending[(ALL_PAGES, day)]) == 2
+        assert visitors._pending_hashes == 4
+
+    def test_failed_merge_is_requeued(self):
+        async def merge(key, hashes):
+            if key[0] == "p1":
+                raise RuntimeError("write failed")
+            return True
+
+        async def scenario():
+            visitors = make_visitors(merge)
+            visitors.observe("p1", "1.1.1.1", "ua")
+            assert await visitors.flush() == 1
+            return visitors
+
+        visitors = asyncio.run(scenario())
+        assert [key[0] for key in visitors._pending] == ["p1"]
+        assert visitors._pending_hashes == 1
+        assert visitors.failed == 1
+
+    def test_cancelling_run_mid_flush_keeps_the_batch(self):
+        merged = []
+
+        async def scenario():
+            started, release = asyncio.Event(), asyncio.Event()
+
+            async def merge(key, hashes):
+                started.set()
+                await release.wait()
+                merged.append(key)
+                return True
+
+            visitors = make_visitors(merge)
+            visitors.observe("p1", "1.1.1.1", "ua")
+            task = asyncio.ensure_future(visitors.run())
+            await started.wait()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            release.set()
+            # The shutdown flush waits for the in-flight one instead of finding nothing
+            assert await visitors.flush() == 0
+            assert visitors._flush_task.done()
+            return visitors
+
+        visitors = asyncio.run(scenario())
+        assert sorted(key[0] for key in merged) == sorted(["p1", ALL_PAGES])
+        assert not visitors._pending and visitors.failed == 0